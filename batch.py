@@ -0,0 +1,250 @@
+"""Headless prompt generation from a JSONL job file.
+
+Usage: python main.py batch jobs.jsonl [--output results.jsonl | --output-dir DIR]
+
+Each line of the job file is a JSON object with these keys; the paths
+fall back to settings.json when omitted:
+
+    id                  name of the job, used for output files (default: line number)
+    defect_description  text for the "Defect Description" section
+    prompt_template     template file
+    context_file        project context file
+    root_folder         project root
+    files               list of globs relative to root_folder, "**" spans folders
+    structure_mode      full, selected, depth or collapse (default: full)
+    symbols             {"rel/path.py": ["Class.method", ...]}: classes and
+                        functions to include in full, the rest of those
+                        files is cut down to signatures
+    git_changed         true to also select the files with uncommitted
+                        changes and those changed in the last git_commits
+                        commits (default: 5) of the root's git repository
+    git_diffs           true to include the diffs of changed files since
+                        git_commits commits ago instead of whole files
+    part_size           split prompts into parts of at most this many
+                        part_unit ("tokens" or "kb"), written as
+                        <id>.part1of3.txt and so on (default: 0, no split)
+
+With scan_agent set to the address of a running scan agent (see
+scan_agent.py), folders are listed and files read through it.
+
+With import_depth above 0 (default: 0), the project files that the
+selected files import are selected too, following imports that many
+levels deep.
+
+Files named by stack frames in the defect description are selected too,
+and cut down to stack_trace_context lines around the frames (0 includes
+them whole).
+
+This module must not import PyQt, so it starts quickly on a headless box.
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from indexer import ExclusionRules, translate_glob
+from index_snapshot import open_project_index
+from prompt_builder import PromptBuilder, read_text_file
+from tree_structure import render_tree_structure
+from stack_trace import parse_frames, FrameResolver
+from import_graph import ImportGraph
+from git_repo import GitRepository, DiffSource
+from scan_agent import connect_agent
+from file_ingest import DEFAULT_MAX_FILE_BYTES, DEFAULT_MAX_TOTAL_BYTES
+from utils import read_settings, default_settings
+
+
+class ProjectIndexCache:
+    """One complete index per (root, rules), shared by the jobs of a worker"""
+
+    def __init__(self):
+        self._indexes = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, root_path, rules, settings=None):
+        key = (root_path, rules.key())
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        # Jobs for the same root wait for the first one to build it
+        with lock:
+            project_index = self._indexes.get(key)
+            if project_index is None:
+                agent = connect_agent(settings or {}, root_path, rules)
+                project_index = open_project_index(root_path, rules, agent=agent)
+                self._indexes[key] = project_index
+            return project_index
+
+
+_index_cache = ProjectIndexCache()
+
+
+def select_files(project_index, patterns):
+    """Ids of the indexed files matching any of the globs, in tree order"""
+    if not patterns:
+        return []
+    regex = re.compile("|".join(
+        "(?:" + translate_glob(pattern.replace("\\", "/").lstrip("/")) + r")\Z"
+        for pattern in patterns))
+    return [file_id for file_id in project_index.iter_files()
+            if regex.match(project_index.rel_path(file_id, "/"))]
+
+
+def create_job_builder(job, settings):
+    """PromptBuilder for one job, sharing indexes with earlier jobs"""
+    merged = dict(settings)
+    merged.update(job)
+    root_folder = merged.get("root_folder", "")
+    if not root_folder or not os.path.isdir(root_folder):
+        raise ValueError(f"Root folder not found: {root_folder!r}")
+
+    project_index = _index_cache.get(
+        root_folder, ExclusionRules.from_settings(merged), merged)
+    selected_ids = select_files(project_index, merged.get("files", []))
+    git_commits = merged.get("git_commits", 5)
+    repository = None
+    if merged.get("git_changed") or merged.get("git_diffs"):
+        repository = GitRepository.open(root_folder)
+        if repository is None:
+            raise ValueError(f"Root folder is not in a git repository: {root_folder!r}")
+    if merged.get("git_changed"):
+        selected = set(selected_ids)
+        for rel_path in repository.changed_files(git_commits):
+            file_id = project_index.find(rel_path)
+            if file_id >= 0 and not project_index.is_dir(file_id) and file_id not in selected:
+                selected.add(file_id)
+                selected_ids.append(file_id)
+    import_depth = merged.get("import_depth", 0)
+    if import_depth > 0 and selected_ids:
+        import_graph = ImportGraph(root_folder, project_index)
+        import_graph.load()
+        selected_ids.extend(import_graph.dependencies(selected_ids, import_depth))
+        if import_graph.modified:
+            try:
+                import_graph.save()
+            except OSError as e:
+                print(f"Warning: Could not save import cache: {str(e)}")
+    frames = parse_frames(merged.get("defect_description", ""))
+    trace_lines = FrameResolver(project_index).resolve_frames(frames) if frames else {}
+    selected = set(selected_ids)
+    selected_ids.extend(entry_id for entry_id in trace_lines if entry_id not in selected)
+    selected.update(trace_lines)
+    symbols = {}
+    for rel_path, names in merged.get("symbols", {}).items():
+        file_id = project_index.find(rel_path)
+        if file_id < 0:
+            raise ValueError(f"File in symbols not found: {rel_path!r}")
+        if file_id not in selected:
+            selected.add(file_id)
+            selected_ids.append(file_id)
+        symbols[project_index.path(file_id)] = names
+    context_lines = merged.get("stack_trace_context", 20)
+    max_file_kb = merged.get("max_file_size_kb", DEFAULT_MAX_FILE_BYTES // 1024)
+    max_total_mb = merged.get("max_total_size_mb", DEFAULT_MAX_TOTAL_BYTES // (1024 * 1024))
+    part_size, part_unit = merged.get("part_size", 0), merged.get("part_unit", "tokens")
+    if part_unit == "kb":
+        part_size *= 1024
+    structure = render_tree_structure(
+        project_index, mode=merged.get("structure_mode", "full"),
+        selected_ids=selected_ids,
+        max_depth=merged.get("structure_max_depth", 3),
+        max_entries=merged.get("structure_max_entries", 50))
+    return PromptBuilder(
+        read_text_file(merged.get("prompt_template", "")),
+        merged.get("defect_description", ""),
+        read_text_file(merged.get("context_file", "")),
+        structure,
+        [project_index.path(file_id) for file_id in selected_ids],
+        root_folder,
+        line_windows={project_index.path(file_id): lines
+                      for file_id, lines in trace_lines.items()} if context_lines > 0 else None,
+        context_lines=context_lines,
+        max_file_bytes=max_file_kb * 1024 if max_file_kb > 0 else None,
+        max_total_bytes=max_total_mb * 1024 * 1024 if max_total_mb > 0 else None,
+        symbols=symbols,
+        part_budget=part_size or None,
+        part_unit="chars" if part_unit == "kb" else "tokens",
+        diff_source=DiffSource(repository, git_commits) if merged.get("git_diffs") else None,
+        file_source=project_index.agent)
+
+
+def _output_path(output_dir, job_id):
+    """Output file of a job; rejects ids that would leave output_dir"""
+    name = f"{job_id}.txt"
+    if (os.path.isabs(name) or os.path.basename(name) != name
+            or (os.altsep and os.altsep in name) or str(job_id) in ("", ".", "..")):
+        raise ValueError(f"Job id cannot be used as a file name: {job_id!r}")
+    return os.path.join(output_dir, name)
+
+
+def run_job(job, settings, output_dir=None):
+    """Generate one prompt; returns a JSON-ready result record"""
+    result = {"id": job["id"]}
+    try:
+        path = _output_path(output_dir, job["id"]) if output_dir else None
+        builder = create_job_builder(job, settings)
+        result["files"] = len(builder.files)
+        if output_dir and builder.part_budget:
+            result["outputs"] = builder.write_parts(path)
+        elif builder.part_budget:
+            result["parts"] = builder.build_parts()
+        elif output_dir:
+            builder.write_file(path)
+            result["output"] = path
+        else:
+            result["prompt"] = builder.build()
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+
+def read_jobs(path):
+    jobs = []
+    with open(path, 'r', encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line)
+            job.setdefault("id", str(line_number))
+            jobs.append(job)
+    return jobs
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="main.py batch", description="Generate prompts from a JSONL job file.")
+    parser.add_argument("jobs", help="JSONL file with one job per line")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--output", "-o",
+                        help="JSONL file for the results (default: stdout)")
+    output.add_argument("--output-dir", "-d",
+                        help="write each prompt to <id>.txt in this folder")
+    parser.add_argument("--workers", "-j", type=int, default=os.cpu_count() or 1,
+                        help="number of jobs to run at once")
+    parser.add_argument("--processes", action="store_true",
+                        help="run jobs in worker processes instead of threads")
+    args = parser.parse_args(argv)
+
+    settings = read_settings() or default_settings()
+    jobs = read_jobs(args.jobs)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    pool_class = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+    out = open(args.output, 'w', encoding="utf-8") if args.output else sys.stdout
+    failed = 0
+    try:
+        with pool_class(max(1, args.workers)) as pool:
+            results = pool.map(run_job, jobs, [settings] * len(jobs),
+                               [args.output_dir] * len(jobs))
+            for result in results:
+                failed += "error" in result
+                out.write(json.dumps(result) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 1 if failed else 0
@@ -0,0 +1,387 @@
+"""Benchmarks of the hot paths on a synthetic project, run headless.
+
+Usage: python benchmark.py [--files 20000] [--depth 4] [--fanout 6]
+                           [--file-size 4096] [--binary-ratio 0.05]
+                           [--repeat 3] [--output results.json]
+                           [--baseline baseline.json] [--tolerance 0.25]
+
+A synthetic project of the given shape is generated once per set of
+parameters in the work folder and reused by later runs. The main window
+then runs under Qt's offscreen platform, from a scratch folder with its
+own settings.json, and these are timed:
+
+    tree_load_cold_root     populate_file_tree until the root is listed,
+                            without an index snapshot
+    tree_load_cold_index    ... until the whole project is indexed
+    tree_load_warm_root     the same, starting from the saved snapshot
+    tree_load_warm_index
+    relevance_index         building the full-text index after a cold load
+    select_subtree          checking the root folder, including
+                            on_tree_selection_changed
+    get_selected_files      paths of every selected file
+    tree_structure          _get_tree_structure of the selection, not memoized
+    generate_prompt_cold    generate_prompt end to end with an empty content
+                            cache, until the prompt is shown and copied
+    generate_prompt_warm    the same with the files cached
+
+Every result has the time of each run, their median and minimum, and the
+peak RSS of the process after the phase; --trace-memory adds the peak of
+Python allocations during the phase, which slows the runs down. Results
+are written as JSON with --output. With --baseline, the medians are
+compared against an earlier results file, and the exit status is 1 if
+any phase got slower by more than the tolerance.
+
+The caches of the synthetic project are deleted between cold runs. The
+benchmark never touches the real settings.json.
+"""
+import os
+import sys
+import json
+import time
+import random
+import platform
+import tempfile
+import argparse
+import statistics
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is left out there
+    resource = None
+
+
+VERSION = 1
+
+DEFAULT_WORKDIR = os.path.join(tempfile.gettempdir(), "llm_prompter_benchmark")
+
+# Differences below this many seconds are noise, whatever the ratio
+NOISE_SECONDS = 0.005
+
+_WORDS = ("value", "index", "result", "config", "request", "buffer", "entry",
+          "parser", "handler", "record", "status", "payload", "session", "cache")
+
+
+def _python_source(rng, size, module_names):
+    """Plausible Python source of about size bytes"""
+    lines = [f"import {name}" for name in rng.sample(module_names, min(3, len(module_names)))]
+    lines.append("")
+    length = sum(len(line) + 1 for line in lines)
+    number = 0
+    while length < size:
+        name = f"{rng.choice(_WORDS)}_{number}"
+        block = [
+            "",
+            f"def {name}({rng.choice(_WORDS)}, {rng.choice(_WORDS)}=None):",
+            f"    \"\"\"Compute the {rng.choice(_WORDS)} of a {rng.choice(_WORDS)}\"\"\"",
+            f"    {rng.choice(_WORDS)} = [{rng.choice(_WORDS)} for _ in range({number})]",
+            f"    if {rng.choice(_WORDS)} is None:",
+            f"        return {rng.randint(0, 1000)}",
+            f"    return len({rng.choice(_WORDS)})",
+        ]
+        lines.extend(block)
+        length += sum(len(line) + 1 for line in block)
+        number += 1
+    return "\n".join(lines) + "\n"
+
+
+def generate_project(root, files=20000, depth=4, fanout=6, file_size=4096,
+                     binary_ratio=0.05, seed=0):
+    """Write a synthetic project below root; returns its number of files.
+
+    Folders are fanout wide and depth deep, and the files are spread over
+    all of them. File sizes vary from half to one and a half times
+    file_size, and binary_ratio of the files are random bytes. The
+    project also has a .gitignore, ignored log files and a node_modules
+    folder, so the exclusion rules have something to do.
+    """
+    rng = random.Random(seed)
+    folders = [""]
+    level = [""]
+    for _ in range(depth):
+        level = [f"{parent}/pkg{number}" if parent else f"pkg{number}"
+                 for parent in level for number in range(fanout)]
+        folders.extend(level)
+    for folder in folders:
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    module_names = [f"module_{number}" for number in range(min(files, 500))]
+    for number in range(files):
+        folder = os.path.join(root, folders[number % len(folders)])
+        size = int(file_size * rng.uniform(0.5, 1.5))
+        if rng.random() < binary_ratio:
+            with open(os.path.join(folder, f"asset_{number}.bin"), 'wb') as f:
+                f.write(rng.randbytes(size) if hasattr(rng, "randbytes")
+                        else os.urandom(size))
+        else:
+            with open(os.path.join(folder, f"module_{number}.py"), 'w') as f:
+                f.write(_python_source(rng, size, module_names))
+
+    with open(os.path.join(root, ".gitignore"), 'w') as f:
+        f.write("*.log\nbuild/\n")
+    for number in range(20):
+        with open(os.path.join(root, folders[number % len(folders)], f"run_{number}.log"), 'w') as f:
+            f.write("log line\n" * 100)
+    node_modules = os.path.join(root, "node_modules", "dependency")
+    os.makedirs(node_modules, exist_ok=True)
+    for number in range(50):
+        with open(os.path.join(node_modules, f"index_{number}.js"), 'w') as f:
+            f.write("module.exports = {};\n")
+    return files
+
+
+def ensure_project(workdir, params):
+    """Root of the synthetic project for params, generated if missing"""
+    name = "project-" + "-".join(f"{params[key]}" for key in sorted(params))
+    root = os.path.join(workdir, name)
+    marker = os.path.join(workdir, name + ".json")
+    if os.path.exists(marker):
+        with open(marker, 'r') as f:
+            if json.load(f) == params:
+                return root, 0.0
+    started = time.perf_counter()
+    generate_project(root, **params)
+    elapsed = time.perf_counter() - started
+    with open(marker, 'w') as f:
+        json.dump(params, f)
+    return root, elapsed
+
+
+def peak_rss_kb():
+    """Peak resident memory of the process so far, None where unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+class Benchmark:
+    """Drives a MainWindow through the timed phases"""
+
+    def __init__(self, app, root_path, repeat=3, trace_memory=False, timeout=600):
+        self.app = app
+        self.root_path = root_path
+        self.repeat = repeat
+        self.trace_memory = trace_memory
+        self.timeout = timeout
+        self.results = {}
+        self.window = None
+        self.file_count = 0
+
+    def wait(self, condition, what):
+        """Run the event loop until condition() holds"""
+        deadline = time.perf_counter() + self.timeout
+        while not condition():
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"Timed out waiting for {what}")
+            self.app.processEvents()
+            time.sleep(0.001)
+
+    def record(self, name, seconds, python_peak=None):
+        result = self.results.setdefault(name, {"runs": []})
+        result["runs"].append(round(seconds, 6))
+        result["median"] = round(statistics.median(result["runs"]), 6)
+        result["min"] = min(result["runs"])
+        result["peak_rss_kb"] = peak_rss_kb()
+        if python_peak is not None:
+            result["python_peak_kb"] = max(result.get("python_peak_kb", 0),
+                                           python_peak // 1024)
+
+    def timed(self, name, function):
+        """Time function() and record it under name; returns its result"""
+        if self.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        value = function()
+        elapsed = time.perf_counter() - started
+        python_peak = None
+        if self.trace_memory:
+            python_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.record(name, elapsed, python_peak)
+        return value
+
+    def run(self):
+        from ui import MainWindow
+        self.window = MainWindow()
+        self.window.show()
+        try:
+            for _ in range(self.repeat):
+                self._delete_caches()
+                self._load_tree("cold")
+            for _ in range(self.repeat):
+                self._load_tree("warm")
+            self._select_and_generate()
+        finally:
+            self.window.close()
+        return self.results
+
+    def _delete_caches(self):
+        from index_snapshot import snapshot_path
+        from relevance import fulltext_path
+        for path in (snapshot_path(self.root_path), fulltext_path(self.root_path)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _load_tree(self, kind):
+        window = self.window
+        window.settings["root_folder"] = self.root_path
+        started = time.perf_counter()
+        window.populate_file_tree()
+        model = window.tree_model
+        root_loaded = []
+        model.root_loaded.connect(lambda: root_loaded.append(time.perf_counter()))
+        self.wait(lambda: root_loaded, "the root folder")
+        self.record(f"tree_load_{kind}_root", root_loaded[0] - started)
+        self.wait(lambda: model.is_index_complete, "the project index")
+        completed = time.perf_counter()
+        self.record(f"tree_load_{kind}_index", completed - started)
+        # The full-text index is built next; wait so it does not slow the
+        # following phases down
+        self.wait(lambda: window.relevance_thread is None, "the full-text index")
+        if kind == "cold":
+            self.record("relevance_index", time.perf_counter() - completed)
+
+    def _select_and_generate(self):
+        window = self.window
+        model = window.tree_model
+        root_id = model.entry_id(model.root_index())
+        for _ in range(self.repeat):
+            model.clear_selection()
+            self.app.processEvents()
+            self.timed("select_subtree", lambda: model.set_checked(root_id, True))
+            self.app.processEvents()
+            paths = self.timed("get_selected_files", window.get_selected_files)
+            selected_ids = window.get_selected_file_ids()
+
+            def render_structure():
+                # Drop the memoized text, as any change to the tree does
+                window._on_tree_state_changed()
+                return window._get_tree_structure(self.root_path, selected_ids)
+            self.timed("tree_structure", render_structure)
+        self.file_count = len(paths)
+
+        for kind in ("cold", "warm"):
+            for _ in range(self.repeat):
+                if kind == "cold":
+                    window.content_cache.clear()
+
+                def generate():
+                    window.generate_prompt()
+                    self.wait(lambda: window.prompt_thread is None
+                              and not window.prompt_view.is_loading(), "the prompt")
+                self.timed(f"generate_prompt_{kind}", generate)
+
+
+def compare(results, baseline, tolerance):
+    """Lines of a comparison table and the names of the phases that got
+    slower than the baseline by more than tolerance"""
+    lines = [f"{'phase':<24}{'median':>12}{'baseline':>12}{'change':>10}"]
+    regressions = []
+    for name, result in results.items():
+        median = result["median"]
+        base = baseline.get(name, {}).get("median")
+        if base is None:
+            lines.append(f"{name:<24}{median:>11.3f}s{'-':>12}{'':>10}")
+            continue
+        change = (median - base) / base if base else 0.0
+        flag = ""
+        if change > tolerance and median - base > NOISE_SECONDS:
+            regressions.append(name)
+            flag = "  slower"
+        lines.append(f"{name:<24}{median:>11.3f}s{base:>11.3f}s{change:>+9.0%}{flag}")
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time the hot paths of the application on a synthetic project.")
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--fanout", type=int, default=6)
+    parser.add_argument("--file-size", type=int, default=4096,
+                        help="average file size in bytes")
+    parser.add_argument("--binary-ratio", type=float, default=0.05,
+                        help="share of binary files")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workdir", default=DEFAULT_WORKDIR,
+                        help="folder for the synthetic projects and scratch settings")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against an earlier results file")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown against the baseline (default: 0.25)")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also record peak Python allocations per phase")
+    args = parser.parse_args(argv)
+
+    params = {"files": args.files, "depth": args.depth, "fanout": args.fanout,
+              "file_size": args.file_size, "binary_ratio": args.binary_ratio,
+              "seed": args.seed}
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    root_path, generate_seconds = ensure_project(workdir, params)
+    if generate_seconds:
+        print(f"Generated {args.files} files in {generate_seconds:.1f}s: {root_path}")
+
+    # The window reads and writes settings.json in the working folder
+    scratch = os.path.join(workdir, "scratch")
+    os.makedirs(scratch, exist_ok=True)
+    os.chdir(scratch)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from utils import default_settings
+    settings = default_settings()
+    settings.update({
+        "prompt_template": os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        "templates", "default_template.txt"),
+        "root_folder": "",
+        "git_integration": False,
+        "token_budget": 0,
+        "part_size": 0,
+        "structure_mode": "full",
+    })
+    with open("settings.json", 'w') as f:
+        json.dump(settings, f, indent=4)
+
+    os.environ["QT_QPA_PLATFORM"] = "offscreen"
+    from PyQt6.QtWidgets import QApplication
+    app = QApplication(sys.argv[:1])
+    benchmark = Benchmark(app, root_path, args.repeat, args.trace_memory)
+    results = benchmark.run()
+
+    from PyQt6.QtCore import QT_VERSION_STR
+    report = {
+        "version": VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": dict(params, repeat=args.repeat, selected_files=benchmark.file_count),
+        "environment": {"python": platform.python_version(), "qt": QT_VERSION_STR,
+                        "platform": platform.platform(), "cpus": os.cpu_count()},
+        "results": results,
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    baseline = {}
+    if baseline_path:
+        with open(baseline_path, 'r') as f:
+            baseline_report = json.load(f)
+        if baseline_report.get("params") != report["params"]:
+            print("Warning: The baseline was run with different parameters")
+        baseline = baseline_report.get("results", {})
+    lines, regressions = compare(results, baseline, args.tolerance)
+    print("\n".join(lines))
+    if regressions:
+        print(f"Slower than the baseline: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+
+class ContentCache:
+    """LRU cache of decoded file contents, validated by size and mtime.
+
+    Entries are keyed by (path, size, mtime_ns), so an edited file is read
+    again while unchanged files cost a single stat. The total size of the
+    cached strings is kept under max_bytes by evicting the least recently
+    used files.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, prewarm_workers=4):
+        self.max_bytes = max_bytes
+        self.prewarm_workers = prewarm_workers
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._prewarm_generation = 0
+        self._executor = None
+
+    def get(self, path, loader):
+        """Cached contents of path, calling loader(path) on a miss.
+
+        Errors raised by the loader are passed on and nothing is cached.
+        """
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime_ns)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == key:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        content = loader(path)
+        self._store(path, key, content)
+        return content
+
+    def _store(self, path, key, content):
+        size = sys.getsizeof(content)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._total_bytes -= old[2]
+            self._entries[path] = (key, content, size)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def prewarm(self, paths, loader):
+        """Load paths in the background, replacing any earlier prewarm request.
+
+        Stops once the files would no longer fit in the cache, since
+        reading more would only evict the first ones again.
+        """
+        with self._lock:
+            self._prewarm_generation += 1
+            generation = self._prewarm_generation
+            if self._executor is None:
+                # Imported on first use, since the window creates its cache
+                # before it is first shown
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(self.prewarm_workers)
+        budget = [self.max_bytes]
+
+        def warm(path):
+            if generation != self._prewarm_generation:
+                return
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return
+            with self._lock:
+                budget[0] -= size
+                if budget[0] < 0:
+                    return
+            try:
+                self.get(path, loader)
+            except (OSError, UnicodeDecodeError):
+                pass
+
+        for path in paths:
+            self._executor.submit(warm, path)
+
+    def shutdown(self):
+        with self._lock:
+            self._prewarm_generation += 1
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            # Queued prewarm tasks see the new generation and return at once
+            executor.shutdown(wait=False)
@@ -0,0 +1,152 @@
+import os
+import mmap
+import codecs
+
+from utils import format_size
+
+
+# Bytes looked at to tell text from binary and pick the encoding
+SNIFF_BYTES = 8192
+
+# Characters decoded per read, so large files never need one huge read
+CHUNK_CHARS = 1024 * 1024
+
+DEFAULT_MAX_FILE_BYTES = 1024 * 1024
+DEFAULT_MAX_TOTAL_BYTES = 16 * 1024 * 1024
+
+# Longer BOMs first, since the UTF-32 LE BOM starts with the UTF-16 LE one
+_BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+# Bytes that occur in text files; a block that is mostly something else is binary
+_TEXT_BYTES = bytes({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x100)) - {0x7f})
+
+
+def _first_block(path):
+    with open(path, 'rb') as f:
+        try:
+            # Mapping avoids copying more than the first block into memory
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[:SNIFF_BYTES]
+        except (ValueError, OSError):
+            # Empty files and special files cannot be mapped
+            return f.read(SNIFF_BYTES)
+
+
+def sniff(path):
+    """(is_binary, encoding) of a file, judged from its first block.
+
+    A byte order mark decides the encoding; otherwise a block with NUL
+    bytes or mostly control bytes is binary, and text that is not valid
+    UTF-8 is read as Latin-1.
+    """
+    block = _first_block(path)
+    for bom, encoding in _BOMS:
+        if block.startswith(bom):
+            return False, encoding
+    if b"\0" in block or len(block.translate(None, _TEXT_BYTES)) > len(block) * 0.3:
+        return True, None
+    try:
+        block.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # A character cut off at the end of the block is still UTF-8
+        if e.start < len(block) - 3:
+            return False, "latin-1"
+    return False, "utf-8"
+
+
+def binary_marker(size):
+    return f"[Binary file omitted: {format_size(size)}]"
+
+
+def total_cap_marker(max_total_bytes):
+    return (f"[Omitted: the selected files exceed the total size limit "
+            f"of {format_size(max_total_bytes)}]")
+
+
+class SizeCap:
+    """Shares max_total_bytes among files in selection order, each of them
+    also capped at max_file_bytes; either may be None for no limit"""
+
+    def __init__(self, max_file_bytes=None, max_total_bytes=None):
+        self.max_file_bytes = max_file_bytes
+        self.max_total_bytes = max_total_bytes
+        self.used = 0
+
+    def limit(self, path):
+        """max_bytes to read the next file with, counting its size against
+        the total; 0 or less once the total is used up"""
+        max_bytes = self.max_file_bytes
+        if self.max_total_bytes is None:
+            return max_bytes
+        remaining = self.max_total_bytes - self.used
+        max_bytes = remaining if max_bytes is None else min(max_bytes, remaining)
+        try:
+            size = os.path.getsize(path)
+            # A large binary file only costs its marker
+            if size > max_bytes > 0 and sniff(path)[0]:
+                size = 0
+        except OSError:
+            size = 0
+        self.used += max(0, min(size, max_bytes))
+        return max_bytes
+
+
+def load_text(path):
+    """Whole contents of a text file in chunks, or a marker for a binary file"""
+    is_binary, encoding = sniff(path)
+    if is_binary:
+        return binary_marker(os.path.getsize(path))
+    parts = []
+    with open(path, 'r', encoding=encoding) as f:
+        while True:
+            chunk = f.read(CHUNK_CHARS)
+            if not chunk:
+                break
+            parts.append(chunk)
+    return "".join(parts)
+
+
+def load_head_and_tail(path, max_bytes):
+    """About max_bytes of a large file: two thirds from its start and one
+    third from its end, cut at line breaks, with a marker in between"""
+    size = os.path.getsize(path)
+    is_binary, encoding = sniff(path)
+    if is_binary:
+        return binary_marker(size)
+    head_bytes = max_bytes * 2 // 3
+    # Seeking into UTF-16/32 could land inside a character, so keep only the head
+    tail_bytes = 0 if encoding in ("utf-16", "utf-32") else max_bytes - head_bytes
+    with open(path, 'rb') as f:
+        head = f.read(head_bytes).decode(encoding, "ignore")
+        tail = ""
+        if tail_bytes:
+            f.seek(size - tail_bytes)
+            tail = f.read(tail_bytes).decode(encoding, "ignore")
+    head = head[:head.rfind("\n") + 1] or head
+    if tail:
+        tail = tail[tail.find("\n") + 1:]
+    kept = len(head.encode(encoding, "ignore")) + len(tail.encode(encoding, "ignore"))
+    marker = (f"[... {format_size(size - kept)} omitted, the file is "
+              f"{format_size(size)} ...]\n")
+    if head and not head.endswith("\n"):
+        marker = "\n" + marker
+    return head.replace("\r\n", "\n") + marker + tail.replace("\r\n", "\n")
+
+
+def read_file(path, max_bytes=None, cache=None):
+    """Contents of a project file for the prompt, at most about max_bytes.
+
+    Files within the limit go through the cache; larger ones are read in
+    part every time, since the cache only holds whole files.
+    """
+    if max_bytes is not None and os.path.getsize(path) > max_bytes:
+        return load_head_and_tail(path, max_bytes)
+    if cache is not None:
+        return cache.get(path, load_text)
+    return load_text(path)
@@ -0,0 +1,198 @@
+import bisect
+import threading
+from array import array
+from collections import Counter
+
+
+# Broad queries stop looking at candidates after this many distinct names
+MAX_CANDIDATES = 3000
+
+# Batches smaller than this are merged into the sorted names one by one
+_INSORT_LIMIT = 1000
+
+# Entries indexed per lock hold, so searches never wait long for an update
+_CHUNK = 5000
+
+# Projects with at most this many distinct names are scanned in full
+# for abbreviations that share no trigram with the name, like "flsrch"
+MAX_SCANNED_NAMES = 20000
+
+# A search indexes new entries itself only if there are at most this many
+SEARCH_UPDATE_LIMIT = 50000
+
+
+def _is_subsequence(term, text):
+    position = 0
+    for char in term:
+        position = text.find(char, position) + 1
+        if not position:
+            return False
+    return True
+
+
+class FileSearchIndex:
+    """Trigram index of the entry names in a ProjectIndex, for fuzzy search.
+
+    Entries are only ever appended to a project index, so update() just
+    indexes the ids added since the last call; removed entries are skipped
+    when matching. Equal names share one slot, and posting lists hold name
+    slots rather than entry ids, which keeps them short in large projects.
+    A sorted copy of the names answers prefix queries with a bisection.
+    """
+
+    def __init__(self, project_index):
+        self.project_index = project_index
+        self._indexed = 0
+        self._slots = {}
+        self._names = []
+        self._sorted_names = []
+        self._entries = []
+        self._postings = {}
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+
+    def __len__(self):
+        return self._indexed
+
+    def update(self):
+        """Index the entries added to the project index since the last update.
+
+        Returns right away if another thread is already updating.
+        """
+        if not self._update_lock.acquire(blocking=False):
+            return
+        try:
+            end = self.project_index.settled_length()
+            first_new_slot = len(self._names)
+            for start in range(self._indexed, end, _CHUNK):
+                with self._lock:
+                    for entry_id in range(start, min(start + _CHUNK, end)):
+                        self._add(entry_id)
+                    self._indexed = min(start + _CHUNK, end)
+
+            with self._lock:
+                new_names = self._names[first_new_slot:]
+                if len(new_names) < _INSORT_LIMIT:
+                    for name in new_names:
+                        bisect.insort(self._sorted_names, name)
+                else:
+                    self._sorted_names.extend(new_names)
+                    self._sorted_names.sort()
+        finally:
+            self._update_lock.release()
+
+    def _add(self, entry_id):
+        name = self.project_index.name(entry_id).lower()
+        slot = self._slots.get(name)
+        if slot is not None:
+            self._entries[slot].append(entry_id)
+            return
+        slot = len(self._names)
+        self._slots[name] = slot
+        self._names.append(name)
+        self._entries.append(array('I', (entry_id,)))
+        postings = self._postings
+        for gram in {name[i:i + 3] for i in range(len(name) - 2)}:
+            posting = postings.get(gram)
+            if posting is None:
+                postings[gram] = array('I', (slot,))
+            else:
+                posting.append(slot)
+
+    def search(self, query, limit=50):
+        """Ids of the best matches for a query, best first.
+
+        The last word of the query is matched against entry names: whole
+        name, then prefix, then substring, then the letters in order, then
+        names sharing most of its trigrams. Earlier words, split on spaces
+        or slashes, must appear in the path. Files rank before folders, and
+        shorter names before longer ones.
+        """
+        words = query.lower().replace("\\", "/").replace("/", " ").split()
+        if not words:
+            return []
+        if self.project_index.settled_length() - self._indexed <= SEARCH_UPDATE_LIMIT:
+            self.update()
+        term, path_terms = words[-1], words[:-1]
+        project_index = self.project_index
+        ranked = []
+        seen = set()
+
+        def collect(slots):
+            for slot in slots:
+                if slot in seen:
+                    continue
+                seen.add(slot)
+                name = self._names[slot]
+                if name == term:
+                    kind = 0
+                elif name.startswith(term):
+                    kind = 1
+                elif term in name:
+                    kind = 2
+                elif _is_subsequence(term, name):
+                    kind = 3
+                else:
+                    kind = 4
+                for entry_id in self._entries[slot]:
+                    ranked.append((kind, project_index.is_dir(entry_id),
+                                   len(name), entry_id))
+
+        with self._lock:
+            collect(self._prefix_candidates(term))
+            if len(term) >= 3 and len(ranked) < limit:
+                postings = sorted(
+                    (self._postings.get(term[i:i + 3], ()) for i in range(len(term) - 2)),
+                    key=len)
+                collect(self._substring_candidates(term, postings))
+                if len(ranked) < limit:
+                    collect(self._loose_candidates(term, postings))
+            if len(ranked) < limit and len(self._names) <= MAX_SCANNED_NAMES:
+                collect(slot for slot, name in enumerate(self._names)
+                        if slot not in seen and _is_subsequence(term, name))
+
+        ranked.sort()
+        results = []
+        folder_paths = {}
+        for item in ranked:
+            entry_id = item[3]
+            if project_index.is_removed(entry_id):
+                continue
+            if path_terms:
+                # Siblings share the folder path, so it is worked out once per folder
+                parent = project_index.parent(entry_id)
+                folder = folder_paths.get(parent)
+                if folder is None:
+                    folder = folder_paths[parent] = project_index.rel_path(parent, "/").lower()
+                rel_path = folder + "/" + project_index.name(entry_id).lower()
+                if not all(word in rel_path for word in path_terms):
+                    continue
+            results.append(entry_id)
+            if len(results) >= limit:
+                break
+        return results
+
+    def _prefix_candidates(self, term):
+        names = self._sorted_names
+        start = bisect.bisect_left(names, term)
+        for position in range(start, min(start + MAX_CANDIDATES, len(names))):
+            if not names[position].startswith(term):
+                return
+            yield self._slots[names[position]]
+
+    def _substring_candidates(self, term, postings):
+        """Slots whose names contain the term, checking the rarest posting list"""
+        if not postings[0]:
+            return []
+        return [slot for slot in postings[0][:MAX_CANDIDATES]
+                if term in self._names[slot]]
+
+    def _loose_candidates(self, term, postings):
+        """Slots with the letters in order or most of the term's trigrams"""
+        counts = Counter()
+        for posting in postings:
+            if len(posting) <= MAX_CANDIDATES:
+                counts.update(posting)
+        needed = max(1, (len(postings) + 1) // 2)
+        return [slot for slot, count in counts.most_common(MAX_CANDIDATES)
+                if count >= needed]
@@ -0,0 +1,655 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtCore import (
+    QAbstractItemModel, QModelIndex, QPersistentModelIndex, Qt, QThread, pyqtSignal
+)
+from PyQt6.QtGui import QBrush, QColor
+
+from indexer import ProjectIndex, ExclusionRules
+from index_snapshot import load_snapshot, save_snapshot
+from fs_watcher import ProjectWatcher
+from scan_agent import connect_agent
+from file_search import FileSearchIndex
+from utils import format_size
+from selection import FileSelection, CHECKED, PARTIAL
+
+
+class DirectoryScanThread(QThread):
+    """Lists the folders the user expands, ahead of the background indexing.
+
+    Also re-reads folders that the watcher reported as changed.
+    """
+    listed = pyqtSignal(int)
+    relisted = pyqtSignal(list)
+
+    def __init__(self, project_index):
+        super().__init__()
+        self.project_index = project_index
+        self._requests = queue.Queue()
+
+    def request(self, entry_id, refresh=False):
+        self._requests.put((entry_id, refresh))
+
+    def stop(self):
+        self._requests.put(None)
+        self.wait()
+
+    def run(self):
+        while True:
+            job = self._requests.get()
+            if job is None:
+                return
+            entry_id, refresh = job
+            if not refresh:
+                self.project_index.list_directory(entry_id)
+                self.listed.emit(entry_id)
+                continue
+            listing = self.project_index.scan(entry_id)
+            if listing is not None:
+                self.relisted.emit([(entry_id, self.project_index.rel_path(entry_id),
+                                     listing)])
+
+
+class SubtreeExpandThread(QThread):
+    """Lists the whole subtree of folders checked before the background
+    indexing reached them, so checking them does not block the window.
+
+    Also indexes the folders that appear after the background indexing
+    finished, saving the snapshot again once it has nothing else to do,
+    and re-reads the sizes of checked files, which may have been edited
+    since they were listed.
+    """
+    expanded = pyqtSignal(str)
+    indexed = pyqtSignal(list)
+    resized = pyqtSignal(dict)
+
+    def __init__(self, project_index, search_index):
+        super().__init__()
+        self.project_index = project_index
+        self.search_index = search_index
+        # Set once the index build thread is done and has saved the snapshot
+        self.index_complete = threading.Event()
+        self._requests = queue.Queue()
+        self._unsaved = False
+
+    def request(self, entry_id):
+        # Ids change when a folder above is re-listed, paths do not
+        self._requests.put(("check", self.project_index.rel_path(entry_id)))
+
+    def request_index(self, rel_paths):
+        self._requests.put(("index", rel_paths))
+
+    def request_sizes(self, file_ids):
+        self._requests.put(("sizes", file_ids))
+
+    def stop(self):
+        self._requests.put(None)
+        self.wait()
+
+    def run(self):
+        while True:
+            job = self._requests.get()
+            if job is None:
+                return
+            kind, value = job
+            if kind == "sizes":
+                sizes = self.project_index.changed_sizes(value)
+                if sizes:
+                    self.resized.emit(sizes)
+            elif kind == "check":
+                self._expand(value)
+                self.expanded.emit(value)
+            else:
+                for rel_path in value:
+                    self._expand(rel_path)
+                self.search_index.update()
+                self._unsaved = True
+                self.indexed.emit(value)
+            if self._unsaved and self.index_complete.is_set() and self._requests.empty():
+                self._unsaved = False
+                try:
+                    save_snapshot(self.project_index)
+                except OSError as e:
+                    print(f"Warning: Could not save project index: {str(e)}")
+
+    def _expand(self, rel_path):
+        entry_id = self.project_index.find(rel_path)
+        if entry_id >= 0:
+            self.project_index.expand(entry_id)
+
+
+class IndexBuildThread(QThread):
+    """Indexes the rest of the project with a pool of scandir workers.
+
+    When the index came from a snapshot, the folders whose mtime changed
+    are re-listed first and handed to the GUI thread to swap in. Once the
+    index is complete, the search index is brought up to date and the
+    index is saved as a snapshot.
+    """
+    progress = pyqtSignal(int)
+    relisted = pyqtSignal(list)
+    completed = pyqtSignal()
+
+    RELIST_BATCH = 64
+
+    def __init__(self, project_index, search_index, revalidate=False):
+        super().__init__()
+        self.project_index = project_index
+        self.search_index = search_index
+        self.revalidate = revalidate
+        self._cancel = threading.Event()
+
+    def stop(self):
+        self._cancel.set()
+        self.wait()
+
+    def run(self):
+        if self.revalidate:
+            self._revalidate()
+        if self._cancel.is_set():
+            return
+        if not self.project_index.expand(cancel=self._cancel,
+                                         progress=self.progress.emit):
+            return
+        self.search_index.update()
+        self.completed.emit()
+        try:
+            save_snapshot(self.project_index)
+        except OSError as e:
+            print(f"Warning: Could not save project index: {str(e)}")
+
+    def _revalidate(self):
+        stale = self.project_index.stale_directories(cancel=self._cancel)
+        if not stale:
+            return
+        batch = []
+        with ThreadPoolExecutor() as pool:
+            for entry_id, listing in zip(stale, pool.map(self.project_index.scan, stale)):
+                if self._cancel.is_set():
+                    return
+                if listing is None:
+                    continue
+                batch.append((entry_id, self.project_index.rel_path(entry_id), listing))
+                if len(batch) >= self.RELIST_BATCH:
+                    self.relisted.emit(batch)
+                    batch = []
+        if batch:
+            self.relisted.emit(batch)
+
+
+class FileTreeModel(QAbstractItemModel):
+    """Tree model over a ProjectIndex that shows a folder once it is expanded.
+
+    The internal id of every model index is the entry id in the project
+    index, so the model keeps no per-item objects of its own. Items are
+    checkable; the check states come from a FileSelection over the index.
+    The second column shows file sizes.
+    """
+    root_loaded = pyqtSignal()
+    directory_loaded = pyqtSignal(QModelIndex)
+    listing_changed = pyqtSignal(QModelIndex)
+    index_complete = pyqtSignal()
+    selection_changed = pyqtSignal()
+
+    NAME_COLUMN = 0
+    SIZE_COLUMN = 1
+
+    CHECK_STATES = {
+        CHECKED: Qt.CheckState.Checked,
+        PARTIAL: Qt.CheckState.PartiallyChecked,
+    }
+
+    # Colours and tooltips of the git marks
+    GIT_MARKS = {
+        "changed": (QBrush(QColor(196, 96, 0)), "Uncommitted changes"),
+        "recent": (QBrush(QColor(32, 110, 190)), "Changed in recent commits"),
+    }
+
+    def __init__(self, root_path, settings, parent=None):
+        super().__init__(parent)
+        self.root_path = root_path
+        # "/" separated rel_path -> key of GIT_MARKS; paths survive renames of
+        # other entries, unlike entry ids
+        self.git_marks = {}
+        rules = ExclusionRules.from_settings(settings)
+        # Paint from the last session's index, then check it against the disk
+        self.project_index = load_snapshot(root_path, rules)
+        self.from_snapshot = self.project_index is not None
+        if not self.from_snapshot:
+            self.project_index = ProjectIndex(root_path, rules)
+        self.project_index.agent = connect_agent(settings, root_path, rules)
+        self.selection = FileSelection(self.project_index)
+        self.search_index = FileSearchIndex(self.project_index)
+        self.is_index_complete = False
+        # rel_path -> check state of folders waiting for their subtree
+        self.pending_checks = {}
+        # Folders whose children have been inserted as rows
+        self._exposed = set()
+        # Folders open in the view, for the "expanded" structure mode
+        self._expanded = set()
+        self._pending = set()
+
+        self._watcher = ProjectWatcher(
+            root_path, settings.get("watch_mode", "auto"),
+            settings.get("max_watched_folders", 2000), parent=self)
+        self._watcher.folders_changed.connect(self._on_folders_changed)
+
+        self._scanner = DirectoryScanThread(self.project_index)
+        self._scanner.listed.connect(self._on_listed)
+        self._scanner.relisted.connect(self._on_relisted)
+        self._builder = IndexBuildThread(self.project_index, self.search_index,
+                                         self.from_snapshot)
+        self._builder.relisted.connect(self._on_relisted)
+        self._builder.completed.connect(self._on_index_complete)
+        self._expander = SubtreeExpandThread(self.project_index, self.search_index)
+        self._expander.expanded.connect(self._on_subtree_expanded)
+        self._expander.indexed.connect(self._on_subtree_indexed)
+        self._expander.resized.connect(self._on_sizes_changed)
+        self._expander.start()
+        self._scanner.start()
+        self._request_listing(ProjectIndex.ROOT)
+
+    def shutdown(self):
+        self._watcher.shutdown()
+        self._scanner.listed.disconnect(self._on_listed)
+        self._scanner.relisted.disconnect(self._on_relisted)
+        self._builder.relisted.disconnect(self._on_relisted)
+        self._builder.completed.disconnect(self._on_index_complete)
+        self._expander.expanded.disconnect(self._on_subtree_expanded)
+        self._expander.indexed.disconnect(self._on_subtree_indexed)
+        self._expander.resized.disconnect(self._on_sizes_changed)
+        self._builder.stop()
+        self._expander.stop()
+        self._scanner.stop()
+        if self.project_index.agent is not None:
+            self.project_index.agent.close()
+
+    def entry_index(self, entry_id):
+        parent = self.project_index.parent(entry_id)
+        row = 0 if parent < 0 else entry_id - self.project_index.child_starts[parent]
+        return self.createIndex(row, 0, entry_id)
+
+    def root_index(self):
+        return self.entry_index(ProjectIndex.ROOT)
+
+    def entry_id(self, index):
+        return index.internalId()
+
+    def file_path(self, index):
+        return self.project_index.path(index.internalId())
+
+    def is_dir(self, index):
+        return self.project_index.is_dir(index.internalId())
+
+    def is_listed(self, index):
+        return index.internalId() in self._exposed
+
+    def is_expanded(self, entry_id):
+        return entry_id in self._expanded
+
+    def set_expanded(self, index, expanded):
+        """Follow the view's expanded and collapsed signals"""
+        if expanded:
+            self._expanded.add(index.internalId())
+        else:
+            self._expanded.discard(index.internalId())
+
+    def listed_children(self, index):
+        """Indexes of the children that have been inserted so far"""
+        entry_id = index.internalId()
+        if entry_id not in self._exposed:
+            return []
+        return [self.createIndex(row, 0, child) for row, child
+                in enumerate(self.project_index.children(entry_id))]
+
+    def _request_listing(self, entry_id):
+        self._pending.add(entry_id)
+        self._scanner.request(entry_id)
+
+    def _on_listed(self, entry_id):
+        self._pending.discard(entry_id)
+        self._expose(entry_id)
+        if entry_id == ProjectIndex.ROOT:
+            self.root_loaded.emit()
+            self._builder.start(QThread.Priority.LowPriority)
+
+    def _on_index_complete(self):
+        self.is_index_complete = True
+        self._expander.index_complete.set()
+        # Folder totals are known now, so partial states can turn checked
+        self.selection.count_files()
+        self._emit_states_changed(ProjectIndex.ROOT, True)
+        self.index_complete.emit()
+
+    def reveal(self, entry_id):
+        """Insert the rows of every folder above an entry; returns its index"""
+        ancestors = []
+        current = self.project_index.parent(entry_id)
+        while current >= 0:
+            ancestors.append(current)
+            current = self.project_index.parent(current)
+        for folder in reversed(ancestors):
+            if folder not in self._exposed:
+                self.project_index.list_directory(folder)
+                self._pending.discard(folder)
+                self._expose(folder)
+        return self.entry_index(entry_id)
+
+    def set_checked(self, entry_id, checked):
+        """Check or uncheck an entry, with its subtree if it is a folder.
+
+        A folder whose subtree is not indexed yet is checked once a
+        background thread has listed it; until then it shows as partially
+        checked and is in pending_checks.
+        """
+        project_index = self.project_index
+        if project_index.is_dir(entry_id):
+            rel_path = project_index.rel_path(entry_id)
+            if rel_path in self.pending_checks:
+                # The last click wins once the subtree is listed
+                self.pending_checks[rel_path] = checked
+                self._emit_states_changed(entry_id, False, [
+                    Qt.ItemDataRole.CheckStateRole, Qt.ItemDataRole.ToolTipRole])
+                return
+            if checked and self.selection.count_files(entry_id) < 0:
+                self.pending_checks[rel_path] = checked
+                self._expander.request(entry_id)
+                self._emit_states_changed(entry_id, False, [
+                    Qt.ItemDataRole.CheckStateRole, Qt.ItemDataRole.ToolTipRole])
+                self.selection_changed.emit()
+                return
+        self._apply_check(entry_id, checked)
+
+    def _on_subtree_expanded(self, rel_path):
+        checked = self.pending_checks.pop(rel_path, None)
+        entry_id = self.project_index.find(rel_path)
+        if checked is None or entry_id < 0 or not self.project_index.is_dir(entry_id):
+            self.selection_changed.emit()
+            return
+        self._apply_check(entry_id, checked)
+
+    def _on_subtree_indexed(self, rel_paths):
+        for rel_path in rel_paths:
+            entry_id = self.project_index.find(rel_path)
+            if entry_id >= 0 and self.project_index.is_dir(entry_id):
+                self.selection.count_files(entry_id)
+                self.listing_changed.emit(self.entry_index(entry_id))
+
+    def _apply_check(self, entry_id, checked):
+        self.selection.set_checked(entry_id, checked)
+        if checked:
+            self._watch_selected(entry_id)
+            if self.project_index.agent is None:
+                # Sizes come from the listing; an agent lists them afresh
+                self._expander.request_sizes(list(self.project_index.iter_files(entry_id)))
+        self._emit_states_changed(entry_id, self.project_index.is_dir(entry_id))
+        self.selection_changed.emit()
+
+    def _on_sizes_changed(self, sizes):
+        project_index = self.project_index
+        sizes = {file_id: size for file_id, size in sizes.items()
+                 if not project_index.is_removed(file_id)}
+        if not sizes:
+            return
+        self.selection.update_sizes(sizes)
+        for file_id in sizes:
+            if project_index.parent(file_id) in self._exposed:
+                index = self.entry_index(file_id).siblingAtColumn(self.SIZE_COLUMN)
+                self.dataChanged.emit(index, index, [Qt.ItemDataRole.DisplayRole])
+        self.selection_changed.emit()
+
+    def _watch_selected(self, entry_id):
+        """Watch the folders holding selected files, expanded or not, so
+        that files added or deleted there are picked up"""
+        project_index = self.project_index
+        if project_index.is_dir(entry_id):
+            folders = project_index.listed_directories(entry_id)
+        else:
+            folders = [project_index.parent(entry_id)]
+        for folder in folders:
+            self._watcher.watch(project_index.path(folder))
+
+    def refresh_files(self, paths):
+        """Re-list the folders of files that turned out to be gone"""
+        folders = {os.path.dirname(path) for path in paths}
+        self._on_folders_changed(sorted(folders))
+
+    def clear_selection(self):
+        self.selection.clear()
+        self._emit_states_changed(ProjectIndex.ROOT, True)
+        self.selection_changed.emit()
+
+    def set_git_marks(self, marks):
+        """Mark files and the folders above them as changed or recent"""
+        self.git_marks = marks
+        self._emit_states_changed(ProjectIndex.ROOT, True, [
+            Qt.ItemDataRole.ForegroundRole, Qt.ItemDataRole.ToolTipRole])
+
+    def _emit_states_changed(self, entry_id, subtree, role=None):
+        """Repaint an entry's checkbox, its ancestors' and its visible subtree's"""
+        role = role or [Qt.ItemDataRole.CheckStateRole]
+        current = entry_id
+        while current >= 0:
+            index = self.entry_index(current)
+            self.dataChanged.emit(index, index, role)
+            current = self.project_index.parent(current)
+        if not subtree:
+            return
+        # One signal per visible folder, not per row
+        stack = [entry_id]
+        while stack:
+            folder = stack.pop()
+            if folder not in self._exposed:
+                continue
+            children = self.project_index.children(folder)
+            if not children:
+                continue
+            self.dataChanged.emit(self.entry_index(children[0]),
+                                  self.entry_index(children[-1]), role)
+            stack.extend(child for child in children
+                         if self.project_index.is_dir(child))
+
+    def _on_folders_changed(self, paths):
+        for path in paths:
+            entry_id = self.project_index.find(os.path.relpath(path, self.root_path))
+            if entry_id >= 0 and self.project_index.is_listed(entry_id):
+                self._scanner.request(entry_id, refresh=True)
+
+    def _on_relisted(self, listings):
+        for entry_id, rel_path, listing in listings:
+            # Ids change when a parent folder is re-listed, paths do not
+            if (self.project_index.is_removed(entry_id)
+                    or self.project_index.rel_path(entry_id) != rel_path):
+                entry_id = self.project_index.find(rel_path)
+                if entry_id < 0 or not self.project_index.is_listed(entry_id):
+                    continue
+            self._apply_listing(entry_id, listing)
+
+    def _apply_listing(self, entry_id, listing):
+        """Swap in a new listing, keeping selection and expansion of what survives"""
+        old_children = self.project_index.children(entry_id)
+        was_checked = self.selection.state(entry_id) == CHECKED
+        had_selection = len(self.selection) > 0
+        if entry_id not in self._exposed:
+            moved = self.project_index.replace_listing(entry_id, *listing)
+            new_folders = self._carry_over(entry_id, old_children, moved, was_checked)
+        else:
+            parent = QPersistentModelIndex(self.entry_index(entry_id))
+            self.layoutAboutToBeChanged.emit([parent])
+            old_indexes = self.persistentIndexList()
+            moved = self.project_index.replace_listing(entry_id, *listing)
+            new_folders = self._carry_over(entry_id, old_children, moved, was_checked)
+            self.changePersistentIndexList(
+                old_indexes, [self._remap(index, moved) for index in old_indexes])
+            self.layoutChanged.emit([parent])
+            self.listing_changed.emit(self.entry_index(entry_id))
+        if len(self.project_index.children(entry_id)) > len(moved):
+            # New folders are indexed like the rest, and new names searchable
+            self._expander.request_index([self.project_index.rel_path(entry_id)])
+        if was_checked:
+            # Folders added to a checked folder are checked with it, listed
+            # in the background like any folder the user checks
+            self._watch_selected(entry_id)
+            for folder in new_folders:
+                self.set_checked(folder, True)
+        if had_selection or len(self.selection):
+            self._emit_states_changed(entry_id, was_checked)
+            self.selection_changed.emit()
+
+    def _carry_over(self, entry_id, old_children, moved, was_checked):
+        new_folders = self.selection.listing_replaced(
+            entry_id, old_children, moved, was_checked)
+        for old_id, new_id in moved.items():
+            if old_id in self._exposed:
+                self._exposed.discard(old_id)
+                self._exposed.add(new_id)
+                self._watcher.watch(self.project_index.path(new_id))
+            if old_id in self._expanded:
+                self._expanded.discard(old_id)
+                self._expanded.add(new_id)
+        return new_folders
+
+    def _remap(self, index, moved):
+        entry_id = index.internalId()
+        if entry_id in moved:
+            return self.entry_index(moved[entry_id]).siblingAtColumn(index.column())
+        current = entry_id
+        while current >= 0:
+            if self.project_index.is_removed(current):
+                return QModelIndex()
+            current = self.project_index.parent(current)
+        return self.entry_index(entry_id).siblingAtColumn(index.column())
+
+    def _expose(self, entry_id):
+        if entry_id in self._exposed:
+            return
+        count = len(self.project_index.children(entry_id))
+        parent = self.entry_index(entry_id)
+        if count:
+            self.beginInsertRows(parent, 0, count - 1)
+            self._exposed.add(entry_id)
+            self.endInsertRows()
+        else:
+            self._exposed.add(entry_id)
+        self._watcher.watch(self.project_index.path(entry_id))
+        if entry_id != ProjectIndex.ROOT:
+            self.directory_loaded.emit(parent)
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column, ProjectIndex.ROOT)
+        start = self.project_index.child_starts[parent.internalId()]
+        return self.createIndex(row, column, start + row)
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        parent = self.project_index.parent(index.internalId())
+        if parent < 0:
+            return QModelIndex()
+        return self.entry_index(parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        if not parent.isValid():
+            return 1
+        entry_id = parent.internalId()
+        if entry_id not in self._exposed:
+            return 0
+        return self.project_index.child_counts[entry_id]
+
+    def columnCount(self, parent=QModelIndex()):
+        return 2
+
+    def hasChildren(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return True
+        if parent.column() > 0:
+            return False
+        entry_id = parent.internalId()
+        if not self.project_index.is_dir(entry_id):
+            return False
+        return (not self.project_index.is_listed(entry_id)
+                or self.project_index.child_counts[entry_id] > 0)
+
+    def canFetchMore(self, parent):
+        if not parent.isValid():
+            return False
+        entry_id = parent.internalId()
+        return (self.project_index.is_dir(entry_id)
+                and entry_id not in self._exposed
+                and entry_id not in self._pending)
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        entry_id = parent.internalId()
+        if self.project_index.is_listed(entry_id):
+            # Already indexed in the background, no need to touch the disk
+            self._expose(entry_id)
+        else:
+            self._request_listing(entry_id)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        entry_id = index.internalId()
+        if index.column() == self.SIZE_COLUMN:
+            if self.project_index.is_dir(entry_id):
+                return None
+            if role == Qt.ItemDataRole.DisplayRole:
+                return format_size(self.project_index.size(entry_id))
+            if role == Qt.ItemDataRole.TextAlignmentRole:
+                return Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter
+            return None
+        if role == Qt.ItemDataRole.DisplayRole:
+            return self.project_index.name(entry_id)
+        if role == Qt.ItemDataRole.CheckStateRole:
+            if self.pending_checks and self._is_pending(entry_id):
+                return Qt.CheckState.PartiallyChecked
+            return self.CHECK_STATES.get(self.selection.state(entry_id),
+                                         Qt.CheckState.Unchecked)
+        if (role == Qt.ItemDataRole.ToolTipRole and self.pending_checks
+                and self._is_pending(entry_id)):
+            return "Loading the folder's files to check them"
+        if role in (Qt.ItemDataRole.ForegroundRole, Qt.ItemDataRole.ToolTipRole):
+            if not self.git_marks or entry_id == ProjectIndex.ROOT:
+                return None
+            mark = self.git_marks.get(self.project_index.rel_path(entry_id, "/"))
+            if mark is None:
+                return None
+            brush, tooltip = self.GIT_MARKS[mark]
+            return brush if role == Qt.ItemDataRole.ForegroundRole else tooltip
+        return None
+
+    def _is_pending(self, entry_id):
+        return (self.project_index.is_dir(entry_id)
+                and self.pending_checks.get(self.project_index.rel_path(entry_id)))
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.ItemFlag.NoItemFlags
+        flags = Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable
+        if index.column() == self.NAME_COLUMN:
+            flags |= Qt.ItemFlag.ItemIsUserCheckable
+        return flags
+
+    def setData(self, index, value, role=Qt.ItemDataRole.EditRole):
+        if (not index.isValid() or index.column() != self.NAME_COLUMN
+                or role != Qt.ItemDataRole.CheckStateRole):
+            return False
+        checked = Qt.CheckState(value) == Qt.CheckState.Checked
+        self.set_checked(index.internalId(), checked)
+        return True
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if (orientation == Qt.Orientation.Horizontal
+                and role == Qt.ItemDataRole.DisplayRole):
+            return "Project Files" if section == self.NAME_COLUMN else "Size"
+        return None
@@ -0,0 +1,142 @@
+import os
+import threading
+
+from PyQt6.QtCore import QObject, QThread, QTimer, QFileSystemWatcher, pyqtSignal
+
+
+def is_remote_path(path):
+    """True for WSL and other network shares, where inotify events never arrive"""
+    normalized = path.replace("\\", "/")
+    return normalized.startswith("//")
+
+
+class _PollThread(QThread):
+    """Compares folder mtimes on an interval, for mounts without native events"""
+    changed = pyqtSignal(list)
+
+    def __init__(self, interval_ms):
+        super().__init__()
+        self.interval = interval_ms / 1000.0
+        self._mtimes = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def add(self, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return False
+        with self._lock:
+            self._mtimes[path] = mtime
+        return True
+
+    def remove(self, path):
+        with self._lock:
+            self._mtimes.pop(path, None)
+
+    def stop(self):
+        self._stop.set()
+        self.wait()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                watched = list(self._mtimes.items())
+            changed = []
+            for path, mtime in watched:
+                if self._stop.is_set():
+                    return
+                try:
+                    current = os.stat(path).st_mtime_ns
+                except OSError:
+                    current = None
+                if current != mtime:
+                    changed.append(path)
+                    with self._lock:
+                        if current is None:
+                            self._mtimes.pop(path, None)
+                        elif path in self._mtimes:
+                            self._mtimes[path] = current
+            if changed:
+                self.changed.emit(changed)
+
+
+class ProjectWatcher(QObject):
+    """Watches project folders and reports changed ones in coalesced batches.
+
+    Uses QFileSystemWatcher (inotify and friends) where the platform
+    delivers events and falls back to polling folder mtimes on WSL and
+    other network paths. At most max_folders folders are watched.
+    """
+    folders_changed = pyqtSignal(list)
+
+    def __init__(self, root_path, mode="auto", max_folders=2000,
+                 poll_interval_ms=2000, settle_ms=300, parent=None):
+        super().__init__(parent)
+        if mode == "auto":
+            mode = "poll" if is_remote_path(root_path) else "native"
+        self.mode = mode
+        self.max_folders = max_folders
+        self._watched = set()
+        self._changed = set()
+
+        self._native = None
+        self._poller = None
+        if mode == "native":
+            self._native = QFileSystemWatcher(self)
+            self._native.directoryChanged.connect(self._on_changed)
+        elif mode == "poll":
+            self._poller = _PollThread(poll_interval_ms)
+            self._poller.changed.connect(self._on_changed)
+            self._poller.start(QThread.Priority.LowPriority)
+
+        # Editors and builds touch many files at once, so wait for a quiet moment
+        self._settle_timer = QTimer(self)
+        self._settle_timer.setSingleShot(True)
+        self._settle_timer.setInterval(settle_ms)
+        self._settle_timer.timeout.connect(self._flush)
+
+    def shutdown(self):
+        self._settle_timer.stop()
+        if self._poller is not None:
+            self._poller.stop()
+        if self._native is not None and self._watched:
+            self._native.removePaths(list(self._watched))
+        self._watched.clear()
+
+    def watch(self, path):
+        if self.mode not in ("native", "poll"):
+            return False
+        if path in self._watched or len(self._watched) >= self.max_folders:
+            return False
+        if self._native is not None:
+            ok = self._native.addPath(path)
+        else:
+            ok = self._poller.add(path)
+        if ok:
+            self._watched.add(path)
+        return ok
+
+    def unwatch(self, path):
+        if path not in self._watched:
+            return
+        self._watched.discard(path)
+        if self._native is not None:
+            self._native.removePath(path)
+        else:
+            self._poller.remove(path)
+
+    def _on_changed(self, paths):
+        if isinstance(paths, str):
+            paths = [paths]
+        for path in paths:
+            self._changed.add(path)
+            # Deleted or renamed folders are dropped by the watcher itself
+            if self._native is not None and not os.path.isdir(path):
+                self._watched.discard(path)
+        self._settle_timer.start()
+
+    def _flush(self):
+        changed, self._changed = sorted(self._changed), set()
+        if changed:
+            self.folders_changed.emit(changed)
@@ -0,0 +1,257 @@
+import os
+import sys
+import time
+import subprocess
+import threading
+
+
+# Tree object of an empty repository, for diffs that reach past the first commit
+EMPTY_TREE = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+
+# Working tree status is run again after this many seconds even if HEAD
+# and the index did not change, since edits to tracked files change neither
+STATUS_MAX_AGE = 5.0
+
+_MAX_CACHED_DIFFS = 2000
+
+# Keeps git from opening a console window from the packaged GUI on Windows
+_CREATION_FLAGS = subprocess.CREATE_NO_WINDOW if sys.platform == "win32" else 0
+
+
+class GitError(Exception):
+    pass
+
+
+def run_git(cwd, *args, timeout=60):
+    """Output of a git command; raises GitError if it cannot be run or fails"""
+    try:
+        result = subprocess.run(
+            ["git", "-c", "core.quotepath=off", *args], cwd=cwd,
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            timeout=timeout, creationflags=_CREATION_FLAGS)
+    except (OSError, subprocess.SubprocessError) as e:
+        raise GitError(str(e))
+    if result.returncode != 0:
+        raise GitError(result.stderr.decode("utf-8", "replace").strip())
+    return result.stdout.decode("utf-8", "surrogateescape")
+
+
+class GitRepository:
+    """Read-only view of the local git repository that holds a root folder.
+
+    Only the local .git is used, never the network. Paths are relative to
+    the root folder with "/" separators, and files of the repository
+    outside the root folder are left out. Status is cached against HEAD
+    and the index mtime, and the files of recent commits against HEAD, so
+    generating again does not walk the history again.
+    """
+
+    def __init__(self, root_path, top_level, git_dir, common_dir):
+        self.root_path = root_path
+        self.top_level = top_level
+        self.git_dir = git_dir
+        self.common_dir = common_dir
+        prefix = os.path.relpath(os.path.realpath(root_path),
+                                 os.path.realpath(top_level)).replace(os.sep, "/")
+        self.prefix = "" if prefix == "." else prefix + "/"
+        self._lock = threading.Lock()
+        self._status = (None, 0.0, {})
+        # (HEAD, commits walked, [set of paths per commit, newest first])
+        self._history = (None, 0, [])
+        self._diffs = {}
+
+    @classmethod
+    def open(cls, root_path):
+        """The repository that holds root_path, or None if there is none or
+        git is not installed"""
+        try:
+            output = run_git(root_path, "rev-parse", "--show-toplevel",
+                             "--absolute-git-dir", "--git-common-dir")
+        except GitError:
+            return None
+        top_level, git_dir, common_dir = output.splitlines()[:3]
+        return cls(os.path.abspath(root_path), os.path.normpath(top_level),
+                   git_dir, os.path.normpath(os.path.join(root_path, common_dir)))
+
+    def head(self):
+        """Commit id of HEAD read from the .git folder, None before the first commit"""
+        try:
+            with open(os.path.join(self.git_dir, "HEAD"), 'r') as f:
+                head = f.read().strip()
+        except OSError:
+            return None
+        if not head.startswith("ref: "):
+            return head
+        ref = head[5:]
+        for folder in (self.git_dir, self.common_dir):
+            try:
+                with open(os.path.join(folder, ref), 'r') as f:
+                    return f.read().strip()
+            except OSError:
+                pass
+        try:
+            with open(os.path.join(self.common_dir, "packed-refs"), 'r') as f:
+                for line in f:
+                    if line.rstrip("\n").endswith(" " + ref):
+                        return line.split(" ", 1)[0]
+        except OSError:
+            pass
+        return None
+
+    def state_key(self):
+        try:
+            index_mtime = os.stat(os.path.join(self.git_dir, "index")).st_mtime_ns
+        except OSError:
+            index_mtime = 0
+        return self.head(), index_mtime
+
+    def _rel_path(self, repo_path):
+        """Root-relative path of a repository path, or None if outside the root"""
+        if not repo_path.startswith(self.prefix):
+            return None
+        return repo_path[len(self.prefix):]
+
+    def status(self):
+        """{rel_path: code} of the files with uncommitted changes, where code
+        is the two-letter porcelain status, such as " M" or "??" """
+        key = self.state_key()
+        with self._lock:
+            cached_key, checked_at, files = self._status
+            if cached_key == key and time.monotonic() - checked_at < STATUS_MAX_AGE:
+                return files
+        try:
+            output = run_git(self.top_level, "status", "--porcelain=v1", "-z",
+                             "--untracked-files=all", "--no-renames")
+        except GitError as e:
+            print(f"Warning: Could not read git status: {str(e)}")
+            return {}
+        files = {}
+        for entry in output.split("\0"):
+            if len(entry) < 4:
+                continue
+            rel_path = self._rel_path(entry[3:])
+            if rel_path is not None:
+                files[rel_path] = entry[:2]
+        with self._lock:
+            # git status may refresh the index, so key on the state after it
+            self._status = (self.state_key(), time.monotonic(), files)
+        return files
+
+    def recent_files(self, commits):
+        """{rel_path: n} of the files changed in the last commits, where n is
+        how many commits back the latest change was (1 for HEAD)"""
+        head = self.head()
+        if head is None or commits <= 0:
+            return {}
+        with self._lock:
+            cached_head, walked, changes = self._history
+        if cached_head != head or walked < commits:
+            try:
+                output = run_git(self.top_level, "log", f"-n{commits}", "--name-only",
+                                 "--no-renames", "--format=%x01", "-z")
+            except GitError as e:
+                print(f"Warning: Could not read git history: {str(e)}")
+                return {}
+            changes = []
+            for commit in output.split("\x01")[1:]:
+                changes.append({path.strip("\n") for path in commit.split("\0")
+                                if path.strip("\n")})
+            walked = commits
+            with self._lock:
+                self._history = (head, walked, changes)
+
+        files = {}
+        for number, paths in enumerate(changes[:commits], 1):
+            for repo_path in paths:
+                rel_path = self._rel_path(repo_path)
+                if rel_path is not None and rel_path not in files:
+                    files[rel_path] = number
+        return files
+
+    def changed_files(self, commits):
+        """rel_paths of the files with uncommitted changes, then of those
+        changed in the last commits, newest first; deleted files are left out"""
+        files = [rel_path for rel_path, code in self.status().items() if "D" not in code]
+        seen = set(files)
+        recent = self.recent_files(commits)
+        files.extend(rel_path for rel_path in sorted(recent, key=recent.get)
+                     if rel_path not in seen)
+        return files
+
+    def marks(self, commits):
+        """{rel_path: "changed" or "recent"} of the changed files and the
+        folders above them, for marking them in the tree"""
+        marks = {}
+        for mark, rel_paths in (("recent", self.recent_files(commits)),
+                                ("changed", self.status())):
+            for rel_path in rel_paths:
+                while rel_path and marks.get(rel_path) != mark:
+                    marks[rel_path] = mark
+                    rel_path = rel_path.rpartition("/")[0]
+        return marks
+
+    def diff_base(self, commits):
+        """Revision that the last commits are compared to: HEAD for none,
+        the empty tree if the history is shorter"""
+        if commits <= 0:
+            return "HEAD"
+        try:
+            return run_git(self.top_level, "rev-parse", "--verify", "-q",
+                           f"HEAD~{commits}").strip()
+        except GitError:
+            return EMPTY_TREE
+
+    def diff(self, rel_path, base="HEAD"):
+        """Unified diff of a file between base and the working tree, "" if
+        it did not change; cached per file version"""
+        path = os.path.join(self.root_path, rel_path)
+        try:
+            st = os.stat(path)
+            key = (rel_path, base, self.head(), st.st_size, st.st_mtime_ns)
+        except OSError:
+            key = None
+        with self._lock:
+            if key is not None and key in self._diffs:
+                return self._diffs[key]
+        diff = run_git(self.top_level, "diff", "--no-color", "--no-ext-diff", base,
+                       "--", ":(literal)" + self.prefix + rel_path)
+        if key is not None:
+            with self._lock:
+                if len(self._diffs) >= _MAX_CACHED_DIFFS:
+                    self._diffs.clear()
+                self._diffs[key] = diff
+        return diff
+
+
+class DiffSource:
+    """Diffs that stand in for whole files in a prompt"""
+
+    def __init__(self, repository, commits=0):
+        self.repository = repository
+        self.commits = commits
+        self._base = None
+
+    @property
+    def base(self):
+        # Looked up on first use, so the GUI can create the source without
+        # waiting for git; diffs are read on the prompt thread
+        if self._base is None:
+            self._base = self.repository.diff_base(self.commits)
+        return self._base
+
+    def diff(self, path):
+        """A marker and the changes of a file, or None to include it whole,
+        such as when it did not change, is new or is not tracked"""
+        rel_path = os.path.relpath(path, self.repository.root_path).replace(os.sep, "/")
+        try:
+            diff = self.repository.diff(rel_path, self.base)
+        except GitError as e:
+            print(f"Warning: Could not diff {rel_path}: {str(e)}")
+            return None
+        if not diff or "\nnew file mode " in diff.split("\n@@", 1)[0]:
+            # A new file is better shown whole than as a diff of added lines
+            return None
+        changes = ("Uncommitted changes" if self.commits <= 0 else
+                   f"Changes in the last {self.commits} commit(s) and uncommitted changes")
+        return (f"[{changes}; the unchanged parts of the file are left out]\n"
+                f"{diff.rstrip()}")
@@ -0,0 +1,312 @@
+import os
+import re
+import ast
+import json
+import gzip
+import hashlib
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from indexer import ProjectIndex
+from relevance import open_pool, MAX_FILE_BYTES
+from utils import get_cache_dir
+
+
+VERSION = 1
+
+PYTHON_EXTENSIONS = (".py", ".pyw", ".pyi")
+SCRIPT_EXTENSIONS = (".ts", ".tsx", ".js", ".jsx", ".mjs", ".cjs", ".mts", ".cts", ".vue")
+
+# TypeScript sources import each other by the name of the compiled .js file
+_COMPILED_SUFFIXES = {".js": (".ts", ".tsx"), ".jsx": (".tsx",),
+                      ".mjs": (".mts",), ".cjs": (".cts",)}
+
+# Import statements at the start of a line, including ones inside functions
+_PYTHON_IMPORTS = re.compile(
+    rb"^[ \t]*(from[ \t]+[\w.]+[ \t]+import[ \t]*(?:\([^)]*\)|[^\n#;]*)|import[ \t]+[^\n#;]*)",
+    re.MULTILINE)
+
+# Relative specifiers of import/export ... from, bare imports, import() and require()
+_SCRIPT_IMPORTS = re.compile(
+    r"""(?:\bfrom|\bimport|\brequire)\s*\(?\s*(['"])(\.\.?(?:/[^'"\n]*)?)\1""")
+
+_BATCH = 256
+
+
+def is_source_file(name):
+    return name.endswith(PYTHON_EXTENSIONS) or name.endswith(SCRIPT_EXTENSIONS)
+
+
+def _python_imports(data):
+    imports = []
+    # Parsing only the import statements is an order of magnitude faster
+    # than parsing the whole file
+    for match in _PYTHON_IMPORTS.finditer(data):
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                tree = ast.parse(match.group(1).rstrip(b"\\ \t\r"))
+        except (SyntaxError, ValueError):
+            continue
+        for node in tree.body:
+            if isinstance(node, ast.Import):
+                imports.extend([0, alias.name, []] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                imports.append([node.level, node.module or "",
+                                [alias.name for alias in node.names if alias.name != "*"]])
+    return imports
+
+
+def parse_imports(path):
+    """(size, mtime_ns, imports) of a source file, or None if it cannot be read.
+
+    Python imports are [level, module, [names]], including imports inside
+    functions. JavaScript and TypeScript imports are their relative
+    specifiers, such as "../utils"; packages are left out since they are
+    not part of the project.
+    """
+    try:
+        st = os.stat(path)
+        if st.st_size > MAX_FILE_BYTES:
+            return st.st_size, st.st_mtime_ns, []
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if path.endswith(PYTHON_EXTENSIONS):
+        return st.st_size, st.st_mtime_ns, _python_imports(data)
+    text = data.decode("utf-8", "ignore")
+    return st.st_size, st.st_mtime_ns, list(dict.fromkeys(
+        match.group(2) for match in _SCRIPT_IMPORTS.finditer(text)))
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def imports_path(root_path):
+    """Cache file of the parsed imports of a root folder"""
+    key = hashlib.sha1(os.path.normcase(os.path.abspath(root_path))
+                       .encode("utf-8", "surrogateescape")).hexdigest()
+    return os.path.join(get_cache_dir(), "imports", key + ".json.gz")
+
+
+class ImportGraph:
+    """Imports between the source files of a project, for expanding a selection.
+
+    The imports of every file are parsed once per version (size and
+    mtime) and saved per root, so only new and changed files are parsed
+    again. Resolving them to entry ids is cheap and is redone whenever the
+    project index changes.
+    """
+
+    def __init__(self, root_path, project_index):
+        self.root_path = root_path
+        self.project_index = project_index
+        # rel_path ("/" separated) -> [size, mtime_ns, imports]
+        self.files = {}
+        self.modified = False
+        self._key = None
+        self._children = {}
+        self._edges = {}
+
+    def load(self, path=None):
+        """Read the saved imports; returns False if missing or unusable"""
+        path = path or imports_path(self.root_path)
+        try:
+            with gzip.open(path, 'rt', encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, EOFError, ValueError):
+            return False
+        if data.get("version") != VERSION or data.get("root_path") != self.root_path:
+            return False
+        self.files = data.get("files", {})
+        return True
+
+    def save(self, path=None):
+        path = path or imports_path(self.root_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Batch jobs for the same root may save at the same time
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding="utf-8", compresslevel=1) as f:
+            json.dump({"version": VERSION, "root_path": self.root_path,
+                       "files": self.files}, f)
+        os.replace(tmp_path, path)
+        self.modified = False
+
+    def parse(self, file_ids, max_workers=None, cancel=None):
+        """Parse the source files among file_ids that are new or changed"""
+        project_index = self.project_index
+        paths = {project_index.rel_path(file_id, "/"): project_index.path(file_id)
+                 for file_id in file_ids if is_source_file(project_index.name(file_id))}
+        rel_paths = list(paths)
+        with ThreadPoolExecutor(max_workers) as pool:
+            stats = list(pool.map(_stat, (paths[rel_path] for rel_path in rel_paths)))
+        changed = [rel_path for rel_path, st in zip(rel_paths, stats)
+                   if st is not None and tuple(self.files.get(rel_path, (None, None))[:2]) != st]
+        if not changed:
+            return
+
+        pool = open_pool(len(changed), max_workers)
+        try:
+            for start in range(0, len(changed), _BATCH):
+                if cancel is not None and cancel.is_set():
+                    return
+                batch = changed[start:start + _BATCH]
+                batch_paths = [paths[rel_path] for rel_path in batch]
+                try:
+                    results = list(pool.map(parse_imports, batch_paths, chunksize=16))
+                except BrokenProcessPool as e:
+                    print(f"Warning: Parsing imports in worker processes failed, "
+                          f"using threads: {str(e)}")
+                    pool.shutdown()
+                    pool = ThreadPoolExecutor(max_workers)
+                    results = list(pool.map(parse_imports, batch_paths))
+                for rel_path, result in zip(batch, results):
+                    if result is None:
+                        self.files.pop(rel_path, None)
+                    else:
+                        self.files[rel_path] = list(result)
+                self.modified = True
+        finally:
+            pool.shutdown()
+
+    def dependencies(self, file_ids, depth=1, max_workers=None, cancel=None):
+        """Ids of the project files that file_ids import, up to depth
+        imports away, nearest first; file_ids themselves are left out"""
+        seen = set(file_ids)
+        frontier = list(file_ids)
+        found = []
+        for _ in range(depth):
+            self.parse(frontier, max_workers, cancel)
+            if cancel is not None and cancel.is_set():
+                break
+            next_frontier = []
+            for file_id in frontier:
+                for dependency in self.imports_of(file_id):
+                    if dependency not in seen:
+                        seen.add(dependency)
+                        found.append(dependency)
+                        next_frontier.append(dependency)
+            if not next_frontier:
+                break
+            frontier = next_frontier
+        return found
+
+    def imports_of(self, file_id):
+        """Ids of the project files a parsed file imports"""
+        key = (self.project_index.generation, len(self.project_index))
+        if key != self._key:
+            self._children = {}
+            self._edges = {}
+            self._key = key
+        rel_path = self.project_index.rel_path(file_id, "/")
+        parsed = self.files.get(rel_path)
+        if parsed is None:
+            return []
+        cached = self._edges.get(file_id)
+        if cached is not None and cached[0] is parsed:
+            return cached[1]
+
+        folder_parts = rel_path.split("/")[:-1]
+        resolved = []
+        if rel_path.endswith(PYTHON_EXTENSIONS):
+            for level, module, names in parsed[2]:
+                resolved.extend(self._resolve_python(folder_parts, level, module, names))
+        else:
+            for specifier in parsed[2]:
+                dependency = self._resolve_script(folder_parts, specifier)
+                if dependency >= 0:
+                    resolved.append(dependency)
+        resolved = [dependency for dependency in dict.fromkeys(resolved)
+                    if dependency != file_id]
+        self._edges[file_id] = (parsed, resolved)
+        return resolved
+
+    def _lookup(self, parts):
+        """Id of the entry at a list of path parts, or -1"""
+        project_index = self.project_index
+        entry_id = ProjectIndex.ROOT
+        for part in parts:
+            children = self._children.get(entry_id)
+            if children is None:
+                # Folders can hold thousands of files, so names are looked up in a dict
+                children = self._children[entry_id] = {
+                    project_index.name(child): child
+                    for child in project_index.children(entry_id)
+                    if not project_index.is_removed(child)}
+            entry_id = children.get(part, -1)
+            if entry_id < 0:
+                return -1
+        return entry_id
+
+    def _lookup_file(self, parts):
+        file_id = self._lookup(parts)
+        if file_id >= 0 and self.project_index.is_dir(file_id):
+            return -1
+        return file_id
+
+    def _python_module(self, parts):
+        """Id of the file of a module given as path parts: module.py or
+        module/__init__.py"""
+        if parts:
+            for extension in (".py", ".pyi"):
+                file_id = self._lookup_file(parts[:-1] + [parts[-1] + extension])
+                if file_id >= 0:
+                    return file_id
+        return self._lookup_file(parts + ["__init__.py"])
+
+    def _resolve_python(self, folder_parts, level, module, names):
+        module_parts = module.split(".") if module else []
+        if level:
+            if level - 1 > len(folder_parts):
+                return []
+            bases = [folder_parts[:len(folder_parts) - level + 1]]
+        else:
+            # Absolute imports are tried from the importing file's folder up
+            # to the root, which covers scripts, packages and src layouts
+            bases = [folder_parts[:end] for end in range(len(folder_parts), -1, -1)]
+        for base in bases:
+            # from package import name imports the submodule name, if there is one
+            found = [self._python_module(base + module_parts + [name]) for name in names]
+            found = [file_id for file_id in found if file_id >= 0]
+            if not found:
+                file_id = self._python_module(base + module_parts)
+                if file_id >= 0:
+                    found.append(file_id)
+            if found:
+                return found
+        return []
+
+    def _resolve_script(self, folder_parts, specifier):
+        parts = list(folder_parts)
+        for part in specifier.split("?")[0].split("/"):
+            if part in ("", "."):
+                continue
+            if part == "..":
+                if not parts:
+                    return -1
+                parts.pop()
+            else:
+                parts.append(part)
+
+        if parts:
+            folder, name = parts[:-1], parts[-1]
+            candidates = [name] + [name + extension for extension in SCRIPT_EXTENSIONS]
+            stem, extension = os.path.splitext(name)
+            candidates.extend(stem + suffix for suffix in _COMPILED_SUFFIXES.get(extension, ()))
+            for candidate in candidates:
+                file_id = self._lookup_file(folder + [candidate])
+                if file_id >= 0:
+                    return file_id
+        for extension in SCRIPT_EXTENSIONS:
+            file_id = self._lookup_file(parts + ["index" + extension])
+            if file_id >= 0:
+                return file_id
+        return -1
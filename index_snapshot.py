@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import struct
+import hashlib
+import threading
+from array import array
+
+from indexer import ProjectIndex, GitIgnore
+from utils import get_cache_dir
+
+
+MAGIC = b"LDPIDX1\n"
+_ARRAYS = ("parents", "name_offsets", "flags", "sizes",
+           "child_starts", "child_counts", "mtimes")
+
+# Threads that save the same root would share its temporary file
+_save_lock = threading.Lock()
+
+
+def snapshot_path(root_path):
+    """Cache file of a root folder, one per normalized root path"""
+    key = hashlib.sha1(os.path.normcase(os.path.abspath(root_path))
+                       .encode("utf-8", "surrogateescape")).hexdigest()
+    return os.path.join(get_cache_dir(), "index", key + ".idx")
+
+
+def save_snapshot(project_index, path=None):
+    """Write the index as a header followed by the raw bytes of its arrays"""
+    path = path or snapshot_path(project_index.root_path)
+    with _save_lock:
+        return _write_snapshot(project_index, path)
+
+
+def _write_snapshot(project_index, path):
+    copy = project_index.compacted()
+
+    header = {
+        "root_path": copy.root_path,
+        "rules": copy.rules.key(),
+        "byteorder": sys.byteorder,
+        "count": len(copy),
+        "names": len(copy.names),
+        "arrays": [[attr, getattr(copy, attr).typecode if attr != "flags" else "B",
+                    getattr(copy, attr).itemsize if attr != "flags" else 1]
+                   for attr in _ARRAYS],
+        "ignores": [[entry_id, ignore.base, ignore.lines]
+                    for entry_id, ignore in copy.ignores.items()],
+    }
+    header_bytes = json.dumps(header).encode("utf-8", "surrogateescape")
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes)
+        f.write(copy.names)
+        for attr in _ARRAYS:
+            f.write(getattr(copy, attr))
+    # Replace in one step so a crash never leaves a half written snapshot
+    os.replace(tmp_path, path)
+    return copy.generation
+
+
+def load_snapshot(root_path, rules, path=None):
+    """Load the cached index of a root, or None if missing or out of date"""
+    path = path or snapshot_path(root_path)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    try:
+        if not data.startswith(MAGIC):
+            return None
+        offset = len(MAGIC)
+        (header_len,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        header = json.loads(data[offset:offset + header_len]
+                            .decode("utf-8", "surrogateescape"))
+        offset += header_len
+
+        if (header["root_path"] != root_path or header["rules"] != rules.key()
+                or header["byteorder"] != sys.byteorder):
+            return None
+
+        project_index = ProjectIndex(root_path, rules)
+        count = header["count"]
+        view = memoryview(data)
+        if offset + header["names"] > len(data):
+            return None
+        project_index.names = bytearray(view[offset:offset + header["names"]])
+        offset += header["names"]
+        for attr, typecode, itemsize in header["arrays"]:
+            size = count * itemsize
+            if offset + size > len(data):
+                return None
+            if attr == "flags":
+                values = bytearray(view[offset:offset + size])
+            else:
+                values = array(typecode)
+                if values.itemsize != itemsize:
+                    return None
+                values.frombytes(view[offset:offset + size])
+            setattr(project_index, attr, values)
+            offset += size
+
+        for entry_id, base, lines in header["ignores"]:
+            project_index.ignores[entry_id] = GitIgnore(base, lines)
+        return project_index
+    except (ValueError, KeyError, TypeError, struct.error):
+        return None
+
+
+def open_project_index(root_path, rules, max_workers=None, agent=None):
+    """Complete index of a root for headless use.
+
+    Starts from the snapshot when there is one, re-lists the folders that
+    changed since, fills in anything missing and saves the result back.
+    With an agent, the folders are listed through it.
+    """
+    project_index = load_snapshot(root_path, rules)
+    from_snapshot = project_index is not None
+    if not from_snapshot:
+        project_index = ProjectIndex(root_path, rules)
+    project_index.agent = agent
+    if from_snapshot:
+        stale = [(entry_id, project_index.rel_path(entry_id))
+                 for entry_id in project_index.stale_directories(max_workers)]
+        for entry_id, rel_path in stale:
+            if project_index.is_removed(entry_id):
+                entry_id = project_index.find(rel_path)
+                if entry_id < 0:
+                    continue
+            listing = project_index.scan(entry_id)
+            if listing is not None:
+                project_index.replace_listing(entry_id, *listing)
+
+    project_index.expand(max_workers=max_workers)
+    if project_index.generation:
+        try:
+            save_snapshot(project_index)
+        except OSError as e:
+            print(f"Warning: Could not save project index: {str(e)}",
+                  file=sys.stderr)
+    return project_index
@@ -0,0 +1,651 @@
+import os
+import re
+import threading
+import fnmatch
+from array import array
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+_GLOB_CHARS = set("*?[")
+
+FLAG_DIR = 1
+FLAG_REMOVED = 2
+
+
+def _default_workers():
+    # Directory listing is I/O bound, so use more threads than cores
+    return min(32, (os.cpu_count() or 1) * 4)
+
+
+def translate_glob(pattern):
+    """Regex for a "/" separated glob where * stays in one folder and ** spans folders"""
+    regex = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            regex.append("/.*")
+            i += 3
+        elif pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
+        elif c == "*":
+            regex.append("[^/]*")
+            i += 1
+        elif c == "?":
+            regex.append("[^/]")
+            i += 1
+        elif c == "[":
+            end = pattern.find("]", i + 2)
+            if end == -1:
+                regex.append(re.escape(c))
+                i += 1
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                regex.append("[" + body.replace("\\", "\\\\") + "]")
+                i = end + 1
+        elif c == "\\" and i + 1 < len(pattern):
+            regex.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            regex.append(re.escape(c))
+            i += 1
+    return "".join(regex)
+
+
+class GitIgnore:
+    """Rules of a single .gitignore file, matched relative to its folder"""
+
+    def __init__(self, base, lines):
+        # base is the folder of the .gitignore relative to the root, "" for the root
+        self.base = base
+        self.lines = lines
+        self.rules = []
+        for line in lines:
+            rule = self._compile(line)
+            if rule:
+                self.rules.append(rule)
+
+    @classmethod
+    def from_file(cls, path, base):
+        try:
+            with open(path, 'r', encoding="utf-8", errors="replace") as f:
+                return cls(base, f.read().splitlines())
+        except OSError:
+            return None
+
+    @staticmethod
+    def _compile(line):
+        if not line.strip() or line.startswith("#"):
+            return None
+        # Trailing spaces are ignored unless escaped
+        line = line.rstrip(" ")
+        if line.endswith("\\"):
+            line += " "
+
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        elif line.startswith("\\!") or line.startswith("\\#"):
+            line = line[1:]
+
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            return None
+
+        # A slash anywhere but the end anchors the pattern to the .gitignore folder
+        anchored = "/" in line
+        line = line.lstrip("/")
+
+        prefix = "" if anchored else "(?:.*/)?"
+        return re.compile(prefix + translate_glob(line) + r"\Z"), negate, dir_only
+
+    def match(self, rel_path, is_dir):
+        """True if ignored, False if re-included, None if no rule applies"""
+        if self.base:
+            rel_path = rel_path[len(self.base) + 1:]
+        result = None
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel_path):
+                result = not negate
+        return result
+
+
+class ExclusionRules:
+    """Compiled form of the excluded_folders / excluded_extensions settings"""
+
+    def __init__(self, excluded_folders=(), excluded_extensions=(), use_gitignore=True):
+        self.excluded_folders = list(excluded_folders)
+        self.excluded_names = set()
+        patterns = []
+        for name in excluded_folders:
+            if _GLOB_CHARS.intersection(name):
+                patterns.append(fnmatch.translate(name))
+            else:
+                self.excluded_names.add(name)
+        self.name_pattern = re.compile("|".join(patterns)) if patterns else None
+        self.excluded_extensions = {ext.lower() for ext in excluded_extensions}
+        self.use_gitignore = use_gitignore
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get("excluded_folders", []),
+                   settings.get("excluded_extensions", []),
+                   settings.get("use_gitignore", True))
+
+    def to_settings(self):
+        """The settings these rules were made from, for from_settings()"""
+        return {"excluded_folders": self.excluded_folders,
+                "excluded_extensions": sorted(self.excluded_extensions),
+                "use_gitignore": self.use_gitignore}
+
+    def key(self):
+        """Stable description of the rules, used to tell cached scans apart"""
+        return "|".join([
+            ",".join(sorted(self.excluded_names)),
+            self.name_pattern.pattern if self.name_pattern else "",
+            ",".join(sorted(self.excluded_extensions)),
+            str(int(self.use_gitignore)),
+        ])
+
+    def is_excluded(self, name, is_dir):
+        if name in self.excluded_names:
+            return True
+        if self.name_pattern is not None and self.name_pattern.match(name):
+            return True
+        if not is_dir:
+            dot = name.rfind(".")
+            if dot > 0 and name[dot:].lower() in self.excluded_extensions:
+                return True
+        return False
+
+
+def scan_directory(path, rel_dir, rules, ignores=()):
+    """List one folder with os.scandir, without any extra stat per entry.
+
+    Returns the sorted (name, is_dir, size) entries that survive the
+    exclusion rules and the folder's own GitIgnore, if it has one.
+    """
+    raw = []
+    has_gitignore = False
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                name = entry.name
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                if name == ".gitignore":
+                    has_gitignore = True
+                if rules.is_excluded(name, is_dir):
+                    continue
+                size = 0
+                if not is_dir:
+                    try:
+                        size = entry.stat().st_size
+                    except OSError:
+                        pass
+                raw.append((name, is_dir, size))
+    except OSError:
+        pass
+
+    own_ignore = None
+    if has_gitignore and rules.use_gitignore:
+        own_ignore = GitIgnore.from_file(os.path.join(path, ".gitignore"), rel_dir)
+    chain = (list(ignores) + [own_ignore]) if own_ignore else ignores
+
+    entries = []
+    for name, is_dir, size in raw:
+        if chain:
+            rel_path = rel_dir + "/" + name if rel_dir else name
+            ignored = None
+            for ignore in chain:
+                result = ignore.match(rel_path, is_dir)
+                if result is not None:
+                    ignored = result
+            if ignored:
+                continue
+        entries.append((name, is_dir, size))
+    entries.sort(key=lambda e: (not e[1], e[0].lower()))
+    return entries, own_ignore
+
+
+class ProjectIndex:
+    """Flat, array-backed index of the files and folders below a root.
+
+    Every entry is a row in parallel arrays: parent id, offset of its name
+    in a shared UTF-8 buffer, flags (is_dir, removed) and a size. The
+    children of a folder are stored as one contiguous block, so listing a
+    folder is a range of ids, and the folder's mtime at listing time is kept
+    so a stale listing can be detected later. Folders are listed lazily with
+    list_directory() or in bulk with expand(), and both may run from worker
+    threads.
+
+    With an agent, such as a scan_agent.AgentClient, folders are listed
+    and checked for changes by a process next to the files, which saves a
+    network round trip per entry on WSL and other remote roots. If the
+    agent fails, the index drops it and reads the disk directly.
+    """
+    ROOT = 0
+
+    def __init__(self, root_path, rules):
+        self.root_path = root_path
+        self.rules = rules
+        self.parents = array('i')
+        self.name_offsets = array('I')
+        self.names = bytearray()
+        self.flags = bytearray()
+        self.sizes = array('q')
+        # Start of the children block of a folder, -1 until it is listed
+        self.child_starts = array('i')
+        self.child_counts = array('i')
+        self.mtimes = array('q')
+        self.removed_count = 0
+        # Bumped on every change, so callers can tell whether to save again
+        self.generation = 0
+        # GitIgnore of every listed folder that has one, by folder id
+        self.ignores = {}
+        self.agent = None
+        self._lock = threading.Lock()
+        self._append(-1, os.path.basename(os.path.normpath(root_path))
+                     or root_path, True, 0)
+
+    def __len__(self):
+        return len(self.parents)
+
+    def settled_length(self):
+        """Number of entries, not counting a block that is being added right now"""
+        with self._lock:
+            return len(self.parents)
+
+    def _append(self, parent, name, is_dir, size):
+        self.parents.append(parent)
+        self.name_offsets.append(len(self.names))
+        self.names += name.encode("utf-8", "surrogateescape")
+        self.flags.append(FLAG_DIR if is_dir else 0)
+        self.sizes.append(size)
+        self.child_starts.append(-1)
+        self.child_counts.append(0)
+        self.mtimes.append(0)
+
+    def name(self, entry_id):
+        start = self.name_offsets[entry_id]
+        if entry_id + 1 < len(self.name_offsets):
+            end = self.name_offsets[entry_id + 1]
+        else:
+            end = len(self.names)
+        return self.names[start:end].decode("utf-8", "surrogateescape")
+
+    def parent(self, entry_id):
+        return self.parents[entry_id]
+
+    def is_dir(self, entry_id):
+        return self.flags[entry_id] & FLAG_DIR != 0
+
+    def is_removed(self, entry_id):
+        return self.flags[entry_id] & FLAG_REMOVED != 0
+
+    def size(self, entry_id):
+        return self.sizes[entry_id]
+
+    def set_size(self, entry_id, size):
+        with self._lock:
+            self.sizes[entry_id] = size
+            self.generation += 1
+
+    def changed_sizes(self, file_ids):
+        """{file_id: size} of the files whose size on disk is not the one
+        listed; a folder's mtime does not change when a file in it is
+        edited, so a snapshot or an old listing can hold stale sizes"""
+        sizes = {}
+        for file_id in file_ids:
+            try:
+                size = os.stat(self.path(file_id)).st_size
+            except OSError:
+                # Gone; the parent folder's listing will drop it
+                continue
+            if size != self.sizes[file_id]:
+                sizes[file_id] = size
+        return sizes
+
+    def is_listed(self, entry_id):
+        return self.child_starts[entry_id] >= 0
+
+    def children(self, entry_id):
+        start = self.child_starts[entry_id]
+        if start < 0:
+            return range(0)
+        return range(start, start + self.child_counts[entry_id])
+
+    def rel_path(self, entry_id, sep=os.sep):
+        parts = []
+        while entry_id > self.ROOT:
+            parts.append(self.name(entry_id))
+            entry_id = self.parents[entry_id]
+        return sep.join(reversed(parts))
+
+    def path(self, entry_id):
+        if entry_id == self.ROOT:
+            return self.root_path
+        return os.path.join(self.root_path, self.rel_path(entry_id))
+
+    def find(self, rel_path):
+        """Id of the entry at a root-relative path, or -1 if not indexed"""
+        entry_id = self.ROOT
+        for part in rel_path.replace("\\", "/").split("/"):
+            if not part or part == ".":
+                continue
+            for child in self.children(entry_id):
+                if self.name(child) == part:
+                    entry_id = child
+                    break
+            else:
+                return -1
+        return entry_id
+
+    def iter_files(self, entry_id=ROOT):
+        """Ids of the indexed files below an entry, in tree order"""
+        if not self.is_dir(entry_id):
+            yield entry_id
+            return
+        stack = [iter(self.children(entry_id))]
+        while stack:
+            for child in stack[-1]:
+                if self.is_dir(child):
+                    stack.append(iter(self.children(child)))
+                    break
+                yield child
+            else:
+                stack.pop()
+
+    def _ignore_chain(self, entry_id):
+        chain = []
+        while entry_id >= 0:
+            ignore = self.ignores.get(entry_id)
+            if ignore is not None:
+                chain.append(ignore)
+            entry_id = self.parents[entry_id]
+        chain.reverse()
+        return chain
+
+    def _agent_request(self, entry_id):
+        """(rel_dir, ignore chain) of a folder as the agent takes them"""
+        return (self.rel_path(entry_id, "/"),
+                [(ignore.base, ignore.lines) for ignore in self._ignore_chain(entry_id)])
+
+    def _drop_agent(self, agent, error):
+        with self._lock:
+            if self.agent is not agent:
+                return
+            self.agent = None
+        print(f"Warning: Scan agent failed, reading the disk directly: {str(error)}")
+        agent.close()
+
+    def scan(self, entry_id):
+        """Read a folder from disk without touching the index.
+
+        Returns (entries, ignore, mtime) ready for add_listing() or
+        replace_listing(), or None if the folder is gone.
+        """
+        agent = self.agent
+        if agent is not None:
+            try:
+                for _, mtime, entries, ignore in agent.walk(
+                        [self._agent_request(entry_id)], recursive=False):
+                    return None if mtime is None else (entries, ignore, mtime)
+            except OSError as e:
+                self._drop_agent(agent, e)
+        path = self.path(entry_id)
+        try:
+            # Taken before listing, so a change during the scan shows up next time
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        entries, ignore = scan_directory(
+            path, self.rel_path(entry_id, "/"), self.rules,
+            self._ignore_chain(entry_id))
+        return entries, ignore, mtime
+
+    def list_directory(self, entry_id):
+        """List a folder if needed and return the range of its children"""
+        if self.is_listed(entry_id) or self.is_removed(entry_id):
+            return self.children(entry_id)
+        listing = self.scan(entry_id)
+        if listing is None:
+            listing = [], None, 0
+        self.add_listing(entry_id, *listing)
+        return self.children(entry_id)
+
+    def add_listing(self, entry_id, entries, ignore, mtime):
+        with self._lock:
+            # Another thread may have listed it in the meantime
+            if self.is_listed(entry_id) or self.is_removed(entry_id):
+                return
+            self._add_block(entry_id, entries, ignore, mtime)
+
+    def _add_block(self, entry_id, entries, ignore, mtime):
+        start = len(self.parents)
+        for name, is_dir, size in entries:
+            self._append(entry_id, name, is_dir, size)
+        if ignore is not None:
+            self.ignores[entry_id] = ignore
+        else:
+            self.ignores.pop(entry_id, None)
+        self.mtimes[entry_id] = mtime
+        self.child_counts[entry_id] = len(entries)
+        self.child_starts[entry_id] = start
+        self.generation += 1
+
+    def replace_listing(self, entry_id, entries, ignore, mtime):
+        """Swap in a fresh listing of an already listed folder.
+
+        The folder gets a new block of children. Children that still exist,
+        or that look renamed (the only entry of its kind and size to vanish
+        and the only one to appear), are matched to their old entry and
+        sub-folders keep their listing. Returns a dict mapping the old id of
+        every matched child to its new id.
+        """
+        with self._lock:
+            old_ids = {}
+            for child in self.children(entry_id):
+                old_ids[(self.name(child), self.is_dir(child))] = child
+                self.flags[child] |= FLAG_REMOVED
+            self.removed_count += len(old_ids)
+
+            self._add_block(entry_id, entries, ignore, mtime)
+            moved = {}
+            added = []
+            for new_id in self.children(entry_id):
+                old_id = old_ids.pop((self.name(new_id), self.is_dir(new_id)), None)
+                if old_id is None:
+                    added.append(new_id)
+                else:
+                    moved[old_id] = new_id
+
+            renamed = self._pair_renames(list(old_ids.values()), added)
+            moved.update(renamed)
+            for old_id, new_id in moved.items():
+                if self.is_dir(old_id) and self.is_listed(old_id):
+                    self._move_listing(old_id, new_id)
+            if any(self.is_dir(new_id) for new_id in renamed.values()):
+                self._rebase_ignores()
+            return moved
+
+    def _pair_renames(self, vanished, added):
+        groups = {}
+        for entry_id in vanished:
+            groups.setdefault((self.is_dir(entry_id), self.sizes[entry_id]),
+                              ([], []))[0].append(entry_id)
+        for entry_id in added:
+            key = (self.is_dir(entry_id), self.sizes[entry_id])
+            if key in groups:
+                groups[key][1].append(entry_id)
+        return {old[0]: new[0] for old, new in groups.values()
+                if len(old) == 1 and len(new) == 1}
+
+    def _move_listing(self, old_id, new_id):
+        self.mtimes[new_id] = self.mtimes[old_id]
+        self.child_counts[new_id] = self.child_counts[old_id]
+        self.child_starts[new_id] = self.child_starts[old_id]
+        for grandchild in self.children(new_id):
+            self.parents[grandchild] = new_id
+        if old_id in self.ignores:
+            self.ignores[new_id] = self.ignores.pop(old_id)
+
+    def _rebase_ignores(self):
+        # A renamed folder changes the relative path of the .gitignore files below it
+        for entry_id, ignore in self.ignores.items():
+            ignore.base = self.rel_path(entry_id, "/")
+
+    def compacted(self):
+        """Copy of the index without the entries dropped by replace_listing()"""
+        with self._lock:
+            copy = ProjectIndex(self.root_path, self.rules)
+            copy.generation = self.generation
+            if not self.removed_count:
+                for attr in ("parents", "name_offsets", "names", "flags", "sizes",
+                             "child_starts", "child_counts", "mtimes"):
+                    setattr(copy, attr, getattr(self, attr)[:])
+                copy.ignores = dict(self.ignores)
+                return copy
+
+            copy.mtimes[self.ROOT] = self.mtimes[self.ROOT]
+            stack = [(self.ROOT, self.ROOT)]
+            while stack:
+                old_id, new_id = stack.pop()
+                if not self.is_listed(old_id):
+                    continue
+                start = len(copy.parents)
+                for i, child in enumerate(self.children(old_id)):
+                    copy._append(new_id, self.name(child), self.is_dir(child),
+                                 self.sizes[child])
+                    if self.is_dir(child):
+                        copy.mtimes[start + i] = self.mtimes[child]
+                        stack.append((child, start + i))
+                copy.child_counts[new_id] = self.child_counts[old_id]
+                copy.child_starts[new_id] = start
+                if old_id in self.ignores:
+                    copy.ignores[new_id] = self.ignores[old_id]
+            return copy
+
+    def listed_directories(self, entry_id=ROOT):
+        """Ids of the listed folders below an entry, parents first"""
+        found = []
+        stack = [entry_id]
+        while stack:
+            current = stack.pop()
+            if not self.is_listed(current):
+                continue
+            found.append(current)
+            stack.extend(child for child in self.children(current)
+                         if self.is_dir(child))
+        return found
+
+    def stale_directories(self, max_workers=None, cancel=None):
+        """Listed folders whose mtime no longer matches the one on disk"""
+        def is_stale(entry_id):
+            if cancel is not None and cancel.is_set():
+                return False
+            try:
+                return os.stat(self.path(entry_id)).st_mtime_ns != self.mtimes[entry_id]
+            except OSError:
+                # Gone; the parent folder's listing will drop it
+                return False
+
+        folders = self.listed_directories()
+        agent = self.agent
+        if agent is not None:
+            try:
+                mtimes = agent.mtimes([self.rel_path(entry_id, "/") for entry_id in folders])
+                return [entry_id for entry_id, mtime in zip(folders, mtimes)
+                        if mtime is not None and mtime != self.mtimes[entry_id]]
+            except OSError as e:
+                self._drop_agent(agent, e)
+        with ThreadPoolExecutor(max_workers or _default_workers()) as pool:
+            flags = list(pool.map(is_stale, folders, chunksize=64))
+        return [entry_id for entry_id, stale in zip(folders, flags) if stale]
+
+    def _unlisted_dirs(self, entry_id):
+        if not self.is_listed(entry_id):
+            return [entry_id]
+        found = []
+        stack = [entry_id]
+        while stack:
+            for child in self.children(stack.pop()):
+                if self.is_dir(child):
+                    if self.is_listed(child):
+                        stack.append(child)
+                    else:
+                        found.append(child)
+        return found
+
+    def expand(self, entry_id=ROOT, max_workers=None, cancel=None, progress=None):
+        """List every folder below an entry, spreading the work over a thread pool.
+
+        Returns False if cancelled before the subtree was complete.
+        """
+        if not self.is_dir(entry_id):
+            return True
+        if self.agent is not None and not self._expand_with_agent(entry_id, cancel, progress):
+            return False
+        with ThreadPoolExecutor(max_workers or _default_workers()) as pool:
+            pending = {pool.submit(self.list_directory, d)
+                       for d in self._unlisted_dirs(entry_id)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                if cancel is not None and cancel.is_set():
+                    for future in pending:
+                        future.cancel()
+                    return False
+                for future in done:
+                    for child in future.result():
+                        if self.is_dir(child):
+                            pending.update(pool.submit(self.list_directory, d)
+                                           for d in self._unlisted_dirs(child))
+                if progress is not None:
+                    progress(len(self.parents))
+        return True
+
+    def _expand_with_agent(self, entry_id, cancel, progress):
+        """List the unlisted folders below an entry from one stream of the
+        agent's listings. Returns False if cancelled; folders it misses,
+        such as when it fails, are left to the direct listing."""
+        agent = self.agent
+        folders = {}
+        for folder in self._unlisted_dirs(entry_id):
+            rel_dir, chain = self._agent_request(folder)
+            folders[rel_dir] = (folder, chain)
+        if not folders:
+            return True
+        try:
+            listings = agent.walk([(rel_dir, chain) for rel_dir, (_, chain)
+                                   in folders.items()])
+            for rel_dir, mtime, entries, ignore in listings:
+                if cancel is not None and cancel.is_set():
+                    listings.close()
+                    return False
+                folder = folders.pop(rel_dir, (-1, None))[0]
+                if folder < 0:
+                    # Below a folder that another thread listed meanwhile
+                    continue
+                if mtime is None:
+                    entries, ignore, mtime = [], None, 0
+                self.add_listing(folder, entries, ignore, mtime)
+                prefix = rel_dir + "/" if rel_dir else ""
+                for child in self.children(folder):
+                    if self.is_dir(child) and not self.is_listed(child):
+                        folders[prefix + self.name(child)] = (child, None)
+                if progress is not None:
+                    progress(len(self.parents))
+        except OSError as e:
+            self._drop_agent(agent, e)
+        return True
@@ -1,23 +1,53 @@
 import sys
 import os
-from PyQt6.QtWidgets import QApplication
-from PyQt6.QtGui import QIcon
-from ui import MainWindow
+import multiprocessing
 from utils import get_resource_path
+from timings import Timings, span
 
 
-def main():
-    app = QApplication(sys.argv)
+def run_gui(profile_startup=False):
+    # With --profile-startup, time each step until the root folder is listed,
+    # print the timings and quit
+    timings = Timings("Startup") if profile_startup else None
+
+    # PyQt is only needed for the window, so batch runs never load it
+    with span(timings, "Import PyQt"):
+        from PyQt6.QtWidgets import QApplication
+        from PyQt6.QtGui import QIcon
+        from PyQt6.QtCore import QTimer
+    with span(timings, "Import ui"):
+        from ui import MainWindow
+
+    with span(timings, "Create application"):
+        app = QApplication(sys.argv)
 
-    # Set application icon using resource path
-    icon_path = get_resource_path(os.path.join("assets", "app_icon.png"))
-    if os.path.exists(icon_path):
-        app.setWindowIcon(QIcon(icon_path))
+        # Set application icon using resource path
+        icon_path = get_resource_path(os.path.join("assets", "app_icon.png"))
+        if os.path.exists(icon_path):
+            app.setWindowIcon(QIcon(icon_path))
 
-    window = MainWindow()
-    window.show()
+    with span(timings, "Create window"):
+        window = MainWindow(startup_timings=timings)
+    with span(timings, "Show window"):
+        window.show()
+    if timings is not None:
+        timings.begin("First paint")
+    # Load the tree once the event loop runs, after the window is shown
+    QTimer.singleShot(0, window.finish_startup)
     sys.exit(app.exec())
 
 
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        from batch import main as batch_main
+        sys.exit(batch_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "agent":
+        from scan_agent import main as agent_main
+        sys.exit(agent_main(sys.argv[2:]))
+    run_gui("--profile-startup" in sys.argv[1:])
+
+
 if __name__ == "__main__":
+    # Worker processes of a frozen build start by running this file again
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,570 @@
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from token_budget import TokenCounter, pack_files, elide_to_tokens
+from stack_trace import merge_windows
+from symbols import slice_file
+from file_ingest import read_file, total_cap_marker, SizeCap
+
+
+class GenerationCancelled(Exception):
+    pass
+
+
+class _Packed(str):
+    """File content cut down to fit the token budget, with its token cost"""
+
+    def __new__(cls, text, tokens):
+        packed = super().__new__(cls, text)
+        packed.tokens = tokens
+        return packed
+
+
+# path -> (size, mtime, contents) of the template and context files read
+_text_files = {}
+
+
+def read_text_file(path):
+    """Contents of an optional template or context file, "" if it is missing.
+
+    The contents are kept until the file's size or modification time
+    changes, so each generation costs a stat instead of a read.
+    """
+    if not path:
+        return ""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ""
+    cached = _text_files.get(path)
+    if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+        return cached[2]
+    with open(path, 'r') as f:
+        content = f.read()
+    _text_files[path] = (st.st_size, st.st_mtime_ns, content)
+    return content
+
+
+def read_file_content(path, cache=None, max_bytes=None):
+    """Contents of a selected project file, an error marker for the prompt,
+    or None if the file no longer exists"""
+    try:
+        return read_file(path, max_bytes, cache)
+    except FileNotFoundError:
+        return None
+    except UnicodeDecodeError:
+        return "[Error: Unable to read file due to encoding issues.]"
+    except Exception as e:
+        return f"[Error reading file: {str(e)}]"
+
+
+def read_capped(path, max_bytes, max_total_bytes, cache=None):
+    """read_file_content(), or a marker once max_bytes from a SizeCap shows
+    that the total size limit is used up"""
+    if max_bytes is not None and max_bytes <= 0:
+        return total_cap_marker(max_total_bytes)
+    return read_file_content(path, cache, max_bytes)
+
+
+def _fits(path, max_bytes):
+    """Whether a file is read whole within max_bytes"""
+    try:
+        return 0 < max_bytes and os.path.getsize(path) <= max_bytes
+    except OSError:
+        return False
+
+
+def read_file_excerpt(path, lines, context):
+    """The parts of a file within context lines of the given line numbers.
+
+    Reading stops after the last window, so only the start of a long
+    file is read for a frame near its top. Skipped stretches are replaced
+    by "[... lines a-b omitted ...]" markers. None if the file no longer
+    exists.
+    """
+    windows = merge_windows(lines, context)
+    parts = []
+    try:
+        with open(path, 'r', encoding="utf-8") as f:
+            line_number = 0
+            for first, last in windows:
+                skipped = 0
+                while line_number + 1 < first:
+                    if not f.readline():
+                        break
+                    line_number += 1
+                    skipped += 1
+                if skipped:
+                    parts.append(f"[... lines {first - skipped}-{first - 1} omitted ...]\n")
+                while line_number < last:
+                    text = f.readline()
+                    if not text:
+                        break
+                    line_number += 1
+                    parts.append(text if text.endswith("\n") else text + "\n")
+            if f.readline():
+                parts.append(f"[... lines after {line_number} omitted ...]\n")
+    except FileNotFoundError:
+        return None
+    except UnicodeDecodeError:
+        return "[Error: Unable to read file due to encoding issues.]"
+    except Exception as e:
+        return f"[Error reading file: {str(e)}]"
+    return "".join(parts).rstrip("\n")
+
+
+def read_file_slice(path, symbols, cache=None):
+    """The chosen symbols of a file with the rest as signatures, None if
+    the file no longer has any of them, or an error marker for the prompt"""
+    try:
+        return slice_file(path, symbols, cache)
+    except FileNotFoundError:
+        # Read as a whole file next, which leaves it out
+        return None
+    except UnicodeDecodeError:
+        return "[Error: Unable to read file due to encoding issues.]"
+    except Exception as e:
+        return f"[Error reading file: {str(e)}]"
+
+
+class PromptBuilder:
+    """Streams the prompt section by section instead of building one string.
+
+    Selected files are read by a bounded thread pool a few files ahead of
+    the writer, and are emitted in selection order. progress is called
+    with (files_done, files_total), and setting cancel (a threading.Event)
+    stops the build with GenerationCancelled. With a ContentCache, files
+    that did not change since the last build are not read again.
+
+    With a TokenCounter, token_report lists the (title, tokens) cost of
+    every section. A token_budget also makes the builder read all files
+    first and pack them into the budget, cutting the largest files down
+    to their head and tail and dropping those that no longer fit.
+
+    line_windows maps a file path to line numbers, such as the frames of
+    a stack trace; such files are cut down to context_lines around those
+    lines instead of being included whole.
+
+    symbols maps a file path to qualified names of its classes and
+    functions, such as "MainWindow.generate_prompt"; such files keep only
+    those and what they call in full, and the signatures of the rest.
+    This takes precedence over line_windows, and symbol tables come from
+    symbol_cache when one is given.
+
+    max_file_bytes caps each file, keeping its head and tail, and
+    max_total_bytes caps all files together: files are given what is left
+    in selection order, and those after the limit are left out. Binary
+    files are replaced by a marker.
+
+    With a diff_source, such as git_repo.DiffSource, files it has a diff
+    for are replaced by that diff.
+
+    With a part_budget, build_parts() and write_parts() split the file
+    contents over as many parts as needed to keep each part within that
+    many tokens (part_unit "tokens") or characters ("chars").
+
+    With a file_source, such as a scan_agent.AgentClient, the files that
+    are included whole are read through it in streamed batches instead of
+    one by one; if it fails, the rest are read directly.
+
+    With timings, a timings.Timings, every file read is recorded with its
+    time and size.
+
+    Files that no longer exist are left out, and their paths are listed in
+    missing once the build is done.
+    """
+
+    def __init__(self, template_content, defect_description, context_content,
+                 tree_structure, files, root_folder, max_workers=8,
+                 progress=None, cancel=None, cache=None,
+                 token_counter=None, token_budget=None,
+                 line_windows=None, context_lines=20,
+                 max_file_bytes=None, max_total_bytes=None,
+                 symbols=None, symbol_cache=None,
+                 part_budget=None, part_unit="tokens", diff_source=None,
+                 file_source=None, timings=None):
+        self.template_content = template_content
+        self.defect_description = defect_description
+        self.context_content = context_content
+        self.tree_structure = tree_structure
+        self.files = list(files)
+        self.root_folder = root_folder
+        self.max_workers = max_workers
+        self.progress = progress
+        self.cancel = cancel or threading.Event()
+        self.cache = cache
+        if token_budget and token_counter is None:
+            token_counter = TokenCounter()
+        self.token_counter = token_counter
+        self.token_budget = token_budget
+        self.line_windows = line_windows or {}
+        self.context_lines = context_lines
+        self.max_file_bytes = max_file_bytes
+        self.max_total_bytes = max_total_bytes
+        self.symbols = symbols or {}
+        self.symbol_cache = symbol_cache
+        self.part_budget = part_budget
+        self.part_unit = part_unit
+        self.diff_source = diff_source
+        self.file_source = file_source
+        self.timings = timings
+        if part_budget and part_unit == "tokens" and token_counter is None:
+            self.token_counter = TokenCounter()
+        self._size_cap = SizeCap(max_file_bytes, max_total_bytes)
+        self.token_report = []
+        self.missing = []
+        # Files read in part because of a size cap
+        self._capped = set()
+
+    @property
+    def total_tokens(self):
+        return sum(tokens for _, tokens in self.token_report)
+
+    def iter_sections(self):
+        """Yield (title, text) pairs that concatenate to the full prompt"""
+        self.token_report = []
+        fixed = [
+            ("Template", f"{self.template_content}\n\n"),
+            ("Defect Description", f"**Defect Description:**\n{self.defect_description}\n\n"),
+            ("Project Context", f"**Project Context:**\n{self.context_content}\n\n"),
+            ("Project File Structure",
+             f"**Project File Structure:**\n{self.tree_structure}\n\n"),
+            ("File Contents", "\n**File Contents:**\n"),
+        ]
+        for title, text in fixed:
+            if self.token_counter is not None:
+                self.token_report.append(
+                    (title, self.token_counter.count_text(text)))
+            yield title, text
+
+        files = self._read_files()
+        if self.token_budget:
+            files = self._pack_files(list(files))
+        for path, content in files:
+            rel_path = os.path.relpath(path, self.root_folder)
+            header = f"\n[File: {rel_path}]\n"
+            if self.token_counter is not None:
+                self.token_report.append((rel_path, self._file_tokens(
+                    path, content, header)))
+            yield rel_path, f"{header}{content}\n"
+
+    def _file_tokens(self, path, content, header):
+        if isinstance(content, _Packed):
+            return content.tokens + self.token_counter.count_text(header)
+        return self._count_content(path, content) + self.token_counter.count_text(header)
+
+    def _is_excerpt(self, path):
+        # A diff is only known once read, so any file might be one
+        return (path in self.line_windows or path in self.symbols
+                or self.diff_source is not None)
+
+    def _count_content(self, path, content):
+        # Counts are cached per file version, which only fits whole files;
+        # a file source means the files are slow to stat
+        if (self._is_excerpt(path) or self.file_source is not None
+                or path in self._capped):
+            return self.token_counter.count_text(content)
+        return self.token_counter.count_file(path, content)
+
+    def _read(self, path, max_bytes):
+        if self.diff_source is not None:
+            diff = self.diff_source.diff(path)
+            if diff is not None:
+                return diff
+        chosen = self.symbols.get(path)
+        if chosen:
+            content = read_file_slice(path, chosen, self.symbol_cache)
+            if content is not None:
+                return content
+        lines = self.line_windows.get(path)
+        if lines:
+            return read_file_excerpt(path, lines, self.context_lines)
+        if max_bytes is not None and not _fits(path, max_bytes):
+            self._capped.add(path)
+        return read_capped(path, max_bytes, self.max_total_bytes, self.cache)
+
+    def _timed_read(self, path, max_bytes):
+        started = time.perf_counter()
+        content = self._read(path, max_bytes)
+        self.timings.file_read(path, time.perf_counter() - started, len(content or ""))
+        return content
+
+    def _submit(self, pool, path):
+        """Start reading a file, within what is left of the total byte cap"""
+        read = self._read if self.timings is None else self._timed_read
+        if self._is_excerpt(path):
+            return pool.submit(read, path, self.max_file_bytes)
+        return pool.submit(read, path, self._size_cap.limit(path))
+
+    def _pack_files(self, files):
+        counter = self.token_counter
+        counts = [self._count_content(path, content) for path, content in files]
+        overhead = sum(
+            counter.count_text(f"\n[File: {os.path.relpath(path, self.root_folder)}]\n")
+            for path, _ in files)
+        available = self.token_budget - overhead - sum(
+            tokens for _, tokens in self.token_report)
+        packed = []
+        for (path, content), tokens, allotted in zip(
+                files, counts, pack_files(counts, available)):
+            if allotted >= tokens:
+                packed.append((path, content))
+            elif allotted == 0:
+                packed.append((path, _Packed(
+                    f"[Omitted: {tokens} tokens do not fit the token budget]", 0)))
+            else:
+                packed.append((path, _Packed(
+                    elide_to_tokens(content, tokens, allotted), allotted)))
+        return packed
+
+    def _read_files(self):
+        total = len(self.files)
+        if self.progress is not None:
+            self.progress(0, total)
+        if not total:
+            return
+
+        self._size_cap = SizeCap(self.max_file_bytes, self.max_total_bytes)
+        self.missing = []
+        self._capped = set()
+        fetched = None
+        if self.file_source is not None:
+            fetched = self.file_source.read_files(
+                [path for path in self.files if not self._is_excerpt(path)],
+                self.max_file_bytes, self.max_total_bytes)
+        try:
+            with ThreadPoolExecutor(self.max_workers) as pool:
+                # Keep only a window of reads in flight so memory stays bounded
+                window = deque()
+                pending = iter(self.files)
+                for path in pending:
+                    window.append((path, self._start(pool, path, fetched)))
+                    if len(window) >= self.max_workers * 2:
+                        break
+                done = 0
+                while window:
+                    if self.cancel.is_set():
+                        for _, future in window:
+                            if future is not None:
+                                future.cancel()
+                        raise GenerationCancelled()
+                    path, future = window.popleft()
+                    if future is None and self.timings is not None:
+                        started = time.perf_counter()
+                        content = self._next_fetched(fetched, path)
+                        self.timings.file_read(
+                            path, time.perf_counter() - started, len(content or ""))
+                    elif future is None:
+                        content = self._next_fetched(fetched, path)
+                    else:
+                        content = future.result()
+                    next_path = next(pending, None)
+                    if next_path is not None:
+                        window.append((next_path, self._start(pool, next_path, fetched)))
+                    done += 1
+                    if self.progress is not None:
+                        self.progress(done, total)
+                    if content is None:
+                        self.missing.append(path)
+                        continue
+                    yield path, content
+        finally:
+            if fetched is not None:
+                fetched.close()
+
+    def _start(self, pool, path, fetched):
+        """Future of a file's content, or None if it comes from the file source"""
+        if fetched is not None and self.file_source is not None and not self._is_excerpt(path):
+            return None
+        return self._submit(pool, path)
+
+    def _next_fetched(self, fetched, path):
+        """Content of the next file from the file source, in selection order"""
+        if self.file_source is not None:
+            try:
+                fetched_path, content, used = next(fetched)
+                if fetched_path == path:
+                    self._size_cap.used = used
+                    return content
+                error = f"expected {path}, got {fetched_path}"
+            except StopIteration:
+                error = "it sent fewer files than requested"
+            except OSError as e:
+                error = str(e)
+            print(f"Warning: Reading files through the scan agent failed, "
+                  f"reading them directly: {error}")
+            self.file_source = None
+        return self._read(path, self._size_cap.limit(path))
+
+    def _measure(self, text):
+        if self.part_unit == "tokens":
+            return self.token_counter.count_text(text)
+        return len(text)
+
+    def _part_header(self, fixed, number, count):
+        """Template, part marker and description that open every part, as
+        (title, text) sections"""
+        sections = [("Template", fixed["Template"])]
+        if count > 1:
+            if number < count:
+                note = (f"Wait for all {count} parts before answering; reply to this "
+                        f"one only with \"Received part {number} of {count}\".")
+            else:
+                note = f"This is the last part; answer using all {count} parts."
+            sections.append((f"Part {number} of {count}",
+                             f"**Part {number} of {count}:** This prompt is split into "
+                             f"{count} parts. {note}\n\n"))
+        sections.append(("Defect Description", fixed["Defect Description"]))
+        if number == 1:
+            sections.append(("Project Context", fixed["Project Context"]))
+            sections.append(("Project File Structure", fixed["Project File Structure"]))
+        if count > 1:
+            sections.append(("File Contents",
+                             f"\n**File Contents (part {number} of {count}):**\n"))
+        else:
+            sections.append(("File Contents", fixed["File Contents"]))
+        return sections
+
+    def _split_lines(self, content, first_room, room):
+        """Pieces of content cut at line breaks, the first within first_room
+        and the others within room; a line longer than that is cut too"""
+        pieces = []
+        current, used, limit = [], 0, first_room
+        for line in content.splitlines(keepends=True):
+            cost = self._measure(line)
+            if current and used + cost > limit:
+                pieces.append("".join(current))
+                current, used, limit = [], 0, room
+            while cost > limit:
+                # Minified code and data files can hold a whole part in one line
+                head = self._line_head(line, cost, limit)
+                pieces.append(head)
+                current, used, limit = [], 0, room
+                line = line[len(head):]
+                cost = self._measure(line)
+            current.append(line)
+            used += cost
+        if current or not pieces:
+            pieces.append("".join(current))
+        return pieces
+
+    def _line_head(self, line, cost, room):
+        """Longest start of a line that fits in room, at least one character,
+        cut at a space if there is one in its second half"""
+        if self.part_unit == "tokens":
+            # Guess from the line's characters per token, then shrink to fit
+            end = max(1, len(line) * room // cost)
+            while end > 1:
+                used = self._measure(line[:end])
+                if used <= room:
+                    break
+                end = max(1, min(end - 1, end * room // used))
+        else:
+            end = max(1, room)
+        space = line.rfind(" ", end // 2, end)
+        return line[:space + 1 if space >= 0 else end]
+
+    def iter_part_sections(self):
+        """The prompt split into parts: a list of (title, text) sections per part.
+
+        Files are read as for iter_sections() and packed into the parts in
+        selection order. A file that does not fit in what is left of a
+        part starts the next one, so files stay whole; only a file larger
+        than a whole part is cut at line breaks, or inside lines longer
+        than a part, and continued in the following parts. The number of parts is only known once all files
+        are read, which is why the parts are returned together.
+        """
+        sections = self.iter_sections()
+        fixed = {}
+        for title, text in sections:
+            fixed[title] = text
+            if title == "File Contents":
+                break
+
+        budget = self.part_budget
+        # The marker is measured with the widest part numbers it will likely
+        # show, and with the longer note of a part that is not the last
+        header = self._measure("".join(
+            text for _, text in self._part_header(fixed, 98, 99)))
+        room = budget - header
+        first_room = room - self._measure(
+            fixed["Project Context"] + fixed["Project File Structure"])
+        if first_room <= 0:
+            raise ValueError(
+                f"The part size of {budget} {self.part_unit} leaves no room for files "
+                f"after the template, description, context and structure")
+
+        parts = [[]]
+        limit, used = first_room, 0
+        for rel_path, text in sections:
+            cost = self._measure(text)
+            if cost <= room:
+                if used + cost > limit:
+                    parts.append([])
+                    limit, used = room, 0
+                parts[-1].append((rel_path, text))
+                used += cost
+                continue
+
+            # Larger than a whole part, so it fills what is left of this
+            # part and is continued in the next ones
+            file_header = f"\n[File: {rel_path}]\n"
+            continued_header = f"\n[File: {rel_path} (continued)]\n"
+            continued = "[... continued in the next part ...]\n"
+            overhead = self._measure(continued_header) + self._measure(continued)
+            if limit - used <= overhead:
+                parts.append([])
+                limit, used = room, 0
+            pieces = self._split_lines(
+                text[len(file_header):], limit - used - overhead, room - overhead)
+            for number, piece in enumerate(pieces):
+                if number:
+                    parts.append([])
+                    limit, used = room, 0
+                chunk = (file_header if number == 0 else continued_header) + piece
+                if number < len(pieces) - 1:
+                    chunk += continued
+                parts[-1].append((f"{rel_path} ({number + 1} of {len(pieces)})", chunk))
+                used += self._measure(chunk)
+
+        count = len(parts)
+        return [self._part_header(fixed, number, count) + sections
+                for number, sections in enumerate(parts, 1)]
+
+    def build_parts(self):
+        return ["".join(text for _, text in sections)
+                for sections in self.iter_part_sections()]
+
+    def write_parts(self, path):
+        """Write each part to its own file next to path, such as
+        prompt.part1of3.txt; returns the paths written"""
+        parts = self.iter_part_sections()
+        base, extension = os.path.splitext(path)
+        paths = []
+        for number, sections in enumerate(parts, 1):
+            part_path = (f"{base}.part{number}of{len(parts)}{extension}"
+                         if len(parts) > 1 else path)
+            with open(part_path, 'w', encoding="utf-8") as f:
+                for _, text in sections:
+                    f.write(text)
+            paths.append(part_path)
+        return paths
+
+    def iter_chunks(self):
+        for _, text in self.iter_sections():
+            yield text
+
+    def write_to(self, stream):
+        """Write the prompt to a text stream, such as an open file"""
+        for text in self.iter_chunks():
+            stream.write(text)
+
+    def write_file(self, path):
+        with open(path, 'w', encoding="utf-8") as f:
+            self.write_to(f)
+
+    def build(self):
+        return "".join(self.iter_chunks())
@@ -0,0 +1,206 @@
+import time
+from collections import deque
+
+from PyQt6.QtWidgets import (
+    QWidget, QVBoxLayout, QLabel, QSplitter, QPlainTextEdit, QTreeWidget,
+    QTreeWidgetItem, QHeaderView
+)
+from PyQt6.QtCore import Qt, QTimer, pyqtSignal
+from PyQt6.QtGui import QTextCursor, QTextOption
+
+
+class PromptView(QWidget):
+    """Read-only plain text view of a prompt with an outline of its sections.
+
+    Sections are queued by append_section() and inserted a slice at a time
+    from a zero-interval timer, so the window keeps painting and taking
+    input while a multi-megabyte prompt fills in. QPlainTextEdit lays out
+    only the visible lines, unlike the rich text QTextEdit. The outline
+    lists every section with its size, and its tokens once set_tokens() is
+    called; the files are grouped under "File Contents", and clicking a
+    section scrolls to it. loaded is emitted whenever the queue runs dry.
+    """
+    loaded = pyqtSignal()
+
+    # Characters inserted per timer tick, small enough to stay responsive
+    APPEND_CHARS = 256 * 1024
+    # Time one tick may spend before handing control back to the event loop
+    TICK_SECONDS = 0.03
+
+    SECTION_COLUMN = 0
+    SIZE_COLUMN = 1
+    TOKENS_COLUMN = 2
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+
+        self.summary_label = QLabel()
+        layout.addWidget(self.summary_label)
+
+        splitter = QSplitter(Qt.Orientation.Horizontal)
+        self.outline = QTreeWidget()
+        self.outline.setHeaderLabels(["Section", "Characters", "Tokens"])
+        self.outline.setUniformRowHeights(True)
+        self.outline.header().setStretchLastSection(False)
+        self.outline.header().setSectionResizeMode(
+            self.SECTION_COLUMN, QHeaderView.ResizeMode.Stretch)
+        self.outline.itemClicked.connect(self._on_item_clicked)
+        splitter.addWidget(self.outline)
+
+        self.text = QPlainTextEdit()
+        self.text.setReadOnly(True)
+        self.text.setUndoRedoEnabled(False)
+        # Wrapping at any character keeps long minified lines from needing
+        # one huge layout line
+        self.text.setWordWrapMode(QTextOption.WrapMode.WrapAtWordBoundaryOrAnywhere)
+        splitter.addWidget(self.text)
+        splitter.setStretchFactor(0, 1)
+        splitter.setStretchFactor(1, 3)
+        layout.addWidget(splitter)
+
+        self._queue = deque()
+        # Offset into the first queued section that is already inserted
+        self._queued_offset = 0
+        self._files_item = None
+        self._items = {}
+        self._tokens = {}
+        self._characters = 0
+        self._file_characters = 0
+        self._file_count = 0
+        self._token_total = 0
+        self._append_timer = QTimer(self)
+        self._append_timer.setInterval(0)
+        self._append_timer.timeout.connect(self._append_queued)
+        self.clear()
+
+    def clear(self):
+        self._append_timer.stop()
+        self._queue = deque()
+        self._queued_offset = 0
+        self._files_item = None
+        self._items = {}
+        self._tokens = {}
+        self._characters = 0
+        self._file_characters = 0
+        self._file_count = 0
+        self._token_total = 0
+        self.outline.clear()
+        self.text.clear()
+        self._update_summary()
+
+    def set_sections(self, sections):
+        """Show a whole prompt given as (title, text) sections"""
+        self.clear()
+        for title, text in sections:
+            self.append_section(title, text)
+
+    def append_section(self, title, text):
+        self._queue.append((title, text))
+        if not self._append_timer.isActive():
+            self._append_timer.start()
+
+    def set_tokens(self, report):
+        """Fill in the tokens column from a (title, tokens) report"""
+        self._tokens = dict(report)
+        self._token_total = 0
+        for title, item in self._items.items():
+            if title in self._tokens:
+                item.setText(self.TOKENS_COLUMN, f"{self._tokens[title]:,}")
+                self._token_total += self._tokens[title]
+        self._update_files_item()
+        self._resize_columns()
+        self._update_summary()
+
+    def is_loading(self):
+        return bool(self._queue)
+
+    def _append_queued(self):
+        started = time.monotonic()
+        budget = self.APPEND_CHARS
+        cursor = QTextCursor(self.text.document())
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        while self._queue and budget > 0:
+            title, text = self._queue[0]
+            if self._queued_offset == 0:
+                self._add_item(title, text, cursor.position())
+            piece = text[self._queued_offset:self._queued_offset + budget]
+            cursor.insertText(piece)
+            budget -= len(piece)
+            self._queued_offset += len(piece)
+            if self._queued_offset >= len(text):
+                self._queue.popleft()
+                self._queued_offset = 0
+            if time.monotonic() - started > self.TICK_SECONDS:
+                break
+        if not self._queue:
+            self._append_timer.stop()
+            self._update_files_item()
+            self._resize_columns()
+        self._update_summary()
+        if not self._queue:
+            self.loaded.emit()
+
+    def _add_item(self, title, text, position):
+        # Sections start with blank lines; jump to their first line of text
+        blank = 0
+        while blank < len(text) and text[blank] == "\n":
+            blank += 1
+        position += blank
+        item = QTreeWidgetItem([title, f"{len(text):,}", ""])
+        item.setData(self.SECTION_COLUMN, Qt.ItemDataRole.UserRole, position)
+        item.setTextAlignment(self.SIZE_COLUMN, Qt.AlignmentFlag.AlignRight)
+        item.setTextAlignment(self.TOKENS_COLUMN, Qt.AlignmentFlag.AlignRight)
+        if title in self._tokens:
+            item.setText(self.TOKENS_COLUMN, f"{self._tokens[title]:,}")
+            self._token_total += self._tokens[title]
+        self._characters += len(text)
+        if self._files_item is not None:
+            # Everything after the "File Contents" heading is a file
+            self._files_item.addChild(item)
+            self._file_count += 1
+            self._file_characters += len(text)
+        else:
+            self.outline.addTopLevelItem(item)
+            if title == "File Contents":
+                self._files_item = item
+                self._file_characters = len(text)
+                item.setExpanded(True)
+        self._items[title] = item
+
+    def _update_files_item(self):
+        item = self._files_item
+        if item is None:
+            return
+        # The heading's row adds up the files below it
+        item.setText(self.SIZE_COLUMN, f"{self._file_characters:,}")
+        if "File Contents" in self._tokens:
+            tokens = self._tokens["File Contents"] + sum(
+                self._tokens.get(item.child(row).text(self.SECTION_COLUMN), 0)
+                for row in range(item.childCount()))
+            item.setText(self.TOKENS_COLUMN, f"{tokens:,}")
+
+    def _resize_columns(self):
+        # Sizing to contents on every added row would measure all rows each time
+        for column in (self.SIZE_COLUMN, self.TOKENS_COLUMN):
+            self.outline.resizeColumnToContents(column)
+
+    def _update_summary(self):
+        parts = [f"{self._file_count} file(s)", f"{self._characters:,} characters"]
+        if self._token_total:
+            parts.append(f"{self._token_total:,} tokens")
+        if self._queue:
+            parts.append("loading...")
+        self.summary_label.setText(" | ".join(parts) if self._items else "")
+
+    def _on_item_clicked(self, item, column):
+        position = item.data(self.SECTION_COLUMN, Qt.ItemDataRole.UserRole)
+        if position is None:
+            return
+        cursor = QTextCursor(self.text.document().findBlock(position))
+        # Scrolling to the end first makes the cursor land on the top line
+        scroll_bar = self.text.verticalScrollBar()
+        scroll_bar.setValue(scroll_bar.maximum())
+        self.text.setTextCursor(cursor)
+        self.text.ensureCursorVisible()
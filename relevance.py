@@ -0,0 +1,225 @@
+import os
+import re
+import json
+import gzip
+import math
+import hashlib
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from utils import get_cache_dir
+
+
+VERSION = 1
+
+# Larger files are indexed by name only
+MAX_FILE_BYTES = 1024 * 1024
+
+# Below this many files to read, a process pool costs more than it saves
+PROCESS_POOL_MIN_FILES = 200
+
+# Files handed to the pool at a time, between checks for cancellation
+_BATCH = 256
+
+# Words of the file path count this many times in its term frequencies
+PATH_WEIGHT = 2
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_IDENTIFIERS = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+_WORD_PARTS = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+")
+
+STOPWORDS = frozenset("""
+    a an and are as at be but by can do does for from has have if in is it its
+    no not of on or so that the then there this to was we were when where which
+    while will with after before should would could my our you your me i
+""".split())
+
+
+def tokenize(text):
+    """Term counts of a text: lowercased identifiers and their camelCase and
+    snake_case parts, without stopwords and one-letter words"""
+    counts = Counter()
+    for identifier, count in Counter(_IDENTIFIERS.findall(text)).items():
+        word = identifier.lower()
+        if len(word) > 1 and word not in STOPWORDS:
+            counts[word] += count
+        parts = _WORD_PARTS.findall(identifier)
+        if len(parts) > 1:
+            for part in parts:
+                part = part.lower()
+                if len(part) > 1 and part != word and part not in STOPWORDS:
+                    counts[part] += count
+    return counts
+
+
+def index_file(path):
+    """(size, mtime_ns, term counts) of a file, or None if it cannot be read.
+
+    Binary files and files over MAX_FILE_BYTES get empty counts, so they
+    are recorded as seen and not read again until they change.
+    """
+    try:
+        st = os.stat(path)
+        if st.st_size > MAX_FILE_BYTES:
+            return st.st_size, st.st_mtime_ns, {}
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if b"\0" in data[:8192]:
+        return st.st_size, st.st_mtime_ns, {}
+    return st.st_size, st.st_mtime_ns, dict(tokenize(data.decode("utf-8", "ignore")))
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def open_pool(count, max_workers=None):
+    """Executor for reading count files: worker processes for many, else threads"""
+    if count >= PROCESS_POOL_MIN_FILES:
+        try:
+            # spawn, since forking a process that runs Qt threads is unsafe
+            return ProcessPoolExecutor(
+                max_workers, mp_context=multiprocessing.get_context("spawn"))
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not start worker processes: {str(e)}")
+    return ThreadPoolExecutor(max_workers)
+
+
+def fulltext_path(root_path):
+    """Cache file of the full-text index of a root folder"""
+    key = hashlib.sha1(os.path.normcase(os.path.abspath(root_path))
+                       .encode("utf-8", "surrogateescape")).hexdigest()
+    return os.path.join(get_cache_dir(), "fulltext", key + ".json.gz")
+
+
+class RelevanceIndex:
+    """Full-text BM25 index of the files of a project, persisted per root.
+
+    Every file keeps its size, mtime and term counts, so update() only
+    reads the files that changed since the index was last saved. Searches
+    use inverted postings rebuilt at the end of each update; they are
+    swapped in whole, so suggest() can run while another thread updates.
+    """
+
+    def __init__(self, root_path):
+        self.root_path = root_path
+        # rel_path ("/" separated) -> [size, mtime_ns, {term: count}]
+        self.docs = {}
+        self._search = ([], {}, [], 1.0)
+
+    def load(self, path=None):
+        """Read the saved index; returns False if missing or unusable"""
+        path = path or fulltext_path(self.root_path)
+        try:
+            with gzip.open(path, 'rt', encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, EOFError, ValueError):
+            return False
+        if data.get("version") != VERSION or data.get("root_path") != self.root_path:
+            return False
+        self.docs = data.get("docs", {})
+        self._build_postings()
+        return True
+
+    def save(self, path=None):
+        path = path or fulltext_path(self.root_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, 'wt', encoding="utf-8", compresslevel=1) as f:
+            json.dump({"version": VERSION, "root_path": self.root_path,
+                       "docs": self.docs}, f)
+        os.replace(tmp_path, path)
+
+    def update(self, project_index, max_workers=None, cancel=None, progress=None):
+        """Re-read the files of project_index that are new or changed.
+
+        progress is called with (files_done, files_total). Returns True if
+        the index changed, False if nothing did or it was cancelled.
+        """
+        files = {project_index.rel_path(file_id, "/"): project_index.path(file_id)
+                 for file_id in project_index.iter_files()}
+        removed = [rel_path for rel_path in self.docs if rel_path not in files]
+        for rel_path in removed:
+            del self.docs[rel_path]
+
+        rel_paths = list(files)
+        with ThreadPoolExecutor(max_workers) as pool:
+            stats = list(pool.map(_stat, (files[rel_path] for rel_path in rel_paths)))
+        changed = [rel_path for rel_path, st in zip(rel_paths, stats)
+                   if st is not None and tuple(self.docs.get(rel_path, (None, None))[:2]) != st]
+        if cancel is not None and cancel.is_set():
+            return False
+
+        pool = open_pool(len(changed), max_workers)
+        try:
+            for start in range(0, len(changed), _BATCH):
+                if cancel is not None and cancel.is_set():
+                    return False
+                batch = changed[start:start + _BATCH]
+                paths = [files[rel_path] for rel_path in batch]
+                try:
+                    results = list(pool.map(index_file, paths, chunksize=16))
+                except BrokenProcessPool as e:
+                    print(f"Warning: Indexing in worker processes failed, "
+                          f"using threads: {str(e)}")
+                    pool.shutdown()
+                    pool = ThreadPoolExecutor(max_workers)
+                    results = list(pool.map(index_file, paths))
+                for rel_path, result in zip(batch, results):
+                    if result is None:
+                        self.docs.pop(rel_path, None)
+                        continue
+                    size, mtime, counts = result
+                    for word, count in tokenize(rel_path).items():
+                        counts[word] = counts.get(word, 0) + count * PATH_WEIGHT
+                    self.docs[rel_path] = [size, mtime, counts]
+                if progress is not None:
+                    progress(start + len(batch), len(changed))
+        finally:
+            pool.shutdown()
+
+        if not changed and not removed:
+            return False
+        self._build_postings()
+        return True
+
+    def _build_postings(self):
+        rel_paths = list(self.docs)
+        postings = {}
+        lengths = []
+        for doc_id, rel_path in enumerate(rel_paths):
+            counts = self.docs[rel_path][2]
+            lengths.append(sum(counts.values()))
+            for word, count in counts.items():
+                posting = postings.get(word)
+                if posting is None:
+                    postings[word] = {doc_id: count}
+                else:
+                    posting[doc_id] = count
+        average = sum(lengths) / len(lengths) if lengths else 1.0
+        self._search = (rel_paths, postings, lengths, average or 1.0)
+
+    def suggest(self, text, limit=20):
+        """(rel_path, score) of the files that best match text, best first"""
+        rel_paths, postings, lengths, average = self._search
+        total = len(rel_paths)
+        scores = Counter()
+        for word in tokenize(text):
+            posting = postings.get(word)
+            if not posting:
+                continue
+            idf = math.log(1 + (total - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, count in posting.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[doc_id] / average)
+                scores[doc_id] += idf * count * (BM25_K1 + 1) / (count + norm)
+        return [(rel_paths[doc_id], score) for doc_id, score in scores.most_common(limit)]
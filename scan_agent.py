@@ -0,0 +1,464 @@
+"""Scan agent: lists folders and reads files next to them for a remote app.
+
+Usage: python main.py agent [--listen 127.0.0.1:8765 | --listen unix:/path]
+                            [--root DIR ...] [--token SECRET]
+
+Run it where the files are, such as inside WSL, and point the scan_agent
+setting of the app at the same address. Every folder listing and file
+read over a WSL or network share costs round trips; the agent does them
+on its local disk instead and sends the results back in batches, each
+frame zlib-compressed JSON behind a 4-byte length.
+
+Only folders below a --root (default: the home folder) are served, and
+paths that resolve outside them, such as through a symlink, are refused.
+It listens on the loopback address by default. Clients must send the
+--token secret; without one, a random token is generated and printed at
+start-up, for the scan_agent_token setting.
+
+This module must not import PyQt, so it runs on a box without a display.
+"""
+import os
+import sys
+import hmac
+import json
+import secrets
+import zlib
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+
+from indexer import ExclusionRules, GitIgnore, scan_directory
+from file_ingest import SizeCap
+from content_cache import ContentCache
+from prompt_builder import read_capped
+
+
+PROTOCOL = 1
+DEFAULT_ADDRESS = "127.0.0.1:8765"
+CONNECT_TIMEOUT = 2.0
+# A request that sends nothing back for this long is taken as a dead agent
+REPLY_TIMEOUT = 120.0
+
+# Frames are sent once they hold this many entries or bytes of content
+_BATCH_ENTRIES = 4096
+_BATCH_BYTES = 1024 * 1024
+_MAX_FRAME = 256 * 1024 * 1024
+# Until a connection has opened a root with the token, frames stay this small
+_MAX_OPEN_FRAME = 64 * 1024
+_LENGTH = struct.Struct(">I")
+
+
+class AgentError(OSError):
+    """The agent could not be reached or failed a request"""
+
+
+def parse_address(address):
+    """(family, address) of "host:port", "[ipv6]:port" or "unix:/path" """
+    if address.startswith("unix:"):
+        if not hasattr(socket, "AF_UNIX"):
+            raise AgentError("Unix sockets are not supported on this platform")
+        return socket.AF_UNIX, address[5:]
+    host, _, port = address.rpartition(":")
+    if not port.isdigit():
+        raise AgentError(f"Invalid scan agent address: {address!r}")
+    host = host.strip("[]") or "127.0.0.1"
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    return family, (host, int(port))
+
+
+def send_frame(sock, message):
+    data = zlib.compress(json.dumps(message, separators=(",", ":")).encode("ascii"), 1)
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+def _receive(sock, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise AgentError("Connection closed by the other side")
+        received += count
+    return data
+
+
+def receive_frame(sock, max_size=_MAX_FRAME):
+    """Next message; its frame may hold at most max_size bytes, compressed
+    and once decompressed"""
+    (size,) = _LENGTH.unpack(_receive(sock, _LENGTH.size))
+    if size > max_size:
+        raise AgentError(f"Frame of {size} bytes is too large")
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(_receive(sock, size), max_size)
+        if decompressor.unconsumed_tail:
+            raise AgentError(f"Frame is larger than {max_size} bytes once decompressed")
+        if not decompressor.eof:
+            raise AgentError("Malformed frame: incomplete compressed data")
+        return json.loads(data)
+    except (zlib.error, ValueError) as e:
+        raise AgentError(f"Malformed frame: {str(e)}")
+
+
+def local_root(root_path):
+    """Path on the agent's side of a root folder as the app names it; WSL
+    shares such as \\\\wsl.localhost\\Ubuntu\\home\\me become /home/me"""
+    normalized = root_path.replace("\\", "/")
+    for share in ("//wsl.localhost/", "//wsl$/"):
+        if normalized.lower().startswith(share):
+            distribution_path = normalized[len(share):]
+            return "/" + distribution_path.partition("/")[2]
+    return root_path
+
+
+class _RequestError(Exception):
+    pass
+
+
+class _OutsideRoots(_RequestError):
+    pass
+
+
+class AgentSession:
+    """Requests of one connection, against the root folder it opened"""
+
+    def __init__(self, roots, token, cache=None):
+        self.roots = roots
+        self.token = token
+        self.cache = cache
+        self.root_path = None
+        self.rules = None
+
+    def handle(self, request):
+        """Yield the reply frames of a request; the last one has "done" set"""
+        op = request.get("op")
+        if op == "open":
+            yield self._open(request)
+        elif self.root_path is None:
+            raise _RequestError("No root folder is open")
+        elif op == "walk":
+            yield from self._walk(request["dirs"], request.get("recursive", True))
+        elif op == "mtimes":
+            yield {"done": True, "mtimes": [self._mtime(rel_dir)
+                                            for rel_dir in request["dirs"]]}
+        elif op == "read":
+            yield from self._read(request["paths"], request.get("max_file_bytes"),
+                                  request.get("max_total_bytes"))
+        else:
+            raise _RequestError(f"Unknown request: {op!r}")
+
+    def _open(self, request):
+        if request.get("protocol") != PROTOCOL:
+            raise _RequestError(f"Protocol {request.get('protocol')} is not supported, "
+                                f"the agent speaks {PROTOCOL}")
+        if not hmac.compare_digest(
+                str(request.get("token") or "").encode("utf-8"), self.token.encode("utf-8")):
+            raise _RequestError("Wrong token")
+        root_path = os.path.realpath(local_root(request["root"]))
+        if not self._is_served(root_path):
+            raise _RequestError(f"{root_path} is not below a folder the agent serves")
+        if not os.path.isdir(root_path):
+            raise _RequestError(f"Root folder not found: {root_path}")
+        self.root_path = root_path
+        self.rules = ExclusionRules.from_settings(request.get("rules", {}))
+        return {"done": True, "root": root_path}
+
+    def _is_served(self, path):
+        """Whether the real path of path is below one of the served roots"""
+        real_path = os.path.realpath(path)
+        for root in self.roots:
+            try:
+                if os.path.commonpath([real_path, root]) == root:
+                    return True
+            except ValueError:
+                # On another drive
+                continue
+        return False
+
+    def _path(self, rel_path):
+        parts = [part for part in rel_path.split("/") if part not in ("", ".")]
+        if ".." in parts:
+            raise _RequestError(f"Path outside the root folder: {rel_path!r}")
+        path = os.path.join(self.root_path, *parts)
+        # A symlink below the root may point anywhere
+        if not self._is_served(path):
+            raise _OutsideRoots(f"Path outside the folders the agent serves: {rel_path!r}")
+        return path
+
+    def _mtime(self, rel_dir):
+        try:
+            return os.stat(self._path(rel_dir)).st_mtime_ns
+        except (OSError, _OutsideRoots):
+            return None
+
+    def _walk(self, dirs, recursive):
+        """Listings of folders as [rel_dir, mtime, entries, .gitignore lines],
+        each folder before the ones below it; mtime is None for a folder
+        that is gone"""
+        stack = [(rel_dir, [GitIgnore(base, lines) for base, lines in chain or ()])
+                 for rel_dir, chain in reversed(dirs)]
+        batch, entry_count = [], 0
+        while stack:
+            rel_dir, ignores = stack.pop()
+            try:
+                path = self._path(rel_dir)
+                mtime = os.stat(path).st_mtime_ns
+            except (OSError, _OutsideRoots):
+                # Listed as gone, like a folder deleted meanwhile
+                batch.append([rel_dir, None, [], None])
+                continue
+            entries, own_ignore = scan_directory(path, rel_dir, self.rules, ignores)
+            batch.append([rel_dir, mtime, entries,
+                          own_ignore.lines if own_ignore is not None else None])
+            entry_count += len(entries) + 1
+            if recursive:
+                chain = ignores + [own_ignore] if own_ignore is not None else ignores
+                prefix = rel_dir + "/" if rel_dir else ""
+                stack.extend((prefix + name, chain)
+                             for name, is_dir, _ in reversed(entries) if is_dir)
+            if entry_count >= _BATCH_ENTRIES:
+                yield {"batch": batch}
+                batch, entry_count = [], 0
+        yield {"batch": batch, "done": True}
+
+    def _read(self, rel_paths, max_file_bytes, max_total_bytes):
+        """Prompt contents of files as [rel_path, content, total bytes used],
+        capped as PromptBuilder caps the files it reads itself"""
+        size_cap = SizeCap(max_file_bytes, max_total_bytes)
+        batch, batch_bytes = [], 0
+        for rel_path in rel_paths:
+            try:
+                path = self._path(rel_path)
+            except _OutsideRoots as e:
+                batch.append([rel_path, f"[Error reading file: {str(e)}]", size_cap.used])
+                continue
+            content = read_capped(path, size_cap.limit(path), max_total_bytes, self.cache)
+            # None for a file that no longer exists, which the app leaves out
+            batch.append([rel_path, content, size_cap.used])
+            batch_bytes += len(content or "")
+            if batch_bytes >= _BATCH_BYTES:
+                yield {"batch": batch}
+                batch, batch_bytes = [], 0
+        yield {"batch": batch, "done": True}
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        session = AgentSession(server.roots, server.token, server.cache)
+        sock = self.request
+        if sock.family != getattr(socket, "AF_UNIX", None):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                request = receive_frame(
+                    sock, _MAX_OPEN_FRAME if session.root_path is None else _MAX_FRAME)
+                try:
+                    for reply in session.handle(request):
+                        send_frame(sock, reply)
+                except (_RequestError, KeyError, TypeError, ValueError) as e:
+                    send_frame(sock, {"error": str(e) or type(e).__name__})
+        except OSError:
+            # The app closed the connection, possibly in the middle of a reply
+            return
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _TCP6Server(_TCPServer):
+    address_family = socket.AF_INET6
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def create_server(address, roots, token, cache_mb=64):
+    """Agent server listening on address; serve_forever() runs it"""
+    if not token:
+        raise AgentError("A token is required, so that other local users "
+                         "cannot read the files")
+    family, target = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(target):
+            os.unlink(target)
+        server = _UnixServer(target, _Handler)
+    elif family == socket.AF_INET6:
+        server = _TCP6Server(target, _Handler)
+    else:
+        server = _TCPServer(target, _Handler)
+    server.roots = [os.path.realpath(root) for root in roots]
+    server.token = token
+    server.cache = ContentCache(cache_mb * 1024 * 1024) if cache_mb > 0 else None
+    return server
+
+
+class AgentClient:
+    """Connection to a scan agent for one root folder.
+
+    Requests from several threads each get a connection of their own from
+    a small pool. Any failure raises AgentError, an OSError, so callers
+    can fall back to reading the disk directly.
+    """
+
+    def __init__(self, address, root_path, rules, token=None):
+        self.address = address
+        self.root_path = root_path
+        self.rules = rules
+        self.token = token
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, address, root_path, rules, token=None):
+        """Client with an open connection; raises AgentError if the agent
+        cannot be reached or does not serve root_path"""
+        client = cls(address, root_path, rules, token)
+        client._idle.append(client._connect())
+        return client
+
+    def _connect(self):
+        family, target = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(target)
+            if family != getattr(socket, "AF_UNIX", None):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.settimeout(REPLY_TIMEOUT)
+            send_frame(sock, {"op": "open", "protocol": PROTOCOL, "root": self.root_path,
+                              "rules": self.rules.to_settings(), "token": self.token})
+            reply = receive_frame(sock)
+        except OSError as e:
+            sock.close()
+            raise AgentError(f"Could not reach the scan agent at {self.address}: {str(e)}")
+        if "error" in reply:
+            sock.close()
+            raise AgentError(f"Scan agent refused {self.root_path}: {reply['error']}")
+        return sock
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for sock in idle:
+            sock.close()
+
+    def _request(self, message):
+        """Yield the reply frames of a request"""
+        with self._lock:
+            sock = self._idle.pop() if self._idle else None
+        if sock is None:
+            sock = self._connect()
+        finished = False
+        try:
+            send_frame(sock, message)
+            while not finished:
+                reply = receive_frame(sock)
+                finished = bool(reply.get("done")) or "error" in reply
+                if "error" in reply:
+                    raise AgentError(f"Scan agent failed: {reply['error']}")
+                yield reply
+        except AgentError:
+            raise
+        except OSError as e:
+            raise AgentError(f"Lost the scan agent at {self.address}: {str(e)}")
+        finally:
+            if finished:
+                with self._lock:
+                    self._idle.append(sock)
+            else:
+                # Closed in the middle of a reply, so the rest of it is still on the way
+                sock.close()
+
+    def walk(self, dirs, recursive=True):
+        """Yield (rel_dir, mtime, entries, ignore) for folders given as
+        (rel_dir, [(base, lines) of the .gitignore files above]) and, if
+        recursive, every folder below them; mtime is None for a missing
+        folder"""
+        for reply in self._request({"op": "walk", "dirs": dirs, "recursive": recursive}):
+            for rel_dir, mtime, entries, lines in reply["batch"]:
+                ignore = GitIgnore(rel_dir, lines) if lines is not None else None
+                yield rel_dir, mtime, [tuple(entry) for entry in entries], ignore
+
+    def mtimes(self, rel_dirs):
+        """mtime_ns of folders, None for missing ones"""
+        for reply in self._request({"op": "mtimes", "dirs": rel_dirs}):
+            return reply["mtimes"]
+
+    def read_files(self, paths, max_file_bytes=None, max_total_bytes=None):
+        """Yield (path, content, total bytes used) for files below the root
+        in order, read and capped as PromptBuilder reads files itself"""
+        rel_paths = [os.path.relpath(path, self.root_path).replace(os.sep, "/")
+                     for path in paths]
+        if not rel_paths:
+            return
+        replies = self._request({"op": "read", "paths": rel_paths,
+                                 "max_file_bytes": max_file_bytes,
+                                 "max_total_bytes": max_total_bytes})
+        remaining = iter(paths)
+        for reply in replies:
+            for _, content, used in reply["batch"]:
+                yield next(remaining), content, used
+
+
+def connect_agent(settings, root_path, rules):
+    """AgentClient for root_path if the scan_agent setting names one,
+    None if it does not or the agent cannot be reached"""
+    address = settings.get("scan_agent", "")
+    if not address:
+        return None
+    try:
+        return AgentClient.connect(address, root_path, rules,
+                                   settings.get("scan_agent_token") or None)
+    except AgentError as e:
+        print(f"Warning: {str(e)}; reading the disk directly")
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="main.py agent",
+        description="List folders and read files for the app over a socket.")
+    parser.add_argument("--listen", default=DEFAULT_ADDRESS,
+                        help=f"host:port or unix:/path (default: {DEFAULT_ADDRESS})")
+    parser.add_argument("--root", action="append",
+                        help="serve root folders below this one (repeatable, "
+                             "default: the home folder)")
+    parser.add_argument("--token", default=os.environ.get("SCAN_AGENT_TOKEN"),
+                        help="secret the app must send (default: $SCAN_AGENT_TOKEN, "
+                             "or a generated one that is printed)")
+    parser.add_argument("--cache-mb", type=int, default=64,
+                        help="memory for keeping file contents between requests")
+    args = parser.parse_args(argv)
+
+    roots = args.root or [os.path.expanduser("~")]
+    token = args.token
+    if not token:
+        token = secrets.token_urlsafe(24)
+        print(f"Generated token: {token}\nSet \"scan_agent_token\": \"{token}\" "
+              f"in settings.json, or pass --token to reuse a secret", file=sys.stderr)
+    try:
+        server = create_server(args.listen, roots, token, args.cache_mb)
+    except (OSError, AgentError) as e:
+        print(f"Error: Could not listen on {args.listen}: {str(e)}", file=sys.stderr)
+        return 1
+    print(f"Scan agent listening on {args.listen}, serving {', '.join(server.roots)}",
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+from array import array
+
+from indexer import ProjectIndex
+
+
+UNCHECKED = 0
+PARTIAL = 1
+CHECKED = 2
+
+
+class FileSelection:
+    """Tri-state file selection over a ProjectIndex.
+
+    Every folder keeps how many files below it are selected and, once its
+    subtree is indexed, how many files it holds in total, so a folder's
+    state is a comparison of two counters. Checking a folder touches its
+    subtree once and its ancestors once each (O(depth)). The selected
+    file ids are kept in selection order, so listing them is O(k), and
+    their total size is kept up to date as well.
+    """
+
+    def __init__(self, project_index):
+        self.project_index = project_index
+        self.selected_counts = array('i')
+        # Files below a folder, -1 while part of its subtree is not indexed
+        self.file_counts = array('i')
+        # Selected file ids in selection order; a dict is an ordered set
+        self._selected = {}
+        self.selected_bytes = 0
+
+    def __len__(self):
+        return len(self._selected)
+
+    def _grow(self):
+        missing = len(self.project_index) - len(self.selected_counts)
+        if missing > 0:
+            self.selected_counts.extend(array('i', [0]) * missing)
+            self.file_counts.extend(array('i', [-1]) * missing)
+
+    def selected_ids(self):
+        return list(self._selected)
+
+    def is_selected(self, entry_id):
+        return entry_id in self._selected
+
+    def state(self, entry_id):
+        if not self.project_index.is_dir(entry_id):
+            return CHECKED if entry_id in self._selected else UNCHECKED
+        self._grow()
+        selected = self.selected_counts[entry_id]
+        if selected == 0:
+            return UNCHECKED
+        return CHECKED if selected == self.file_counts[entry_id] else PARTIAL
+
+    def count_files(self, entry_id=ProjectIndex.ROOT):
+        """Fill in the file totals of every folder below an entry"""
+        self._grow()
+        project_index = self.project_index
+        for folder in reversed(project_index.listed_directories(entry_id)):
+            self.file_counts[folder] = self._sum_children(folder)
+        # Folders above may have waited for this subtree only
+        folder = entry_id
+        parent = project_index.parent(folder)
+        while parent >= 0 and self.file_counts[parent] < 0 and self.file_counts[folder] >= 0:
+            self.file_counts[parent] = self._sum_children(parent)
+            folder, parent = parent, project_index.parent(parent)
+        return self.file_counts[entry_id]
+
+    def _sum_children(self, folder):
+        """Files below a folder from its children's totals, -1 if one is unknown"""
+        project_index = self.project_index
+        total = 0
+        for child in project_index.children(folder):
+            if not project_index.is_dir(child):
+                total += 1
+            elif not project_index.is_listed(child) or self.file_counts[child] < 0:
+                return -1
+            else:
+                total += self.file_counts[child]
+        return total
+
+    def set_checked(self, entry_id, checked):
+        project_index = self.project_index
+        if not project_index.is_dir(entry_id):
+            if checked == (entry_id in self._selected):
+                return
+            if checked:
+                self._selected[entry_id] = None
+                self.selected_bytes += project_index.size(entry_id)
+            else:
+                del self._selected[entry_id]
+                self.selected_bytes -= project_index.size(entry_id)
+            self._grow()
+            self._add_to_ancestors(project_index.parent(entry_id), 1 if checked else -1)
+            return
+
+        # The whole subtree has to be known to select it; selected files
+        # are always in listed folders, so unchecking needs no listing
+        if checked:
+            project_index.expand(entry_id)
+        self.count_files(entry_id)
+        delta = 0
+        for file_id in project_index.iter_files(entry_id):
+            if checked and file_id not in self._selected:
+                self._selected[file_id] = None
+                self.selected_bytes += project_index.size(file_id)
+                delta += 1
+            elif not checked and file_id in self._selected:
+                del self._selected[file_id]
+                self.selected_bytes -= project_index.size(file_id)
+                delta -= 1
+        for folder in project_index.listed_directories(entry_id):
+            self.selected_counts[folder] = self.file_counts[folder] if checked else 0
+        self._add_to_ancestors(project_index.parent(entry_id), delta)
+
+    def update_sizes(self, sizes):
+        """Store {file_id: size} read from disk in the index, keeping the
+        selected total in step"""
+        project_index = self.project_index
+        for file_id, size in sizes.items():
+            if file_id in self._selected:
+                self.selected_bytes += size - project_index.size(file_id)
+            project_index.set_size(file_id, size)
+
+    def clear(self):
+        self._selected.clear()
+        self.selected_bytes = 0
+        self.selected_counts = array('i', [0]) * len(self.selected_counts)
+
+    def _add_to_ancestors(self, entry_id, delta):
+        if not delta:
+            return
+        while entry_id >= 0:
+            self.selected_counts[entry_id] += delta
+            entry_id = self.project_index.parent(entry_id)
+
+    def listing_replaced(self, entry_id, old_children, moved, was_checked):
+        """Carry the selection over after ProjectIndex.replace_listing().
+
+        old_children are the ids the folder had before, moved is the map
+        returned by replace_listing and was_checked the folder's state
+        before; a fully checked folder also checks its new files. Returns
+        its new folders, which still have to be listed to be checked, so
+        the caller can check them without blocking.
+        """
+        self._grow()
+        project_index = self.project_index
+        delta = 0
+        dropped = set()
+        for old_id in old_children:
+            new_id = moved.get(old_id)
+            if project_index.is_dir(old_id):
+                if new_id is None:
+                    delta -= self.selected_counts[old_id]
+                    if self.selected_counts[old_id]:
+                        dropped.update(file_id for file_id in project_index.iter_files(old_id)
+                                       if file_id in self._selected)
+                else:
+                    self.selected_counts[new_id] = self.selected_counts[old_id]
+                    self.file_counts[new_id] = self.file_counts[old_id]
+                    self.selected_counts[old_id] = 0
+            elif old_id in self._selected:
+                if new_id is None:
+                    dropped.add(old_id)
+                    delta -= 1
+                else:
+                    # The file may have changed size as well
+                    self.selected_bytes += project_index.size(new_id) - project_index.size(old_id)
+
+        self.selected_bytes -= sum(project_index.size(file_id) for file_id in dropped)
+        if dropped or moved:
+            self._selected = {moved.get(file_id, file_id): None
+                              for file_id in self._selected if file_id not in dropped}
+        self._add_to_ancestors(entry_id, delta)
+        self._refresh_total(entry_id)
+
+        new_folders = []
+        if was_checked:
+            matched = set(moved.values())
+            for child in project_index.children(entry_id):
+                if child in matched:
+                    continue
+                if project_index.is_dir(child):
+                    new_folders.append(child)
+                else:
+                    self.set_checked(child, True)
+        return new_folders
+
+    def _refresh_total(self, entry_id):
+        project_index = self.project_index
+        old_total = self.file_counts[entry_id]
+        total = 0
+        for child in project_index.children(entry_id):
+            if not project_index.is_dir(child):
+                total += 1
+            elif not project_index.is_listed(child) or self.file_counts[child] < 0:
+                total = -1
+                break
+            else:
+                total += self.file_counts[child]
+        self.file_counts[entry_id] = total
+
+        # Ancestors move by the same amount, or become unknown as well
+        parent = project_index.parent(entry_id)
+        while parent >= 0:
+            if total < 0 or old_total < 0 or self.file_counts[parent] < 0:
+                self.file_counts[parent] = -1
+            else:
+                self.file_counts[parent] += total - old_total
+            parent = project_index.parent(parent)
@@ -0,0 +1,109 @@
+import re
+
+
+# Each pattern yields a path (or Java class and file) and a line number
+_PYTHON = re.compile(r'File "(?P<path>[^"\n]+)", line (?P<line>\d+)')
+_JAVA = re.compile(
+    r"at (?P<qualified>[\w$.]+)\.[\w$<>]+\((?P<file>[\w$-]+\.(?:java|kt|scala|groovy)):(?P<line>\d+)\)")
+_DOTNET = re.compile(r" in (?P<path>[^\n]+?\.(?:cs|vb|fs)):line (?P<line>\d+)")
+_JAVASCRIPT = re.compile(
+    r"(?:\(|@|at )(?:[a-z-]+:/+)?(?P<path>[^\s()@:]*[^\s()@]+?\.(?:js|jsx|ts|tsx|mjs|cjs|vue))"
+    r":(?P<line>\d+)(?::\d+)?\)?")
+
+
+def parse_frames(text):
+    """(path, line) of every stack frame in text, first occurrence order.
+
+    Understands Python tracebacks, Java/Kotlin stack traces (the path is
+    derived from the package of the class), JavaScript/TypeScript traces
+    from V8 and Firefox, and .NET traces with line information. Paths are
+    returned with forward slashes.
+    """
+    found = []
+    for pattern in (_PYTHON, _DOTNET, _JAVASCRIPT):
+        for match in pattern.finditer(text):
+            found.append((match.start(), match.group("path"), int(match.group("line"))))
+    for match in _JAVA.finditer(text):
+        package = match.group("qualified").split("$")[0].rsplit(".", 1)[0]
+        path = package.replace(".", "/") + "/" + match.group("file")
+        found.append((match.start(), path, int(match.group("line"))))
+
+    frames = []
+    seen = set()
+    for _, path, line in sorted(found):
+        frame = (path.replace("\\", "/"), line)
+        if frame not in seen:
+            seen.add(frame)
+            frames.append(frame)
+    return frames
+
+
+class FrameResolver:
+    """Finds the project files that stack frame paths point to.
+
+    Frames often come from another machine or a build folder, so a path
+    is matched by its longest common suffix of folder names with the
+    indexed files of the same name. A frame that matches only by file
+    name, with several files of that name, is left unresolved; on deeper
+    ties the first file in tree order wins.
+    """
+
+    def __init__(self, project_index):
+        self.project_index = project_index
+        self._key = None
+        self._by_name = {}
+
+    def _files_by_name(self):
+        key = (self.project_index.generation, len(self.project_index))
+        if key != self._key:
+            by_name = {}
+            for file_id in self.project_index.iter_files():
+                by_name.setdefault(self.project_index.name(file_id).lower(),
+                                   []).append(file_id)
+            self._by_name = by_name
+            self._key = key
+        return self._by_name
+
+    def resolve(self, path):
+        """Entry id of the file a frame path refers to, or -1"""
+        parts = [part.lower() for part in path.replace("\\", "/").split("/") if part]
+        if not parts:
+            return -1
+        candidates = self._files_by_name().get(parts[-1], [])
+        best, best_depth, tied = -1, 0, False
+        for file_id in candidates:
+            if self.project_index.is_removed(file_id):
+                continue
+            rel_parts = self.project_index.rel_path(file_id, "/").lower().split("/")
+            depth = 0
+            while (depth < len(parts) and depth < len(rel_parts)
+                   and parts[-1 - depth] == rel_parts[-1 - depth]):
+                depth += 1
+            if depth > best_depth:
+                best, best_depth, tied = file_id, depth, False
+            elif depth == best_depth:
+                tied = True
+        if tied and best_depth < 2:
+            return -1
+        return best
+
+    def resolve_frames(self, frames):
+        """{entry id: [line, ...]} of the frames that resolve to a project file"""
+        lines = {}
+        for path, line in frames:
+            file_id = self.resolve(path)
+            if file_id >= 0:
+                lines.setdefault(file_id, []).append(line)
+        return lines
+
+
+def merge_windows(lines, context):
+    """Sorted, non-overlapping (first, last) line ranges around each line"""
+    windows = []
+    for line in sorted(set(lines)):
+        first, last = max(1, line - context), line + context
+        if windows and first <= windows[-1][1] + 1:
+            windows[-1] = (windows[-1][0], max(windows[-1][1], last))
+        else:
+            windows.append((first, last))
+    return windows
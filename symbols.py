@@ -0,0 +1,195 @@
+import os
+import ast
+import threading
+import warnings
+from collections import OrderedDict
+
+from file_ingest import load_text
+
+
+# A symbol is (qualname, kind, first_line, header_last_line, last_line, references):
+# kind is "class" or "def", the header runs from the first decorator to the
+# end of the signature, and references are the names used in a function
+# body, with a leading "." for attributes of self or cls.
+QUALNAME, KIND, FIRST_LINE, HEADER_END, LAST_LINE, REFERENCES = range(6)
+
+# extension -> parser(text) returning the symbols of a file in source order
+_PARSERS = {}
+
+
+def register_parser(extensions, parser):
+    """Use parser(text) for the symbol tables of files with these extensions.
+
+    The parser returns symbol tuples in source order, with members
+    following their class and lines counted from 1. A file it cannot
+    parse has no symbols.
+    """
+    for extension in extensions:
+        _PARSERS[extension.lower()] = parser
+
+
+def has_parser(path):
+    return os.path.splitext(path)[1].lower() in _PARSERS
+
+
+def python_symbols(text):
+    """Symbols of Python source: classes, functions and methods, without
+    the functions nested inside functions"""
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return []
+    lines = text.split("\n")
+    symbols = []
+
+    def visit(nodes, prefix):
+        for node in nodes:
+            if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                continue
+            qualname = prefix + node.name
+            first_line = min([node.lineno] + [decorator.lineno
+                                              for decorator in node.decorator_list])
+            header_end = max(node.lineno, node.body[0].lineno - 1)
+            # Comments between the signature and the body are not part of it
+            while header_end > node.lineno and lines[header_end - 1].lstrip()[:1] in ("#", ""):
+                header_end -= 1
+            if isinstance(node, ast.ClassDef):
+                symbols.append((qualname, "class", first_line, header_end,
+                                node.end_lineno, ()))
+                visit(node.body, qualname + ".")
+                continue
+            references = set()
+            for statement in node.body:
+                for child in ast.walk(statement):
+                    if isinstance(child, ast.Name):
+                        references.add(child.id)
+                    elif (isinstance(child, ast.Attribute)
+                          and isinstance(child.value, ast.Name)
+                          and child.value.id in ("self", "cls")):
+                        references.add("." + child.attr)
+            symbols.append((qualname, "def", first_line, header_end,
+                            node.end_lineno, tuple(sorted(references))))
+
+    visit(tree.body, "")
+    return symbols
+
+
+register_parser((".py", ".pyw", ".pyi"), python_symbols)
+
+
+def symbol_table(path, text=None):
+    """Symbols of a file, or [] if no parser handles its extension"""
+    parser = _PARSERS.get(os.path.splitext(path)[1].lower())
+    if parser is None:
+        return []
+    if text is None:
+        text = load_text(path)
+    return parser(text)
+
+
+class SymbolCache:
+    """LRU cache of symbol tables, validated by size and mtime like the
+    content cache, so a symbol picker opens without parsing again"""
+
+    def __init__(self, max_files=1000):
+        self.max_files = max_files
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, text=None):
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime_ns)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == key:
+                self._entries.move_to_end(path)
+                return entry[1]
+
+        symbols = symbol_table(path, text)
+        with self._lock:
+            self._entries[path] = (key, symbols)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_files:
+                self._entries.popitem(last=False)
+        return symbols
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _referenced(by_name, symbol):
+    """Qualnames of the symbols of the same file a function refers to"""
+    prefix = symbol[QUALNAME].rpartition(".")[0]
+    for name in symbol[REFERENCES]:
+        if name.startswith("."):
+            # self.name and cls.name are members of the enclosing class
+            qualname = f"{prefix}.{name[1:]}" if prefix else None
+        else:
+            qualname = name
+        target = by_name.get(qualname)
+        if target is None:
+            continue
+        if target[KIND] == "class":
+            # Creating an instance runs the constructor, not the whole class
+            qualname += ".__init__"
+            if qualname not in by_name:
+                continue
+        yield qualname
+
+
+def slice_source(text, symbols, chosen, callee_depth=1):
+    """text with only the chosen symbols in full, or None if none of them
+    are in symbols.
+
+    The functions the chosen ones refer to, up to callee_depth references
+    away, are kept in full too. Every other class and function is cut
+    down to its signature with a "..." body.
+    """
+    by_name = {symbol[QUALNAME]: symbol for symbol in symbols}
+    full = {qualname for qualname in chosen if qualname in by_name}
+    if not full:
+        return None
+    frontier = list(full)
+    for _ in range(callee_depth):
+        next_frontier = []
+        for qualname in frontier:
+            for callee in _referenced(by_name, by_name[qualname]):
+                if callee not in full:
+                    full.add(callee)
+                    next_frontier.append(callee)
+        frontier = next_frontier
+
+    lines = text.split("\n")
+    parts = [f"[Symbols: {', '.join(sorted(full))}; other definitions are "
+             f"shown as signatures]"]
+    emitted_to = 0
+    for symbol in symbols:
+        qualname, kind, first_line, header_end, last_line = symbol[:5]
+        if first_line <= emitted_to:
+            # Inside a symbol already included in full
+            continue
+        if emitted_to and first_line > emitted_to + 1 and parts[-1]:
+            parts.append("")
+        if qualname in full:
+            parts.extend(lines[first_line - 1:last_line])
+            emitted_to = last_line
+            continue
+        parts.extend(lines[first_line - 1:header_end])
+        emitted_to = header_end
+        if kind == "def" and last_line > header_end:
+            body = lines[header_end] if header_end < len(lines) else ""
+            indent = body[:len(body) - len(body.lstrip())]
+            parts.append(indent + "...")
+            emitted_to = last_line
+    return "\n".join(parts)
+
+
+def slice_file(path, chosen, cache=None, callee_depth=1):
+    """The chosen symbols of a file with the rest cut down to signatures,
+    or None if the file has none of them"""
+    text = load_text(path)
+    symbols = cache.get(path, text) if cache is not None else symbol_table(path, text)
+    return slice_source(text, symbols, chosen, callee_depth)
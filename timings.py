@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import heapq
+import threading
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+from utils import get_cache_dir
+
+# Shared do-nothing span for when timings are off
+_NO_SPAN = nullcontext()
+
+
+def span(timings, name):
+    """Span of timings named name, or a no-op when timings is None"""
+    return _NO_SPAN if timings is None else timings.span(name)
+
+
+def profiled(timings):
+    """Profile the block if timings captures a profile"""
+    return _NO_SPAN if timings is None else timings.profiled()
+
+
+def create_timings(settings, operation):
+    """Timings of an operation if the settings turn them on, else None"""
+    if not settings.get("record_timings", False):
+        return None
+    return Timings(operation, profile=settings.get("profile_timings", False))
+
+
+class Timings:
+    """Named spans of one operation, such as loading the tree or generating
+    a prompt, plus the time and size of every file read.
+
+    Spans may be recorded from any thread. Phases that start and end in
+    different callbacks use begin() and end(). With profile set, the code
+    run inside profiled() is captured with cProfile; cProfile only sees the
+    thread it is enabled in, so profiled() wraps the busiest thread.
+    """
+
+    SLOWEST_FILES = 10
+
+    def __init__(self, operation, profile=False):
+        self.operation = operation
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.spans = []
+        self.file_count = 0
+        self.file_characters = 0
+        self.file_seconds = 0.0
+        self.profile_path = None
+        # Total time, once finished
+        self.seconds = None
+        self._slowest = []
+        self._open = {}
+        self._lock = threading.Lock()
+        self._profiler = None
+        if profile:
+            # Imported only when profiling, as startup timings come first
+            import cProfile
+            self._profiler = cProfile.Profile()
+
+    @contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, started, time.perf_counter())
+
+    def add(self, name, started, ended):
+        """Record a span from perf_counter() times"""
+        with self._lock:
+            self.spans.append((name, started - self.started, ended - started))
+
+    def begin(self, name):
+        self._open[name] = time.perf_counter()
+
+    def end(self, name):
+        started = self._open.pop(name, None)
+        if started is not None:
+            self.add(name, started, time.perf_counter())
+
+    def file_read(self, path, seconds, characters):
+        with self._lock:
+            self.file_count += 1
+            self.file_characters += characters
+            self.file_seconds += seconds
+            entry = (seconds, path, characters)
+            if len(self._slowest) < self.SLOWEST_FILES:
+                heapq.heappush(self._slowest, entry)
+            elif entry > self._slowest[0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    @contextmanager
+    def profiled(self):
+        profiler = self._profiler
+        if profiler is None:
+            yield
+            return
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Another profiler is already running in this thread
+            print(f"Warning: Could not profile {self.operation}: {str(e)}")
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+
+    @property
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def finish(self, log=None):
+        """Record of the operation; writes it, and any profile, to log"""
+        total = self.seconds = self.total
+        record = {
+            "time": datetime.fromtimestamp(self.started_at).isoformat(timespec="seconds"),
+            "operation": self.operation,
+            "seconds": round(total, 4),
+            "spans": [{"name": name, "start": round(start, 4), "seconds": round(seconds, 4)}
+                      for name, start, seconds in self.spans],
+        }
+        if self.file_count:
+            record["files"] = {
+                "count": self.file_count,
+                "characters": self.file_characters,
+                "read_seconds": round(self.file_seconds, 4),
+                "slowest": [{"path": path, "seconds": round(seconds, 4),
+                             "characters": characters}
+                            for seconds, path, characters
+                            in sorted(self._slowest, reverse=True)],
+            }
+        if log is not None:
+            if self._profiler is not None:
+                self.profile_path = log.write_profile(self.operation, self._profiler)
+                if self.profile_path:
+                    record["profile"] = self.profile_path
+            log.write(record)
+        return record
+
+    def summary(self):
+        """Short line for the status bar, such as
+        "Generate prompt 2.31 s (Build prompt 1.80 s)" """
+        total = self.total if self.seconds is None else self.seconds
+        text = f"{self.operation} {total:.2f} s"
+        if self.spans:
+            name, _, seconds = max(self.spans, key=lambda span: span[2])
+            text += f" ({name} {seconds:.2f} s)"
+        return text
+
+    def details(self):
+        """Several lines with the slowest files, for a tooltip"""
+        lines = [f"{name}: {seconds:.3f} s (at {start:.3f} s)"
+                 for name, start, seconds in self.spans]
+        if self.file_count:
+            lines.append(f"{self.file_count} file(s), {self.file_characters:,} "
+                         f"characters, {self.file_seconds:.3f} s of reads")
+            lines.extend(f"  {path}: {seconds:.3f} s, {characters:,} characters"
+                         for seconds, path, characters in sorted(self._slowest, reverse=True))
+        if self.profile_path:
+            lines.append(f"Profile: {self.profile_path}")
+        return "\n".join(lines)
+
+
+class TimingLog:
+    """JSON lines log of Timings records that rotates at max_bytes, keeping
+    backups older files as timings.jsonl.1, .2 and so on"""
+
+    def __init__(self, folder=None, max_bytes=1024 * 1024, backups=3):
+        self.folder = folder or os.path.join(get_cache_dir(), "timings")
+        self.path = os.path.join(self.folder, "timings.jsonl")
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            if (os.path.exists(self.path)
+                    and os.path.getsize(self.path) + len(line) > self.max_bytes):
+                self._rotate()
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError as e:
+            print(f"Warning: Could not write timings to {self.path}: {str(e)}")
+
+    def _rotate(self):
+        for number in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{number}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{number + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def write_profile(self, operation, profiler):
+        """Save cProfile stats next to the log, for pstats or snakeviz;
+        returns the file's path, or None"""
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        name = operation.lower().replace(" ", "_")
+        path = os.path.join(self.folder, f"{name}-{stamp}.prof")
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            profiler.dump_stats(path)
+        except OSError as e:
+            print(f"Warning: Could not save the profile to {path}: {str(e)}")
+            return None
+        self._remove_old_profiles()
+        return path
+
+    def _remove_old_profiles(self):
+        # Profiles are large; keep as many as the log keeps files
+        try:
+            profiles = sorted(
+                (entry for entry in os.scandir(self.folder) if entry.name.endswith(".prof")),
+                key=lambda entry: entry.stat().st_mtime)
+            for entry in profiles[:-(self.backups + 1)]:
+                os.remove(entry.path)
+        except OSError:
+            pass
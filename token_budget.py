@@ -0,0 +1,133 @@
+import os
+import re
+import threading
+
+
+_WORDS = re.compile(r"[A-Za-z]+")
+_LONG_WORDS = re.compile(r"[A-Za-z]{7,}")
+_NUMBERS = re.compile(r"\d{1,3}")
+_SYMBOLS = re.compile(r"[^\w\s]")
+_INDENTS = re.compile(r"(?m)^(?: {4}|\t)+")
+_OTHER = re.compile(r"[^\x00-\x7f]")
+
+# Fewer tokens per file than this is not worth including
+MIN_FILE_TOKENS = 32
+
+
+class ApproximateTokenizer:
+    """Regex-based token estimate, close to BPE tokenizers for code and prose.
+
+    Counts what byte-pair encoders usually merge into one token: a short
+    word, a group of up to three digits, a symbol, an indentation run.
+    Long words and non-ASCII characters add extra tokens.
+    """
+    name = "approx"
+
+    def count(self, text):
+        return (len(_WORDS.findall(text))
+                + sum(len(word) // 6 for word in _LONG_WORDS.findall(text))
+                + len(_NUMBERS.findall(text))
+                + len(_SYMBOLS.findall(text))
+                + len(_INDENTS.findall(text))
+                + text.count("\n")
+                + len(_OTHER.findall(text)))
+
+
+class TiktokenTokenizer:
+    """Exact counts from a local tiktoken encoding, if tiktoken is installed"""
+
+    def __init__(self, encoding_name="cl100k_base"):
+        import tiktoken
+        self.name = f"tiktoken:{encoding_name}"
+        self._encoding = tiktoken.get_encoding(encoding_name)
+
+    def count(self, text):
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+
+def create_tokenizer(name="approx"):
+    """Tokenizer for the "tokenizer" setting, falling back to the estimate"""
+    if name and name.startswith("tiktoken"):
+        _, _, encoding_name = name.partition(":")
+        try:
+            return TiktokenTokenizer(encoding_name or "cl100k_base")
+        except Exception as e:
+            print(f"Warning: Could not load {name}, using estimate: {str(e)}")
+    return ApproximateTokenizer()
+
+
+class TokenCounter:
+    """Token counts of files, cached per file version (size and mtime)"""
+
+    def __init__(self, tokenizer=None):
+        self.tokenizer = tokenizer or ApproximateTokenizer()
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def count_text(self, text):
+        return self.tokenizer.count(text)
+
+    def count_file(self, path, content):
+        try:
+            st = os.stat(path)
+            key = (path, st.st_size, st.st_mtime_ns)
+        except OSError:
+            return self.tokenizer.count(content)
+        with self._lock:
+            count = self._counts.get(key)
+        if count is None:
+            count = self.tokenizer.count(content)
+            with self._lock:
+                self._counts[key] = count
+        return count
+
+
+def pack_files(token_counts, available):
+    """Tokens to spend on each file so the total fits in available.
+
+    Files are visited from the cheapest up, and each may use at most an
+    equal share of what is left, so small files stay whole and only the
+    largest ones are cut down. A file given less than MIN_FILE_TOKENS is
+    dropped (0).
+    """
+    allotted = [0] * len(token_counts)
+    remaining = max(available, 0)
+    order = sorted(range(len(token_counts)), key=lambda i: token_counts[i])
+    for position, i in enumerate(order):
+        share = remaining // (len(order) - position)
+        tokens = min(token_counts[i], share)
+        if tokens < min(MIN_FILE_TOKENS, token_counts[i]):
+            tokens = 0
+        allotted[i] = tokens
+        remaining -= tokens
+    return allotted
+
+
+def elide_to_tokens(content, tokens, target):
+    """Keep the head and tail of content, about target tokens in total"""
+    if tokens <= target:
+        return content
+    lines = content.splitlines(keepends=True)
+    chars_per_token = len(content) / max(tokens, 1)
+    head_budget = int(target * 2 / 3 * chars_per_token)
+    tail_budget = int(target / 3 * chars_per_token)
+
+    head, used = [], 0
+    for line in lines:
+        if used + len(line) > head_budget:
+            break
+        head.append(line)
+        used += len(line)
+    tail, used = [], 0
+    for line in reversed(lines[len(head):]):
+        if used + len(line) > tail_budget:
+            break
+        tail.append(line)
+        used += len(line)
+    tail.reverse()
+
+    omitted = len(lines) - len(head) - len(tail)
+    marker = f"[... {omitted} lines omitted to fit the token budget ...]\n"
+    if head and not head[-1].endswith("\n"):
+        marker = "\n" + marker
+    return "".join(head) + marker + "".join(tail)
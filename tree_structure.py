@@ -0,0 +1,105 @@
+from indexer import ProjectIndex
+
+
+STRUCTURE_MODES = {
+    "expanded": "Folders open in the tree",
+    "full": "Whole project",
+    "selected": "Selected files only",
+    "depth": "Limited depth",
+    "collapse": "Collapse large folders",
+}
+
+
+def selected_ancestors(project_index, selected_ids):
+    """The selected entries together with every folder above them"""
+    keep = set()
+    for entry_id in selected_ids:
+        while entry_id >= 0 and entry_id not in keep:
+            keep.add(entry_id)
+            entry_id = project_index.parent(entry_id)
+    return keep
+
+
+def render_tree_structure(project_index, is_expanded=None, mode=None,
+                          selected_ids=(), max_depth=3, max_entries=50):
+    """Text tree of a project index for the "Project File Structure" section.
+
+    mode picks what is shown:
+      "expanded"  folders for which is_expanded(entry_id) is true (the GUI tree)
+      "full"      every indexed entry
+      "selected"  the selected files and their folders
+      "depth"     entries down to max_depth levels
+      "collapse"  everything, but folders with more than max_entries children
+                  are folded
+    In the last three modes selected files are always shown, and hidden
+    entries are summarised as "… N more" under their folder.
+    """
+    if mode is None or (mode == "expanded" and is_expanded is None):
+        # Without a view there is nothing expanded, as in batch mode
+        mode = "full" if is_expanded is None else "expanded"
+    keep = (selected_ancestors(project_index, selected_ids)
+            if mode in ("selected", "depth", "collapse") else None)
+
+    def visible_children(entry_id, depth):
+        children = project_index.children(entry_id)
+        if mode == "full":
+            return list(children), 0
+        if mode == "expanded":
+            return (list(children) if is_expanded(entry_id) else []), 0
+        if (mode == "selected"
+                or (mode == "depth" and depth >= max_depth)
+                or (mode == "collapse" and len(children) > max_entries)):
+            shown = [child for child in children if child in keep]
+            return shown, len(children) - len(shown)
+        return list(children), 0
+
+    root = ProjectIndex.ROOT
+    lines = [project_index.name(root) + "/"]
+
+    # Walk with an explicit stack so deep trees cannot hit the recursion limit
+    # Items are (entry_id, prefix, is_last, depth); entry_id None is a summary
+    stack = []
+
+    def push_children(entry_id, prefix, depth):
+        shown, hidden = visible_children(entry_id, depth)
+        items = [(child, i == len(shown) - 1 and not hidden)
+                 for i, child in enumerate(shown)]
+        if hidden:
+            items.append((-hidden, True))
+        stack.extend((child, prefix, is_last, depth + 1)
+                     for child, is_last in reversed(items))
+
+    push_children(root, "", 0)
+    while stack:
+        entry_id, prefix, is_last, depth = stack.pop()
+        connector = "└── " if is_last else "├── "
+        if entry_id < 0:
+            lines.append(f"{prefix}{connector}… {-entry_id} more")
+            continue
+        lines.append(prefix + connector + project_index.name(entry_id))
+        if project_index.is_dir(entry_id):
+            push_children(entry_id, prefix + ("    " if is_last else "│   "), depth)
+    return "\n".join(lines)
+
+
+class TreeStructureRenderer:
+    """Memoizes the rendered structure until the index or the view state changes.
+
+    Callers pass a state token that changes whenever the selection or the
+    expanded folders change; together with the index generation and the
+    options it decides whether the last text can be reused.
+    """
+
+    def __init__(self, project_index):
+        self.project_index = project_index
+        self._key = None
+        self._text = ""
+
+    def render(self, state, **options):
+        key = (self.project_index.generation, len(self.project_index), state,
+               tuple(sorted((name, value) for name, value in options.items()
+                            if name not in ("is_expanded", "selected_ids"))))
+        if key != self._key:
+            self._text = render_tree_structure(self.project_index, **options)
+            self._key = key
+        return self._text
@@ -1,55 +1,208 @@
 from PyQt6.QtWidgets import (
     QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QPushButton, QTextEdit, QTreeWidget, QTreeWidgetItem,
-    QFileDialog, QLabel, QDialog, QDialogButtonBox, QProgressDialog, QFrame, QProgressBar
+    QPushButton, QTextEdit, QTreeView, QAbstractItemView, QHeaderView,
+    QFileDialog, QLabel, QDialog, QDialogButtonBox, QProgressDialog, QFrame, QProgressBar,
+    QSpinBox, QComboBox, QLineEdit, QListWidget, QListWidgetItem, QMenu, QCheckBox
 )
-from PyQt6.QtCore import Qt, QSettings, QThread, pyqtSignal, QSize
+from PyQt6.QtCore import Qt, QSettings, QThread, QTimer, pyqtSignal, QSize
 from PyQt6.QtGui import QIcon
 import os
 import json
-import pyperclip
-from utils import get_resource_path
+import time
+import threading
+from utils import get_resource_path, read_settings, default_settings, format_size
+from prompt_view import PromptView
+from content_cache import ContentCache
+from tree_structure import TreeStructureRenderer, STRUCTURE_MODES
+from token_budget import TokenCounter, create_tokenizer
+from symbols import SymbolCache, has_parser
+from timings import TimingLog, create_timings, span, profiled
+
+
+class PromptGenerationThread(QThread):
+    """Generates a prompt, handing its sections to the window as they are
+    built so that the view fills in while files are still being read"""
+    progress = pyqtSignal(int, int)
+    token_report = pyqtSignal(list)
+    sections = pyqtSignal(list)
+    generated = pyqtSignal(str)
+    generated_parts = pyqtSignal(list)
+    saved = pyqtSignal(str)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+    # Sections are sent in batches at most this often, not one signal per file
+    SECTION_INTERVAL = 0.1
+
+    def __init__(self, builder, output_path=None, timings=None):
+        super().__init__()
+        self.builder = builder
+        self.builder.progress = self.progress.emit
+        self.output_path = output_path
+        self.timings = timings
 
+    def cancel(self):
+        self.builder.cancel.set()
 
-class TreeLoaderThread(QThread):
-    finished = pyqtSignal()
-    progress = pyqtSignal(int)
+    def run(self):
+        with profiled(self.timings), span(self.timings, "Build prompt"):
+            self._generate()
 
-    def __init__(self, root_path, tree_widget, settings):
+    def _generate(self):
+        from prompt_builder import GenerationCancelled
+        try:
+            if self.builder.part_budget and self.output_path:
+                paths = self.builder.write_parts(self.output_path)
+                self.token_report.emit(self.builder.token_report)
+                self.saved.emit(paths[0] if len(paths) == 1 else
+                                f"{paths[0]} and {len(paths) - 1} more part file(s)")
+            elif self.builder.part_budget:
+                parts = self.builder.iter_part_sections()
+                self.token_report.emit(self.builder.token_report)
+                self.generated_parts.emit(parts)
+            elif self.output_path:
+                # Streamed straight to disk, never held as one string
+                self.builder.write_file(self.output_path)
+                self.token_report.emit(self.builder.token_report)
+                self.saved.emit(self.output_path)
+            else:
+                chunks = []
+                batch = []
+                sent_at = time.monotonic()
+                for title, text in self.builder.iter_sections():
+                    chunks.append(text)
+                    batch.append((title, text))
+                    if time.monotonic() - sent_at >= self.SECTION_INTERVAL:
+                        self.sections.emit(batch)
+                        batch = []
+                        sent_at = time.monotonic()
+                if batch:
+                    self.sections.emit(batch)
+                self.token_report.emit(self.builder.token_report)
+                self.generated.emit("".join(chunks))
+        except GenerationCancelled:
+            self.cancelled.emit()
+        except (OSError, ValueError) as e:
+            self.failed.emit(str(e))
+
+
+class RelevanceIndexThread(QThread):
+    """Loads the saved full-text index of a project and brings it up to date"""
+    progress = pyqtSignal(int, int)
+    ready = pyqtSignal()
+
+    def __init__(self, relevance_index, project_index):
         super().__init__()
-        self.root_path = root_path
-        self.tree_widget = tree_widget
-        self.settings = settings
-        self.root_item = None
+        self.relevance_index = relevance_index
+        self.project_index = project_index
+        self._cancel = threading.Event()
 
-    def run(self):
-        self.root_item = QTreeWidgetItem(
-            self.tree_widget, [os.path.basename(self.root_path)])
-        self._populate_tree_recursive(self.root_path, self.root_item)
-        self.finished.emit()
+    def stop(self):
+        self._cancel.set()
+        self.wait()
 
-    def _populate_tree_recursive(self, path, parent_item):
+    def run(self):
+        if not self.relevance_index.docs and self.relevance_index.load():
+            # Rank with the last session's index while checking for changes
+            self.ready.emit()
+        if not self.relevance_index.update(self.project_index, cancel=self._cancel,
+                                           progress=self.progress.emit):
+            return
+        self.ready.emit()
         try:
-            entries = os.listdir(path)
-            entries.sort(key=lambda x: (not os.path.isdir(
-                os.path.join(path, x)), x.lower()))
+            self.relevance_index.save()
+        except OSError as e:
+            print(f"Warning: Could not save full-text index: {str(e)}")
+
+
+class ImportExpansionThread(QThread):
+    """Finds the files that the selected files import, up to a depth"""
+    ready = pyqtSignal(list)
+
+    def __init__(self, import_graph, file_ids, depth):
+        super().__init__()
+        self.import_graph = import_graph
+        self.file_ids = file_ids
+        self.depth = depth
+        self._cancel = threading.Event()
+
+    def stop(self):
+        self._cancel.set()
+        self.wait()
 
-            for entry in entries:
-                if entry in self.settings.get("excluded_folders", []):
-                    continue
+    def run(self):
+        if not self.import_graph.files:
+            self.import_graph.load()
+        found = self.import_graph.dependencies(
+            self.file_ids, self.depth, cancel=self._cancel)
+        if self._cancel.is_set():
+            return
+        self.ready.emit(found)
+        if self.import_graph.modified:
+            try:
+                self.import_graph.save()
+            except OSError as e:
+                print(f"Warning: Could not save import cache: {str(e)}")
 
-                full_path = os.path.join(path, entry)
 
-                if os.path.isfile(full_path):
-                    _, ext = os.path.splitext(entry)
-                    if ext.lower() in self.settings.get("excluded_extensions", []):
-                        continue
+class GitStatusThread(QThread):
+    """Reads which files changed from the local git repository; with
+    changed_files set, also lists them for selecting"""
+    ready = pyqtSignal(dict)
+    changed = pyqtSignal(list)
 
-                item = QTreeWidgetItem(parent_item, [entry])
-                if os.path.isdir(full_path):
-                    self._populate_tree_recursive(full_path, item)
-        except PermissionError:
-            pass
+    def __init__(self, repository, commits, changed_files=False):
+        super().__init__()
+        self.repository = repository
+        self.commits = commits
+        self.changed_files = changed_files
+
+    def run(self):
+        if self.changed_files:
+            self.changed.emit(self.repository.changed_files(self.commits))
+        self.ready.emit(self.repository.marks(self.commits))
+
+
+class SymbolPickerDialog(QDialog):
+    """Checklist of the classes and functions of a file to include in full"""
+
+    def __init__(self, rel_path, symbols, chosen, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(f"Symbols of {rel_path}")
+        self.resize(420, 480)
+        layout = QVBoxLayout(self)
+        note = QLabel("Checked classes and functions are included in full, with the "
+                      "functions they call; the rest of the file is cut down to "
+                      "signatures. Check none to include the whole file.")
+        note.setWordWrap(True)
+        layout.addWidget(note)
+
+        self.symbol_list = QListWidget()
+        self.symbol_list.setUniformItemSizes(True)
+        chosen = set(chosen)
+        for qualname, kind in ((symbol[0], symbol[1]) for symbol in symbols):
+            depth = qualname.count(".")
+            name = qualname.rsplit(".", 1)[-1]
+            item = QListWidgetItem("    " * depth + (f"class {name}" if kind == "class"
+                                                     else f"{name}()"))
+            item.setData(Qt.ItemDataRole.UserRole, qualname)
+            item.setFlags(item.flags() | Qt.ItemFlag.ItemIsUserCheckable)
+            item.setCheckState(Qt.CheckState.Checked if qualname in chosen
+                               else Qt.CheckState.Unchecked)
+            self.symbol_list.addItem(item)
+        layout.addWidget(self.symbol_list)
+
+        buttons = QDialogButtonBox(
+            QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addWidget(buttons)
+
+    def chosen(self):
+        """Qualified names of the checked symbols, in source order"""
+        return [self.symbol_list.item(row).data(Qt.ItemDataRole.UserRole)
+                for row in range(self.symbol_list.count())
+                if self.symbol_list.item(row).checkState() == Qt.CheckState.Checked]
 
 
 class LoadingOverlay(QWidget):
@@ -143,8 +296,13 @@ class LoadingOverlay(QWidget):
 
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, startup_timings=None):
         super().__init__()
+        # Timings of a --profile-startup run
+        self.startup_timings = startup_timings
+        self.first_paint_pending = True
+        self.startup_finished = False
+        self.tree_load_pending = False
         self.setWindowTitle("LLM Defect Prompt Generator")
         self.setMinimumSize(800, 600)
 
@@ -157,6 +315,67 @@ class MainWindow(QMainWindow):
         self.settings = {}
         self.load_settings()
 
+        # Contents of selected files, kept between generations
+        self.content_cache = ContentCache(
+            self.settings.get("content_cache_mb", 64) * 1024 * 1024)
+        # Spin boxes save the settings once the user stops stepping them
+        self.settings_save_timer = QTimer(self)
+        self.settings_save_timer.setSingleShot(True)
+        self.settings_save_timer.setInterval(1000)
+        self.settings_save_timer.timeout.connect(self.save_settings)
+        self.prewarm_timer = QTimer(self)
+        self.prewarm_timer.setSingleShot(True)
+        self.prewarm_timer.setInterval(500)
+        self.prewarm_timer.timeout.connect(self._prewarm_selected_files)
+
+        # Token estimates are cached per file version, so repacking is cheap;
+        # a tiktoken tokenizer is loaded after the window is shown
+        self.token_counter = TokenCounter()
+        self.token_report = []
+        self.repack_timer = QTimer(self)
+        self.repack_timer.setSingleShot(True)
+        self.repack_timer.setInterval(400)
+        self.repack_timer.timeout.connect(self._repack_prompt)
+
+        # Searches run when typing pauses briefly
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(100)
+        self.search_timer.timeout.connect(self._run_file_search)
+
+        # Files matching the defect description, from a full-text index
+        self.relevance_index = None
+        self.relevance_thread = None
+        # Files imported by the selected files, parsed on request
+        self.import_graph = None
+        self.import_thread = None
+        # Classes and functions chosen per file, by "/" separated rel_path;
+        # paths survive re-listings of the folder, unlike entry ids
+        self.file_symbols = {}
+        self.symbol_cache = SymbolCache()
+        # Changed files from the local git repository, if the root is in one
+        self.git_repository = None
+        self.git_thread = None
+        # Set while Select Changed Files waits for the git thread
+        self.select_changed_pending = False
+        self.git_refresh_timer = QTimer(self)
+        self.git_refresh_timer.setSingleShot(True)
+        self.git_refresh_timer.setInterval(5000)
+        self.git_refresh_timer.timeout.connect(self._refresh_git_marks)
+        # Files named by a stack trace in the defect description
+        self.frame_resolver = None
+        self._trace_selected = set()
+        # Both are worked out again when typing in the description pauses
+        self.defect_timer = QTimer(self)
+        self.defect_timer.setSingleShot(True)
+        self.defect_timer.setInterval(600)
+        self.defect_timer.timeout.connect(self._update_suggestions)
+        self.defect_timer.timeout.connect(self._apply_stack_trace)
+        self.relevance_refresh_timer = QTimer(self)
+        self.relevance_refresh_timer.setSingleShot(True)
+        self.relevance_refresh_timer.setInterval(5000)
+        self.relevance_refresh_timer.timeout.connect(self._refresh_relevance_index)
+
         # Create main widget and layout
         main_widget = QWidget()
         self.setCentralWidget(main_widget)
@@ -165,6 +384,8 @@ class MainWindow(QMainWindow):
         # Defect description section
         layout.addWidget(QLabel("Defect Description:"))
         self.defect_input = QTextEdit()
+        self.defect_input.textChanged.connect(self._update_token_summary)
+        self.defect_input.textChanged.connect(lambda: self.defect_timer.start())
         layout.addWidget(self.defect_input)
 
         # File selection buttons
@@ -197,57 +418,277 @@ class MainWindow(QMainWindow):
         tree_layout = QVBoxLayout(self.tree_container)
         tree_layout.setContentsMargins(0, 0, 0, 0)
 
-        tree_label = QLabel("Select Project Files:")
-        tree_layout.addWidget(tree_label)
+        tree_header = QHBoxLayout()
+        self.tree_label = QLabel("Select Project Files:")
+        tree_header.addWidget(self.tree_label)
+        tree_header.addStretch()
+
+        tree_header.addWidget(QLabel("Structure in prompt:"))
+        self.structure_mode_input = QComboBox()
+        for mode, description in STRUCTURE_MODES.items():
+            self.structure_mode_input.addItem(description, mode)
+        self.structure_mode_input.setCurrentIndex(max(0, self.structure_mode_input.findData(
+            self.settings.get("structure_mode", "full"))))
+        self.structure_mode_input.currentIndexChanged.connect(
+            self._on_structure_mode_changed)
+        tree_header.addWidget(self.structure_mode_input)
+        tree_layout.addLayout(tree_header)
+
+        # File search above the tree
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("Search files, e.g. \"src model.py\"")
+        self.search_input.setClearButtonEnabled(True)
+        self.search_input.textChanged.connect(lambda: self.search_timer.start())
+        self.search_input.returnPressed.connect(self._choose_first_search_result)
+        tree_layout.addWidget(self.search_input)
+        self.search_results = QListWidget()
+        self.search_results.setMaximumHeight(160)
+        self.search_results.setUniformItemSizes(True)
+        self.search_results.itemActivated.connect(self._on_file_result_chosen)
+        self.search_results.itemClicked.connect(self._on_file_result_chosen)
+        self.search_results.hide()
+        tree_layout.addWidget(self.search_results)
 
         # Create a widget to hold the tree and overlay
         self.tree_widget_container = QWidget()
         self.tree_widget_container.setLayout(QVBoxLayout())
         self.tree_widget_container.layout().setContentsMargins(0, 0, 0, 0)
 
-        self.file_tree = QTreeWidget()
-        self.file_tree.setHeaderLabel("Project Files")
+        self.file_tree = QTreeView()
+        self.file_tree.setUniformRowHeights(True)
+        # Files are picked with the checkboxes; the row selection is only a cursor
         self.file_tree.setSelectionMode(
-            QTreeWidget.SelectionMode.MultiSelection)
-        self.file_tree.itemSelectionChanged.connect(
-            self.on_tree_selection_changed)
+            QAbstractItemView.SelectionMode.SingleSelection)
+        self.file_tree.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        self.file_tree.customContextMenuRequested.connect(self._show_tree_menu)
+        self.file_tree.expanded.connect(lambda index: self._on_tree_expansion(index, True))
+        self.file_tree.collapsed.connect(lambda index: self._on_tree_expansion(index, False))
+        self.tree_model = None
+        self.tree_timings = None
+        self.structure_renderer = None
+        self._tree_state_version = 0
         self.tree_widget_container.layout().addWidget(self.file_tree)
 
         # Create loading overlay as child of tree_widget_container
         self.loading_overlay = LoadingOverlay(self.tree_widget_container)
 
         tree_layout.addWidget(self.tree_widget_container)
+
+        # Adding the files that the selected files import
+        imports_layout = QHBoxLayout()
+        self.choose_symbols_btn = QPushButton("Choose Symbols...")
+        self.choose_symbols_btn.setToolTip(
+            "Include only some classes and functions of the current file")
+        self.choose_symbols_btn.clicked.connect(
+            lambda: self.choose_symbols(self.file_tree.currentIndex()))
+        imports_layout.addWidget(self.choose_symbols_btn)
+        imports_layout.addStretch()
+        imports_layout.addWidget(QLabel("Import depth:"))
+        self.import_depth_input = QSpinBox()
+        self.import_depth_input.setRange(1, 10)
+        self.import_depth_input.setValue(self.settings.get("import_depth", 1))
+        imports_layout.addWidget(self.import_depth_input)
+        self.add_imports_btn = QPushButton("Add Imported Files")
+        self.add_imports_btn.clicked.connect(self.add_imported_files)
+        imports_layout.addWidget(self.add_imports_btn)
+        tree_layout.addLayout(imports_layout)
+
+        # Git changes, shown when the root folder is in a git repository
+        self.git_container = QWidget()
+        git_layout = QHBoxLayout(self.git_container)
+        git_layout.setContentsMargins(0, 0, 0, 0)
+        self.select_changed_btn = QPushButton("Select Changed Files")
+        self.select_changed_btn.setToolTip(
+            "Select the files with uncommitted changes and those changed in recent commits")
+        self.select_changed_btn.clicked.connect(self.select_changed_files)
+        git_layout.addWidget(self.select_changed_btn)
+        git_layout.addWidget(QLabel("in the last"))
+        self.git_commits_input = QSpinBox()
+        self.git_commits_input.setRange(0, 1000)
+        self.git_commits_input.setValue(self.settings.get("git_commits", 5))
+        self.git_commits_input.valueChanged.connect(self._on_git_commits_changed)
+        git_layout.addWidget(self.git_commits_input)
+        git_layout.addWidget(QLabel("commits"))
+        git_layout.addStretch()
+        self.git_diffs_input = QCheckBox("Diffs instead of whole changed files")
+        self.git_diffs_input.setChecked(self.settings.get("git_diffs", False))
+        self.git_diffs_input.toggled.connect(self._on_git_diffs_changed)
+        git_layout.addWidget(self.git_diffs_input)
+        self.git_container.hide()
+        tree_layout.addWidget(self.git_container)
         layout.addWidget(self.tree_container)
 
+        # Suggested files
+        suggest_header = QHBoxLayout()
+        self.suggest_label = QLabel("Suggested Files:")
+        suggest_header.addWidget(self.suggest_label)
+        suggest_header.addStretch()
+        self.suggest_count_input = QSpinBox()
+        self.suggest_count_input.setRange(1, 20)
+        self.suggest_count_input.setValue(self.settings.get("suggestion_count", 5))
+        suggest_header.addWidget(self.suggest_count_input)
+        self.add_suggestions_btn = QPushButton("Add Top Suggestions")
+        self.add_suggestions_btn.clicked.connect(self.add_top_suggestions)
+        suggest_header.addWidget(self.add_suggestions_btn)
+        layout.addLayout(suggest_header)
+        self.suggestion_list = QListWidget()
+        self.suggestion_list.setMaximumHeight(120)
+        self.suggestion_list.setUniformItemSizes(True)
+        self.suggestion_list.itemActivated.connect(self._on_file_result_chosen)
+        self.suggestion_list.itemClicked.connect(self._on_file_result_chosen)
+        layout.addWidget(self.suggestion_list)
+
         # Generate button and output
-        self.generate_btn = QPushButton("Generate Prompt")
-        self.generate_btn.clicked.connect(self.generate_prompt)
-        layout.addWidget(self.generate_btn)
+        generate_layout = QHBoxLayout()
+        self.prompt_thread = None
+        self.prompt_timings = None
+        # (output_path,) of a generation waiting for checked folders to load
+        self.deferred_generation = None
 
-        layout.addWidget(QLabel("Generated Prompt:"))
-        self.output_text = QTextEdit()
-        self.output_text.setReadOnly(True)
-        layout.addWidget(self.output_text)
+        self.generate_btn = QPushButton("Generate Prompt")
+        self.generate_btn.clicked.connect(lambda: self.generate_prompt())
+        generate_layout.addWidget(self.generate_btn)
+
+        self.save_prompt_btn = QPushButton("Save Prompt to File")
+        self.save_prompt_btn.clicked.connect(self.save_prompt)
+        generate_layout.addWidget(self.save_prompt_btn)
+
+        self.prompt_progress = QProgressBar()
+        self.prompt_progress.hide()
+        generate_layout.addWidget(self.prompt_progress)
+
+        generate_layout.addWidget(QLabel("Token budget:"))
+        self.token_budget_input = QSpinBox()
+        self.token_budget_input.setRange(0, 10_000_000)
+        self.token_budget_input.setSingleStep(1000)
+        self.token_budget_input.setSpecialValueText("Unlimited")
+        self.token_budget_input.setValue(self.settings.get("token_budget", 0))
+        self.token_budget_input.valueChanged.connect(self._on_token_budget_changed)
+        generate_layout.addWidget(self.token_budget_input)
+
+        # Prompts over the part size are split into parts
+        generate_layout.addWidget(QLabel("Part size:"))
+        self.part_size_input = QSpinBox()
+        self.part_size_input.setRange(0, 10_000_000)
+        self.part_size_input.setSingleStep(1000)
+        self.part_size_input.setSpecialValueText("One prompt")
+        self.part_size_input.setValue(self.settings.get("part_size", 0))
+        self.part_size_input.valueChanged.connect(self._on_part_size_changed)
+        generate_layout.addWidget(self.part_size_input)
+        self.part_unit_input = QComboBox()
+        self.part_unit_input.addItem("tokens", "tokens")
+        self.part_unit_input.addItem("KB", "kb")
+        self.part_unit_input.setCurrentIndex(max(0, self.part_unit_input.findData(
+            self.settings.get("part_unit", "tokens"))))
+        self.part_unit_input.currentIndexChanged.connect(self._on_part_size_changed)
+        generate_layout.addWidget(self.part_unit_input)
+
+        layout.addLayout(generate_layout)
+
+        output_header = QHBoxLayout()
+        output_header.addWidget(QLabel("Generated Prompt:"))
+        output_header.addStretch()
+        # Shown when the prompt was split, to go through the parts one by one
+        self.prompt_parts = []
+        self.current_part = 0
+        self.part_label = QLabel()
+        output_header.addWidget(self.part_label)
+        self.previous_part_btn = QPushButton("Previous Part")
+        self.previous_part_btn.clicked.connect(lambda: self._show_part(self.current_part - 1))
+        output_header.addWidget(self.previous_part_btn)
+        self.next_part_btn = QPushButton("Next Part")
+        self.next_part_btn.clicked.connect(lambda: self._show_part(self.current_part + 1))
+        output_header.addWidget(self.next_part_btn)
+        self.copy_part_btn = QPushButton("Copy Part")
+        self.copy_part_btn.clicked.connect(self._copy_part)
+        output_header.addWidget(self.copy_part_btn)
+        layout.addLayout(output_header)
+        self._update_part_controls()
+
+        self.prompt_view = PromptView()
+        self.prompt_view.loaded.connect(self._on_prompt_view_loaded)
+        layout.addWidget(self.prompt_view)
+
+        self.token_label = QLabel()
+        layout.addWidget(self.token_label)
+
+        # Phase timings of the last tree load or generation, when recorded
+        self.timing_log = TimingLog()
+        self.timing_label = QLabel()
+        self.statusBar().addPermanentWidget(self.timing_label)
 
         # Load saved settings
         self.apply_saved_settings()
 
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        # Only timed; a window that is never painted must still load
+        if self.first_paint_pending:
+            self.first_paint_pending = False
+            if self.startup_timings is not None:
+                self.startup_timings.end("First paint")
+
+    def finish_startup(self):
+        """Work left out of __init__ so that the window appears sooner;
+        main.py runs it from the event loop once the window is shown"""
+        if self.startup_finished:
+            return
+        self.startup_finished = True
+        from prompt_builder import read_text_file
+
+        timings = self.startup_timings
+        tokenizer = self.settings.get("tokenizer", "approx")
+        if tokenizer != "approx":
+            with span(timings, "Load tokenizer"):
+                self.token_counter = TokenCounter(create_tokenizer(tokenizer))
+        # Read now so that the first generation finds them cached
+        with span(timings, "Read template and context"):
+            for path in (self.settings.get("prompt_template", ""),
+                         self.settings.get("context_file", "")):
+                try:
+                    read_text_file(path)
+                except (OSError, UnicodeDecodeError) as e:
+                    # Generating reports it again if it is still unreadable
+                    self.statusBar().showMessage(f"Could not read {path}: {str(e)}")
+        if self.tree_load_pending:
+            if timings is not None:
+                timings.begin("List root")
+            with span(timings, "Start tree load"):
+                self.populate_file_tree()
+        if self.tree_model is None:
+            self._report_startup()
+
+    def _report_startup(self):
+        """Print and log the startup timings of --profile-startup, then quit"""
+        timings = self.startup_timings
+        if timings is None:
+            return
+        self.startup_timings = None
+        timings.finish(self.timing_log)
+        print(timings.summary())
+        print(timings.details())
+        print(f"Logged to {self.timing_log.path}")
+        self.close()
+
+    def closeEvent(self, event):
+        if self.prompt_thread is not None:
+            self.prompt_thread.cancel()
+            self.prompt_thread.wait()
+        self._stop_relevance_thread()
+        self._stop_import_thread()
+        self._stop_git_thread()
+        if self.tree_model is not None:
+            self.tree_model.shutdown()
+        self.content_cache.shutdown()
+        if self.settings_save_timer.isActive():
+            self.settings_save_timer.stop()
+            self.save_settings()
+        super().closeEvent(event)
+
     def load_settings(self):
-        settings_path = get_resource_path('settings.json')
-        try:
-            with open(settings_path, 'r') as f:
-                self.settings = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            # Load default template path
-            default_template = get_resource_path(
-                'templates/default_template.txt')
-            self.settings = {
-                "prompt_template": default_template,
-                "context_file": "",
-                "root_folder": "",
-                "excluded_folders": [".git", "__pycache__", "node_modules", ".venv", "venv"],
-                "excluded_extensions": [".pyc", ".pyo", ".pyd", ".so", ".dll"]
-            }
+        self.settings = read_settings()
+        if self.settings is None:
+            self.settings = default_settings()
             self.save_settings()
 
     def save_settings(self):
@@ -270,8 +711,8 @@ class MainWindow(QMainWindow):
                     # Update with normalized path
                     self.settings["root_folder"] = root_path
                     self.root_label.setText(f"Root Folder: {root_path}")
-                    # Start loading the file tree
-                    self.populate_file_tree()
+                    # Start loading the file tree once the window is shown
+                    self.tree_load_pending = True
                 else:
                     print(
                         f"Warning: Root folder path does not exist: {root_path}")
@@ -338,171 +779,707 @@ class MainWindow(QMainWindow):
             self.populate_file_tree()
 
     def populate_file_tree(self):
-        self.file_tree.clear()
-        root_path = self.settings.get("root_folder")
-        if not root_path:
-            return
-
-        # Disable generate button during loading
-        self.generate_btn.setEnabled(False)
-
-        # Show loading overlay
-        self.loading_overlay.show()
-        self.loading_overlay.raise_()  # Ensure overlay is on top
-
-        # Create and start loader thread
-        self.loader_thread = TreeLoaderThread(
-            root_path, self.file_tree, self.settings)
-        self.loader_thread.finished.connect(self._on_tree_load_finished)
-        self.loader_thread.start()
+        # Imported on the first load, after the window is shown
+        from file_tree_model import FileTreeModel
+        from relevance import RelevanceIndex
+        from import_graph import ImportGraph
+        from git_repo import GitRepository
+        from stack_trace import FrameResolver
+
+        timings = create_timings(self.settings, "Tree load")
+        self.tree_timings = None
+        self.tree_load_pending = False
+        with profiled(timings):
+            with span(timings, "Clear previous tree"):
+                self._clear_file_tree()
+            root_path = self.settings.get("root_folder")
+            if not root_path:
+                return
+
+            # Disable generate button during loading
+            self.generate_btn.setEnabled(False)
+
+            # Show loading overlay
+            self.loading_overlay.show()
+            self.loading_overlay.raise_()  # Ensure overlay is on top
+
+            # Directories are listed in the background as they are expanded
+            if timings is not None:
+                timings.begin("List root")
+                timings.begin("Index project")
+            with span(timings, "Create model"):
+                self.tree_model = FileTreeModel(root_path, self.settings, self)
+            self.tree_model.root_loaded.connect(self._on_tree_load_finished)
+            self.tree_model.rowsInserted.connect(self._on_tree_state_changed)
+            self.tree_model.layoutChanged.connect(self._on_tree_state_changed)
+            self.tree_model.selection_changed.connect(self.on_tree_selection_changed)
+            self.tree_model.index_complete.connect(self._on_tree_indexed)
+            self.tree_model.index_complete.connect(self._refresh_relevance_index)
+            self.tree_model.index_complete.connect(self._apply_stack_trace)
+            self.tree_model.index_complete.connect(self._refresh_git_marks)
+            self.tree_model.listing_changed.connect(lambda: self.git_refresh_timer.start())
+            if self.settings.get("git_integration", True):
+                with span(timings, "Open git repository"):
+                    self.git_repository = GitRepository.open(root_path)
+                self.git_container.setVisible(self.git_repository is not None)
+            with span(timings, "Set up indexes"):
+                self.frame_resolver = FrameResolver(self.tree_model.project_index)
+                self._trace_selected = set()
+                self.tree_model.listing_changed.connect(
+                    lambda: self.relevance_refresh_timer.start())
+                self.relevance_index = RelevanceIndex(root_path)
+                self.import_graph = ImportGraph(root_path, self.tree_model.project_index)
+                self.structure_renderer = TreeStructureRenderer(
+                    self.tree_model.project_index)
+            with span(timings, "Show tree"):
+                self.file_tree.setModel(self.tree_model)
+                header = self.file_tree.header()
+                header.setStretchLastSection(False)
+                header.setSectionResizeMode(
+                    FileTreeModel.NAME_COLUMN, QHeaderView.ResizeMode.Stretch)
+                header.setSectionResizeMode(
+                    FileTreeModel.SIZE_COLUMN, QHeaderView.ResizeMode.ResizeToContents)
+            self._update_selection_summary()
+        # Finished once the whole project is indexed
+        self.tree_timings = timings
+
+    def _clear_file_tree(self):
+        self.deferred_generation = None
+        self._stop_relevance_thread()
+        self.relevance_index = None
+        self._stop_import_thread()
+        self.import_graph = None
+        self._stop_git_thread()
+        self.git_repository = None
+        self.git_container.hide()
+        self.file_symbols = {}
+        self.symbol_cache.clear()
+        if self.tree_model is not None:
+            self.tree_model.shutdown()
+            self.tree_model = None
+        self.file_tree.setModel(None)
+        self.search_results.clear()
+        self.search_results.hide()
+        self.suggestion_list.clear()
+        self._update_selection_summary()
 
     def _on_tree_load_finished(self):
+        if self.tree_timings is not None:
+            self.tree_timings.end("List root")
+
         # Re-enable generate button
         self.generate_btn.setEnabled(True)
 
-        # Collapse all items
-        self.file_tree.collapseAll()
+        # Show the first level of the project
+        self.file_tree.expand(self.tree_model.root_index())
 
         # Hide loading overlay
         self.loading_overlay.hide()
 
-    def get_selected_files(self):
-        selected_files = []
-        for item in self.file_tree.selectedItems():
-            path_parts = []
-            current = item
-            while current:
-                path_parts.insert(0, current.text(0))
-                current = current.parent()
-
-            # Use the normalized root folder path
-            root_path = self._normalize_wsl_path(self.settings["root_folder"])
-            full_path = os.path.join(root_path, *path_parts[1:])
-
-            if os.path.isfile(full_path):
-                selected_files.append(full_path)
-        return selected_files
-
-    def _get_tree_structure(self, root_path, prefix=""):
-        """Generate a tree-like structure of the visible files/folders"""
-        structure = []
-
-        def add_item(item, prefix="", is_last=False):
-            item_text = item.text(0)
-            # Use the correct symbols for the tree structure
-            line = prefix + ("└── " if is_last else "├── ") + item_text
-            structure.append(line)
-
-            child_prefix = prefix + ("    " if is_last else "│   ")
-            child_count = item.childCount()
-
-            for i in range(child_count):
-                add_item(item.child(i), child_prefix, i == child_count - 1)
-
-        # Get the root item
-        root_item = self.file_tree.topLevelItem(0)
-        if root_item:
-            structure.append(root_item.text(0) + "/")
-            child_count = root_item.childCount()
-            for i in range(child_count):
-                add_item(root_item.child(i), "", i == child_count - 1)
-
-        return "\n".join(structure)
-
-    def generate_prompt(self):
-        # Read template
-        template_content = ""
-        if os.path.exists(self.settings.get("prompt_template", "")):
-            with open(self.settings["prompt_template"], 'r') as f:
-                template_content = f.read()
-
-        # Read context
-        context_content = ""
-        if os.path.exists(self.settings.get("context_file", "")):
-            with open(self.settings["context_file"], 'r') as f:
-                context_content = f.read()
-
-        # Get selected files
-        selected_files = self.get_selected_files()
-
-        # Build prompt
-        prompt = f"{template_content}\n\n"
-        prompt += f"**Defect Description:**\n{self.defect_input.toPlainText()}\n\n"
-        prompt += f"**Project Context:**\n{context_content}\n\n"
-
-        # Add file structure
-        prompt += "**Project File Structure:**\n"
-        prompt += self._get_tree_structure(self.settings["root_folder"])
-        prompt += "\n\n"
-
-        # Add file contents
-        prompt += "\n**File Contents:**\n"
-        for file in selected_files:
-            try:
-                with open(file, 'r', encoding="utf-8") as f:
-                    content = f.read()
-            except UnicodeDecodeError:
-                content = "[Error: Unable to read file due to encoding issues.]"
-            except Exception as e:
-                content = f"[Error reading file: {str(e)}]"
-
-            rel_path = os.path.relpath(file, self.settings['root_folder'])
-            prompt += f"\n[File: {rel_path}]\n{content}\n"
-
-        self.output_text.setText(prompt)
+        if self.startup_timings is not None:
+            self.startup_timings.end("List root")
+            self._report_startup()
+
+    def _on_tree_indexed(self):
+        if self.tree_timings is not None:
+            self.tree_timings.end("Index project")
+            self._show_timings(self.tree_timings)
+            self.tree_timings = None
+
+    def _show_timings(self, timings):
+        """Log the timings of a finished operation and show them in the status bar"""
+        timings.finish(self.timing_log)
+        self.timing_label.setText(timings.summary())
+        self.timing_label.setToolTip(timings.details())
+
+    def _run_file_search(self):
+        self.search_results.clear()
+        query = self.search_input.text().strip()
+        if self.tree_model is None or not query:
+            self.search_results.hide()
+            return
+        project_index = self.tree_model.project_index
+        for entry_id in self.tree_model.search_index.search(query):
+            rel_path = project_index.rel_path(entry_id, "/")
+            if project_index.is_dir(entry_id):
+                rel_path += "/"
+            item = QListWidgetItem(rel_path)
+            item.setData(Qt.ItemDataRole.UserRole, entry_id)
+            self.search_results.addItem(item)
+        self.search_results.setVisible(self.search_results.count() > 0)
+
+    def _choose_first_search_result(self):
+        self.search_timer.stop()
+        self._run_file_search()
+        if self.search_results.count():
+            self._on_file_result_chosen(self.search_results.item(0))
+
+    def _on_file_result_chosen(self, item):
+        """Select the file and show it in the tree"""
+        entry_id = item.data(Qt.ItemDataRole.UserRole)
+        if self.tree_model is None or self.tree_model.project_index.is_removed(entry_id):
+            self._run_file_search()
+            return
+        index = self.tree_model.reveal(entry_id)
+        parent = index.parent()
+        while parent.isValid():
+            self.file_tree.expand(parent)
+            parent = parent.parent()
+        self.file_tree.scrollTo(index, QAbstractItemView.ScrollHint.PositionAtCenter)
+        self.file_tree.setCurrentIndex(index)
+        self.tree_model.set_checked(entry_id, True)
+
+    def _refresh_relevance_index(self):
+        if self.relevance_index is None or self.tree_model is None:
+            return
+        if self.relevance_thread is not None:
+            # Still busy, so look again later
+            self.relevance_refresh_timer.start()
+            return
+        self.relevance_thread = RelevanceIndexThread(
+            self.relevance_index, self.tree_model.project_index)
+        self.relevance_thread.progress.connect(self._on_relevance_progress)
+        self.relevance_thread.ready.connect(self._update_suggestions)
+        self.relevance_thread.finished.connect(self._on_relevance_thread_finished)
+        self.relevance_thread.start(QThread.Priority.LowPriority)
+
+    def _stop_relevance_thread(self):
+        self.relevance_refresh_timer.stop()
+        if self.relevance_thread is not None:
+            self.relevance_thread.ready.disconnect(self._update_suggestions)
+            self.relevance_thread.stop()
+            self.relevance_thread = None
+            self.suggest_label.setText("Suggested Files:")
+
+    def _on_relevance_progress(self, done, total):
+        self.suggest_label.setText(f"Suggested Files (indexing {done}/{total}):")
+
+    def _on_relevance_thread_finished(self):
+        if self.sender() is self.relevance_thread:
+            self.relevance_thread = None
+            self.suggest_label.setText("Suggested Files:")
+
+    def _update_suggestions(self):
+        self.suggestion_list.clear()
+        text = self.defect_input.toPlainText()
+        if self.relevance_index is None or self.tree_model is None or not text.strip():
+            return
+        project_index = self.tree_model.project_index
+        for rel_path, score in self.relevance_index.suggest(text):
+            entry_id = project_index.find(rel_path)
+            if entry_id < 0:
+                continue
+            item = QListWidgetItem(rel_path)
+            item.setToolTip(f"Relevance score {score:.1f}")
+            item.setData(Qt.ItemDataRole.UserRole, entry_id)
+            self.suggestion_list.addItem(item)
+
+    def add_top_suggestions(self):
+        """Select the best matching files for the defect description"""
+        if self.tree_model is None:
+            return
+        count = min(self.suggest_count_input.value(), self.suggestion_list.count())
+        for row in range(count):
+            entry_id = self.suggestion_list.item(row).data(Qt.ItemDataRole.UserRole)
+            if not self.tree_model.project_index.is_removed(entry_id):
+                self.tree_model.set_checked(entry_id, True)
+        self.settings["suggestion_count"] = self.suggest_count_input.value()
+        self.save_settings()
+
+    def add_imported_files(self):
+        """Select the project files that the selected files import"""
+        if self.import_graph is None or self.import_thread is not None:
+            return
+        selected_ids = self.get_selected_file_ids()
+        if not selected_ids:
+            self.statusBar().showMessage("Select the files whose imports to add")
+            return
+        self.settings["import_depth"] = self.import_depth_input.value()
+        self.save_settings()
+        self.add_imports_btn.setEnabled(False)
+        self.import_thread = ImportExpansionThread(
+            self.import_graph, selected_ids, self.import_depth_input.value())
+        self.import_thread.ready.connect(self._on_imports_found)
+        self.import_thread.finished.connect(self._on_import_thread_finished)
+        self.import_thread.start()
+
+    def _on_imports_found(self, file_ids):
+        if self.tree_model is None:
+            return
+        project_index = self.tree_model.project_index
+        selection = self.tree_model.selection
+        added = 0
+        for file_id in file_ids:
+            if not project_index.is_removed(file_id) and not selection.is_selected(file_id):
+                self.tree_model.set_checked(file_id, True)
+                added += 1
+        if added:
+            self.statusBar().showMessage(f"Selected {added} imported file(s)")
+        else:
+            self.statusBar().showMessage("The selected files import no other project files")
+
+    def _stop_import_thread(self):
+        if self.import_thread is not None:
+            self.import_thread.ready.disconnect(self._on_imports_found)
+            self.import_thread.stop()
+            self.import_thread = None
+            self.add_imports_btn.setEnabled(True)
+
+    def _on_import_thread_finished(self):
+        if self.sender() is self.import_thread:
+            self.import_thread = None
+            self.add_imports_btn.setEnabled(True)
+
+    def _refresh_git_marks(self):
+        if self.git_repository is None or self.tree_model is None:
+            return
+        if self.git_thread is not None:
+            # Still busy, so look again later
+            if not self.select_changed_pending:
+                self.git_refresh_timer.start()
+            return
+        self.git_thread = GitStatusThread(self.git_repository,
+                                          self.git_commits_input.value(),
+                                          changed_files=self.select_changed_pending)
+        self.select_changed_pending = False
+        self.git_thread.ready.connect(self._on_git_marks)
+        self.git_thread.changed.connect(self._on_changed_files)
+        self.git_thread.finished.connect(self._on_git_thread_finished)
+        self.git_thread.start(QThread.Priority.LowPriority)
+
+    def _on_git_marks(self, marks):
+        if self.tree_model is not None:
+            self.tree_model.set_git_marks(marks)
+
+    def _stop_git_thread(self):
+        self.git_refresh_timer.stop()
+        self.select_changed_pending = False
+        self.select_changed_btn.setEnabled(True)
+        if self.git_thread is not None:
+            self.git_thread.ready.disconnect(self._on_git_marks)
+            self.git_thread.changed.disconnect(self._on_changed_files)
+            self.git_thread.wait()
+            self.git_thread = None
+
+    def _on_git_thread_finished(self):
+        if self.sender() is self.git_thread:
+            self.git_thread = None
+            if self.select_changed_pending:
+                self._refresh_git_marks()
+
+    def _on_git_commits_changed(self, value):
+        self.settings["git_commits"] = value
+        self.settings_save_timer.start()
+        self._refresh_git_marks()
+
+    def _on_git_diffs_changed(self, checked):
+        self.settings["git_diffs"] = checked
+        self.save_settings()
+
+    def select_changed_files(self):
+        """Select the uncommitted files and those changed in the last commits"""
+        if self.git_repository is None or self.tree_model is None:
+            return
+        # git status and git log run on the git thread, which may be busy
+        self.select_changed_pending = True
+        self.select_changed_btn.setEnabled(False)
+        self.statusBar().showMessage("Reading the changed files from git...")
+        self._refresh_git_marks()
+
+    def _on_changed_files(self, rel_paths):
+        self.select_changed_btn.setEnabled(True)
+        if self.tree_model is None:
+            return
+        project_index = self.tree_model.project_index
+        added = 0
+        for rel_path in rel_paths:
+            entry_id = project_index.find(rel_path)
+            if (entry_id >= 0 and not project_index.is_dir(entry_id)
+                    and not self.tree_model.selection.is_selected(entry_id)):
+                self.tree_model.set_checked(entry_id, True)
+                added += 1
+        self.statusBar().showMessage(f"Selected {added} changed file(s)")
+
+    def _show_tree_menu(self, position):
+        index = self.file_tree.indexAt(position)
+        if self.tree_model is None or not index.isValid() or self.tree_model.is_dir(index):
+            return
+        menu = QMenu(self)
+        action = menu.addAction("Choose Symbols...", lambda: self.choose_symbols(index))
+        action.setEnabled(has_parser(self.tree_model.file_path(index)))
+        menu.exec(self.file_tree.viewport().mapToGlobal(position))
+
+    def choose_symbols(self, index):
+        """Pick the classes and functions of a file to include in full"""
+        if self.tree_model is None or not index.isValid() or self.tree_model.is_dir(index):
+            self.statusBar().showMessage("Select a source file in the tree first")
+            return
+        entry_id = self.tree_model.entry_id(index)
+        path = self.tree_model.file_path(index)
+        rel_path = self.tree_model.project_index.rel_path(entry_id, "/")
+        if not has_parser(path):
+            self.statusBar().showMessage(f"Symbols of {rel_path} cannot be listed")
+            return
         try:
-            pyperclip.copy(prompt)
-        except pyperclip.PyperclipException:
-            self.output_text.setText(
-                prompt + "\n\n[Clipboard copy failed. Please copy manually.]")
-
-    def on_tree_selection_changed(self):
-        # Block signals temporarily to prevent recursion
-        self.file_tree.blockSignals(True)
-
-        # Get the item that triggered the change (last clicked)
-        current_item = self.file_tree.currentItem()
-        if not current_item:
-            self.file_tree.blockSignals(False)
+            symbols = self.symbol_cache.get(path)
+        except (OSError, UnicodeDecodeError) as e:
+            self.statusBar().showMessage(f"Could not read {rel_path}: {str(e)}")
+            return
+        if not symbols:
+            self.statusBar().showMessage(f"{rel_path} has no classes or functions")
             return
 
-        # Handle the selection state of the current item
-        is_selected = current_item.isSelected()
-
-        # If it's a folder, handle its children
-        if current_item.childCount() > 0:
-            self._batch_select_children(current_item, is_selected)
-
-        # Update parent states only for the current branch
-        self._update_parent_chain(current_item)
-
-        self.file_tree.blockSignals(False)
-
-    def _batch_select_children(self, parent_item, select):
-        """More efficient batch selection of children"""
-        stack = [(parent_item, 0)]
-
-        while stack:
-            item, child_index = stack[-1]
+        dialog = SymbolPickerDialog(rel_path, symbols,
+                                    self.file_symbols.get(rel_path, ()), self)
+        if dialog.exec() != QDialog.DialogCode.Accepted:
+            return
+        chosen = dialog.chosen()
+        if chosen:
+            self.file_symbols[rel_path] = chosen
+            self.tree_model.set_checked(entry_id, True)
+            self.statusBar().showMessage(
+                f"{rel_path}: {len(chosen)} symbol(s) included in full")
+        else:
+            self.file_symbols.pop(rel_path, None)
+            self.statusBar().showMessage(f"{rel_path} is included whole")
 
-            if child_index >= item.childCount():
-                stack.pop()
+    def get_selected_files(self):
+        if self.tree_model is None:
+            return []
+        project_index = self.tree_model.project_index
+        return [project_index.path(entry_id)
+                for entry_id in self.get_selected_file_ids()]
+
+    def get_selected_file_ids(self):
+        """Index entry ids of the selected files, in selection order"""
+        if self.tree_model is None:
+            return []
+        return self.tree_model.selection.selected_ids()
+
+    def _get_tree_structure(self, root_path, selected_ids=()):
+        """Generate a tree-like structure of the files/folders for the prompt"""
+        if self.tree_model is None:
+            return ""
+        return self.structure_renderer.render(
+            self._tree_state_version,
+            is_expanded=self.tree_model.is_expanded,
+            mode=self.structure_mode_input.currentData(),
+            selected_ids=selected_ids,
+            max_depth=self.settings.get("structure_max_depth", 3),
+            max_entries=self.settings.get("structure_max_entries", 50))
+
+    def _on_tree_state_changed(self, *args):
+        # Invalidates the memoized structure text
+        self._tree_state_version += 1
+
+    def _on_tree_expansion(self, index, expanded):
+        if self.tree_model is not None:
+            self.tree_model.set_expanded(index, expanded)
+            self._on_tree_state_changed()
+
+    def _on_structure_mode_changed(self):
+        self.settings["structure_mode"] = self.structure_mode_input.currentData()
+        self.save_settings()
+
+    def _stack_trace_lines(self):
+        """{entry id: frame lines} of the project files in the defect's stack traces"""
+        if self.frame_resolver is None:
+            return {}
+        from stack_trace import parse_frames
+        frames = parse_frames(self.defect_input.toPlainText())
+        return self.frame_resolver.resolve_frames(frames) if frames else {}
+
+    def _apply_stack_trace(self):
+        """Select the files of new stack frames, once each, so they can be unticked"""
+        if self.tree_model is None:
+            return
+        project_index = self.tree_model.project_index
+        added = 0
+        for entry_id in self._stack_trace_lines():
+            rel_path = project_index.rel_path(entry_id)
+            if rel_path in self._trace_selected:
                 continue
+            self._trace_selected.add(rel_path)
+            self.tree_model.set_checked(entry_id, True)
+            added += 1
+        if added:
+            self.statusBar().showMessage(f"Selected {added} file(s) from the stack trace")
+
+    def _chosen_symbols(self, selected_ids):
+        """{path: chosen symbols} of the selected files with chosen symbols"""
+        if not self.file_symbols or self.tree_model is None:
+            return {}
+        project_index = self.tree_model.project_index
+        chosen = {}
+        for entry_id in selected_ids:
+            symbols = self.file_symbols.get(project_index.rel_path(entry_id, "/"))
+            if symbols:
+                chosen[project_index.path(entry_id)] = symbols
+        return chosen
+
+    def _create_prompt_builder(self, timings=None):
+        from prompt_builder import PromptBuilder, read_text_file
+
+        selected_ids = self.get_selected_file_ids()
+        project_index = self.tree_model.project_index if self.tree_model else None
+        max_file_bytes, max_total_bytes = self._size_limits()
+        part_budget, part_unit = self._part_budget()
+        diff_source = None
+        if self.git_repository is not None and self.git_diffs_input.isChecked():
+            from git_repo import DiffSource
+            diff_source = DiffSource(self.git_repository, self.git_commits_input.value())
+        # Files in a stack trace are cut down to the lines around their frames
+        context_lines = self.settings.get("stack_trace_context", 20)
+        line_windows = {}
+        if context_lines > 0 and project_index is not None:
+            selected = set(selected_ids)
+            line_windows = {project_index.path(entry_id): lines for entry_id, lines
+                            in self._stack_trace_lines().items() if entry_id in selected}
+        with span(timings, "Render structure"):
+            tree_structure = self._get_tree_structure(
+                self.settings.get("root_folder", ""), selected_ids)
+        return PromptBuilder(
+            read_text_file(self.settings.get("prompt_template", "")),
+            self.defect_input.toPlainText(),
+            read_text_file(self.settings.get("context_file", "")),
+            tree_structure,
+            [project_index.path(entry_id) for entry_id in selected_ids],
+            self.settings.get("root_folder", ""),
+            cache=self.content_cache,
+            token_counter=self.token_counter,
+            token_budget=self.token_budget_input.value() or None,
+            line_windows=line_windows,
+            context_lines=context_lines,
+            max_file_bytes=max_file_bytes,
+            max_total_bytes=max_total_bytes,
+            symbols=self._chosen_symbols(selected_ids),
+            symbol_cache=self.symbol_cache,
+            part_budget=part_budget,
+            part_unit=part_unit,
+            diff_source=diff_source,
+            file_source=project_index.agent if project_index is not None else None,
+            timings=timings)
+
+    def generate_prompt(self, output_path=None):
+        # A second click while generating cancels the running generation
+        if self.prompt_thread is not None:
+            self.prompt_thread.cancel()
+            return
+        if self.tree_model is not None and self.tree_model.pending_checks:
+            # Runs from on_tree_selection_changed once they are checked
+            self.deferred_generation = (output_path,)
+            self.statusBar().showMessage(
+                "Generating once the files of the checked folders are loaded")
+            return
 
-            child = item.child(child_index)
-            # Update index for next iteration
-            stack[-1] = (item, child_index + 1)
-
-            child.setSelected(select)
-
-            if child.childCount() > 0:
-                stack.append((child, 0))
+        timings = create_timings(self.settings, "Generate prompt")
+        with profiled(timings), span(timings, "Prepare"):
+            builder = self._create_prompt_builder(timings)
+        self.prompt_timings = timings
+        self.prompt_thread = PromptGenerationThread(builder, output_path, timings)
+        self.prompt_thread.progress.connect(self._on_prompt_progress)
+        self.prompt_thread.token_report.connect(self._on_token_report)
+        self.prompt_thread.sections.connect(self._on_prompt_sections)
+        self.prompt_thread.generated.connect(self._on_prompt_generated)
+        self.prompt_thread.generated_parts.connect(self._on_prompt_parts_generated)
+        self.prompt_thread.saved.connect(self._on_prompt_saved)
+        self.prompt_thread.failed.connect(self._on_prompt_failed)
+        self.prompt_thread.cancelled.connect(self._on_prompt_cancelled)
+        self.prompt_thread.finished.connect(self._on_prompt_thread_finished)
+
+        if output_path is None:
+            self.prompt_parts = []
+            self._update_part_controls()
+            self.prompt_view.clear()
+            if timings is not None:
+                timings.begin("Show prompt")
+        self.generate_btn.setText("Cancel")
+        self.save_prompt_btn.setEnabled(False)
+        self.prompt_progress.setValue(0)
+        self.prompt_progress.show()
+        self.prompt_thread.start()
+
+    def save_prompt(self):
+        file_path, _ = QFileDialog.getSaveFileName(
+            self, "Save Prompt", "", "Text Files (*.txt);;All Files (*)"
+        )
+        if file_path:
+            self.generate_prompt(file_path)
+
+    def _on_prompt_progress(self, done, total):
+        self.prompt_progress.setMaximum(max(total, 1))
+        self.prompt_progress.setValue(done)
+
+    def _on_token_budget_changed(self, value):
+        self.settings["token_budget"] = value
+        self.settings_save_timer.start()
+        # Repack the last prompt once the user stops changing the budget
+        if self.token_report:
+            self.repack_timer.start()
+
+    def _on_part_size_changed(self):
+        self.settings["part_size"] = self.part_size_input.value()
+        self.settings["part_unit"] = self.part_unit_input.currentData()
+        self.settings_save_timer.start()
+
+    def _part_budget(self):
+        """(budget, unit) for the prompt builder, (None, unit) for one prompt"""
+        size = self.part_size_input.value()
+        if self.part_unit_input.currentData() == "kb":
+            return (size * 1024 or None), "chars"
+        return (size or None), "tokens"
+
+    def _repack_prompt(self):
+        if self.prompt_thread is None:
+            self.generate_prompt()
+
+    def _on_token_report(self, report):
+        self.token_report = report
+        self._update_token_summary()
+        self.prompt_view.set_tokens(report)
+
+    def _update_token_summary(self):
+        if not self.token_report:
+            return
+        sections = dict(self.token_report[:5])
+        # The description is cheap to re-count, so follow the user's typing
+        sections["Defect Description"] = self.token_counter.count_text(
+            f"**Defect Description:**\n{self.defect_input.toPlainText()}\n\n")
+        files = self.token_report[5:]
+        file_tokens = sum(tokens for _, tokens in files)
+        total = sum(sections.values()) + file_tokens
+
+        parts = [f"{title} {tokens:,}" for title, tokens in sections.items()
+                 if title != "File Contents"]
+        parts.append(f"Files {file_tokens + sections['File Contents']:,} ({len(files)})")
+        budget = self.token_budget_input.value()
+        summary = f"Tokens: {total:,}"
+        if budget:
+            summary += f" of {budget:,}"
+        self.token_label.setText(summary + " | " + " | ".join(parts))
+        self.token_label.setToolTip("\n".join(
+            f"{title}: {tokens:,}" for title, tokens in files))
+
+    def _on_prompt_sections(self, sections):
+        for title, text in sections:
+            self.prompt_view.append_section(title, text)
+
+    def _on_prompt_generated(self, prompt):
+        self._copy_to_clipboard(prompt)
+
+    def _on_prompt_parts_generated(self, parts):
+        self.prompt_parts = parts
+        self._show_part(0)
+
+    def _show_part(self, number):
+        """Show a part of a split prompt and copy it to the clipboard"""
+        if not 0 <= number < len(self.prompt_parts):
+            return
+        self.current_part = number
+        self._update_part_controls()
+        self.prompt_view.set_sections(self.prompt_parts[number])
+        self.prompt_view.set_tokens(self.token_report)
+        self._copy_part()
+
+    def _copy_part(self):
+        """Copy the shown part of a split prompt to the clipboard"""
+        self._copy_to_clipboard(
+            "".join(text for _, text in self.prompt_parts[self.current_part]))
+        if len(self.prompt_parts) > 1:
+            self.statusBar().showMessage(f"Part {self.current_part + 1} of "
+                                         f"{len(self.prompt_parts)} copied to the clipboard")
+
+    def _update_part_controls(self):
+        count = len(self.prompt_parts)
+        for widget in (self.part_label, self.previous_part_btn,
+                       self.next_part_btn, self.copy_part_btn):
+            widget.setVisible(count > 1)
+        self.part_label.setText(f"Part {self.current_part + 1} of {count}")
+        self.previous_part_btn.setEnabled(self.current_part > 0)
+        self.next_part_btn.setEnabled(self.current_part < count - 1)
+
+    def _copy_to_clipboard(self, text):
+        import pyperclip
+        try:
+            with span(self.prompt_timings, "Clipboard copy"):
+                pyperclip.copy(text)
+        except pyperclip.PyperclipException:
+            self.statusBar().showMessage(
+                "Clipboard copy failed. Please copy the prompt manually.")
+
+    def _on_prompt_saved(self, path):
+        self.statusBar().showMessage(f"Prompt saved to {path}")
+
+    def _on_prompt_failed(self, message):
+        self.statusBar().showMessage(f"Prompt generation failed: {message}")
+
+    def _on_prompt_cancelled(self):
+        self.statusBar().showMessage("Prompt generation cancelled")
+
+    def _on_prompt_thread_finished(self):
+        missing = self.prompt_thread.builder.missing
+        self.prompt_thread = None
+        if missing and self.tree_model is not None:
+            # Drops them from the tree and the selection
+            self.tree_model.refresh_files(missing)
+            self.statusBar().showMessage(
+                f"Left out {len(missing)} selected file(s) that no longer exist")
+        self.generate_btn.setText("Generate Prompt")
+        self.save_prompt_btn.setEnabled(True)
+        self.prompt_progress.hide()
+        if not self.prompt_view.is_loading():
+            self._on_prompt_view_loaded()
+
+    def _on_prompt_view_loaded(self):
+        # The view may catch up with the generation before it is done
+        if self.prompt_timings is None or self.prompt_thread is not None:
+            return
+        self.prompt_timings.end("Show prompt")
+        self._show_timings(self.prompt_timings)
+        self.prompt_timings = None
 
-    def _update_parent_chain(self, item):
-        """Update selection state of parent chain"""
-        current = item.parent()
-        while current:
-            all_selected = all(current.child(i).isSelected()
-                               for i in range(current.childCount()))
-            current.setSelected(all_selected)
-            current = current.parent()
+    def on_tree_selection_changed(self):
+        self._on_tree_state_changed()
+        self._update_selection_summary()
+        # Start reading the selection once the user pauses
+        self.prewarm_timer.start()
+        if self.deferred_generation is not None and not self.tree_model.pending_checks:
+            output_path, = self.deferred_generation
+            self.deferred_generation = None
+            self.generate_prompt(output_path)
+
+    def _update_selection_summary(self):
+        """Show how much is selected, so the cost is visible before generating"""
+        if self.tree_model is None:
+            self.tree_label.setText("Select Project Files:")
+            return
+        selection = self.tree_model.selection
+        text = (f"Select Project Files: {len(selection)} selected, "
+                f"{format_size(selection.selected_bytes)}")
+        if self.tree_model.pending_checks:
+            text += f", loading {len(self.tree_model.pending_checks)} folder(s)"
+        self.tree_label.setText(text)
+
+    def _size_limits(self):
+        """(per-file, total) byte caps from the settings, None for no cap"""
+        from file_ingest import DEFAULT_MAX_FILE_BYTES, DEFAULT_MAX_TOTAL_BYTES
+
+        max_file_kb = self.settings.get("max_file_size_kb", DEFAULT_MAX_FILE_BYTES // 1024)
+        max_total_mb = self.settings.get(
+            "max_total_size_mb", DEFAULT_MAX_TOTAL_BYTES // (1024 * 1024))
+        return (max_file_kb * 1024 if max_file_kb > 0 else None,
+                max_total_mb * 1024 * 1024 if max_total_mb > 0 else None)
+
+    def _prewarm_selected_files(self):
+        # Files over the cap are read in part at generation, so the cache cannot help
+        if self.tree_model is None:
+            return
+        if self.tree_model.project_index.agent is not None:
+            # The agent reads and caches the files on its side
+            return
+        max_file_bytes = self._size_limits()[0]
+        project_index = self.tree_model.project_index
+        paths = [project_index.path(entry_id) for entry_id in self.get_selected_file_ids()
+                 if max_file_bytes is None or project_index.size(entry_id) <= max_file_bytes]
+        from file_ingest import load_text
+        self.content_cache.prewarm(paths, load_text)
@@ -1,5 +1,6 @@
 import os
 import sys
+import json
 
 
 def get_resource_path(relative_path):
@@ -11,3 +12,51 @@ def get_resource_path(relative_path):
         base_path = os.path.abspath(".")
 
     return os.path.join(base_path, relative_path)
+
+
+def default_settings():
+    """Settings used when settings.json is missing"""
+    # Load default template path
+    default_template = get_resource_path(
+        'templates/default_template.txt')
+    return {
+        "prompt_template": default_template,
+        "context_file": "",
+        "root_folder": "",
+        "excluded_folders": [".git", "__pycache__", "node_modules", ".venv", "venv"],
+        "excluded_extensions": [".pyc", ".pyo", ".pyd", ".so", ".dll"]
+    }
+
+
+def read_settings():
+    """Load settings.json, or None if it is missing or unreadable"""
+    settings_path = get_resource_path('settings.json')
+    try:
+        with open(settings_path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def get_cache_dir():
+    """Get the per-user folder for caches that can be rebuilt at any time"""
+    if sys.platform == "win32":
+        base_path = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    elif sys.platform == "darwin":
+        base_path = os.path.expanduser("~/Library/Caches")
+    else:
+        base_path = os.environ.get(
+            "XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+
+    return os.path.join(base_path, "LLMDefectPrompter")
+
+
+def format_size(size):
+    """Human readable file size, such as 12.3 KB"""
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    if unit == "bytes":
+        return f"{size} bytes"
+    return f"{size:.1f} {unit}"